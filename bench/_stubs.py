@@ -0,0 +1,481 @@
+"""Local stand-ins used by the benchmarks in this folder.
+
+FakeTelegramSession replaces the Bot API HTTP session: outgoing calls are
+answered locally (with optional latency) and getUpdates is served from a queue,
+so the real polling loop can be driven offline.
+
+PostgRESTStub is a tiny threaded HTTP server that understands the subset of
+the PostgREST protocol bot.py uses (eq/in/lt/gt filters, order, limit/offset,
+count=exact, insert/upsert/update, one-to-many embeds like
+`*,shipment_events(status,created_at)`) over in-memory tables, with a
+configurable per-request latency to mimic the network round trip to Supabase.
+`.triggers[table]` stands in for row triggers: called as fn(stub, old, new)
+after each insert (old=None) and update.
+"""
+import asyncio
+import itertools
+import functools
+import json
+import multiprocessing
+import operator
+import os
+import re
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FAKE_ENV = {
+    "BOT_TOKEN": "123456:TEST-token-for-benchmarks",
+    "SUPABASE_SERVICE_ROLE_KEY": "bench.service.role",
+    "ADMIN_IDS": "1",
+}
+
+
+def import_bot(supabase_url: str):
+    """Import bot.py against the stub without touching a real .env."""
+    for k, v in FAKE_ENV.items():
+        os.environ.setdefault(k, v)
+    os.environ["SUPABASE_URL"] = supabase_url
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import bot
+    return bot
+
+
+def _cast(v: str):
+    if v == "null":
+        return None
+    if v in ("true", "false"):
+        return v == "true"
+    try:
+        return int(v)
+    except ValueError:
+        pass
+    try:
+        return float(v)
+    except ValueError:
+        return v
+
+
+def _cmp_key(v):
+    # Mixed None/str/number columns must still sort deterministically.
+    return (v is None, str(type(v)), v if v is not None else 0)
+
+
+@functools.lru_cache(maxsize=4096)
+def _compile(col: str, expr: str):
+    """Predicate for one `col=op.arg` filter, parsed once per distinct filter."""
+    op, _, arg = expr.partition(".")
+    if op != "in":
+        arg = arg.strip('"')
+    if op in ("eq", "neq"):
+        typed = _cast(arg)
+        eq = lambda r: (v := r.get(col)) == typed or str(v) == arg
+        return eq if op == "eq" else (lambda r: not eq(r))
+    if op == "in":
+        items = {x.strip('"') for x in arg.strip("()").split(",") if x}
+        return lambda r: str(r.get(col)) in items
+    if op == "is":
+        typed = _cast(arg)
+        return (lambda r: r.get(col) is None) if arg == "null" else (lambda r: r.get(col) == typed)
+    if op in ("lt", "lte", "gt", "gte"):
+        a = _cast(arg)
+        cmp = {"lt": operator.lt, "lte": operator.le, "gt": operator.gt, "gte": operator.ge}[op]
+
+        def ordered(r):
+            val = r.get(col)
+            if val is None:
+                return False
+            if isinstance(val, str) or isinstance(a, str):
+                return cmp(str(val), str(a))
+            return cmp(val, a)
+        return ordered
+    if op == "ilike":
+        needle = arg.strip("*%").lower()
+        return lambda r: needle in str(r.get(col) or "").lower()
+    return lambda r: True
+
+
+def _match(row: dict, col: str, expr: str) -> bool:
+    return _compile(col, expr)(row)
+
+
+def _split_top(s: str) -> list[str]:
+    out, depth, cur = [], 0, ""
+    for ch in s:
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        if ch == "," and depth == 0:
+            out.append(cur)
+            cur = ""
+        else:
+            cur += ch
+    if cur:
+        out.append(cur)
+    return out
+
+
+@functools.lru_cache(maxsize=4096)
+def _compile_logic(kind: str, body: str):
+    parts = []
+    for cond in _split_top(body.strip()[1:-1]):
+        if cond.startswith(("and(", "or(")):
+            k, _, rest = cond.partition("(")
+            parts.append(_compile_logic(k, "(" + rest))
+        else:
+            col, _, expr = cond.partition(".")
+            parts.append(_compile(col, expr))
+    if kind == "and":
+        return lambda r: all(p(r) for p in parts)
+    return lambda r: any(p(r) for p in parts)
+
+
+def _match_logic(row: dict, kind: str, body: str) -> bool:
+    return _compile_logic(kind, body)(row)
+
+
+class PostgRESTStub:
+    def __init__(self, latency_ms: float = 20.0, port: int = 0):
+        self.latency = latency_ms / 1000.0
+        self.tables: dict[str, list[dict]] = {}
+        self.rpcs: dict[str, callable] = {}
+        self.triggers: dict[str, callable] = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._ids: dict[str, int] = {}
+        # Like DB indexes: sorted copies per (table, order), dropped on any write
+        self._sorted: dict[tuple[str, str], list[dict]] = {}
+        ThreadingHTTPServer.request_queue_size = 256
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.process = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self, in_process: bool = False) -> "PostgRESTStub":
+        """Serve from a forked child by default so the stub's CPU time does not
+        compete with the bot's event loop for the GIL; seed tables first."""
+        if in_process:
+            self.thread.start()
+        else:
+            self.process = multiprocessing.get_context("fork").Process(target=self.server.serve_forever, daemon=True)
+            self.process.start()
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+        else:
+            self.server.shutdown()
+
+    def seed(self, table: str, rows: list[dict]):
+        with self._lock:
+            self._sorted.clear()
+            dest = self.tables.setdefault(table, [])
+            for r in rows:
+                dest.append(self._with_defaults(table, dict(r)))
+
+    def append_row(self, table: str, row: dict) -> dict:
+        """Insert from inside an rpc or trigger callback (the stub lock is already held)."""
+        self._sorted = {k: v for k, v in self._sorted.items() if k[0] != table}
+        row = self._with_defaults(table, dict(row))
+        self.tables.setdefault(table, []).append(row)
+        return row
+
+    def _with_defaults(self, table: str, row: dict) -> dict:
+        if "id" not in row:
+            self._ids[table] = self._ids.get(table, 0) + 1
+            row["id"] = self._ids[table]
+        else:
+            self._ids[table] = max(self._ids.get(table, 0), int(row["id"]) if str(row["id"]).isdigit() else 0)
+        row.setdefault("created_at", datetime.now(timezone.utc).isoformat())
+        return row
+
+    # --- query evaluation ---
+    def _filter(self, rows: list[dict], params: list[tuple[str, str]]) -> list[dict]:
+        for k, v in params:
+            if k.rsplit(".", 1)[-1] in ("select", "order", "limit", "offset", "on_conflict", "columns"):
+                continue
+            pred = _compile_logic(k, v) if k in ("or", "and") else _compile(k, v)
+            rows = [r for r in rows if pred(r)]
+        return rows
+
+    @staticmethod
+    def _order(rows: list[dict], spec: str | None) -> list[dict]:
+        if not spec:
+            return rows
+        for part in reversed(spec.split(",")):
+            col, *mods = part.split(".")
+            rows = sorted(rows, key=lambda r: _cmp_key(r.get(col)), reverse="desc" in mods)
+        return rows
+
+    def _ordered(self, table: str, rows: list[dict], spec: str | None) -> list[dict]:
+        if not spec:
+            return rows
+        key = (table, spec)
+        if key not in self._sorted:
+            self._sorted[key] = self._order(rows, spec)
+        return self._sorted[key]
+
+    def _project(self, table: str, rows: list[dict], select: str | None, p: dict) -> list[dict]:
+        select = select or "*"
+        embeds = re.findall(r"(\w+)\(([^)]*)\)", select)
+        cols = [c.strip() for c in re.sub(r"\w+\([^)]*\)", "", select).split(",") if c.strip()]
+        out = [dict(r) if cols == ["*"] else {c: r.get(c) for c in cols} for r in rows]
+        # One-to-many only: child.<parent singular>_id = parent.id
+        for child, child_cols in embeds:
+            fk = table[:-1] + "_id"
+            children = self._order(self.tables.get(child, []), p.get(f"{child}.order"))
+            lim = int(p[f"{child}.limit"]) if f"{child}.limit" in p else None
+            wanted = [c.strip() for c in child_cols.split(",") if c.strip()]
+            for src, row in zip(rows, out):
+                mine = [c for c in children if c.get(fk) == src.get("id")][:lim]
+                row[child] = [c if wanted == ["*"] else {k: c.get(k) for k in wanted} for c in mine]
+        return out
+
+    def handle(self, method: str, path: str, query: str, headers, body: bytes):
+        params = parse_qsl(query, keep_blank_values=True)
+        p = dict(params)
+        prefer = headers.get("Prefer", "") or ""
+        name = path.rsplit("/", 1)[-1]
+        payload = json.loads(body) if body else None
+        with self._lock:
+            self.requests += 1
+            if "/rpc/" in path:
+                fn = self.rpcs.get(name)
+                if fn is None:
+                    return 404, {"message": f"function {name} not found"}, {}
+                self._sorted.clear()  # rpc callbacks may write
+                return 200, fn(self, payload or {}), {}
+            rows = self.tables.setdefault(name, [])
+            if method not in ("GET", "HEAD"):
+                self._sorted = {k: v for k, v in self._sorted.items() if k[0] != name}
+            if method in ("GET", "HEAD"):
+                # Sorting first (cached) then filtering keeps the order: filters are stable
+                found = self._filter(self._ordered(name, rows, p.get("order")), params)
+                total = len(found)
+                off = int(p.get("offset", 0))
+                lim = int(p["limit"]) if "limit" in p else None
+                page = found[off: off + lim if lim is not None else None]
+                hdr = {}
+                if "count=" in prefer:
+                    end = off + len(page) - 1
+                    hdr["Content-Range"] = f"{off}-{end}/{total}" if page else f"*/{total}"
+                return 200, self._project(name, page, p.get("select"), p), hdr
+            if method == "POST":
+                items = payload if isinstance(payload, list) else [payload]
+                conflict = p.get("on_conflict")
+                out = []
+                for item in items:
+                    if conflict:
+                        keys = conflict.split(",")
+                        existing = next((r for r in rows if all(r.get(k) == item.get(k) for k in keys)), None)
+                        if existing is not None:
+                            if "resolution=merge-duplicates" in prefer:
+                                existing.update(item)
+                                out.append(dict(existing))
+                            continue
+                    row = self._with_defaults(name, dict(item))
+                    rows.append(row)
+                    out.append(dict(row))
+                    if name in self.triggers:
+                        self.triggers[name](self, None, row)
+                return 201, out, {}
+            if method == "PATCH":
+                found = self._filter(rows, params)
+                for r in found:
+                    old = dict(r)
+                    r.update(payload or {})
+                    if name in self.triggers:
+                        self.triggers[name](self, old, r)
+                return 200, [dict(r) for r in found], {}
+            if method == "DELETE":
+                found = self._filter(rows, params)
+                self.tables[name] = [r for r in rows if r not in found]
+                return 200, [dict(r) for r in found], {}
+        return 405, {"message": "unsupported"}, {}
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def _serve(self):
+                if stub.latency:
+                    time.sleep(stub.latency)
+                u = urlsplit(self.path)
+                n = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(n) if n else b""
+                code, data, extra = stub.handle(self.command, u.path, u.query, self.headers, body)
+                raw = json.dumps(data, default=str).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(raw)))
+                for k, v in extra.items():
+                    self.send_header(k, v)
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(raw)
+
+            do_GET = do_POST = do_PATCH = do_DELETE = do_HEAD = _serve
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def synthetic_shipments(n: int, start: datetime | None = None) -> list[dict]:
+    start = start or datetime(2025, 1, 1, tzinfo=timezone.utc)
+    statuses = ["В пути", "Прибыло", "На складе"]
+    return [
+        {
+            "id": i + 1,
+            "tracking_code": f"YA{i:09d}",
+            "phone": f"+99290{i % 1000000:07d}",
+            "description": f"Страна: {'Tajikistan' if i % 3 else 'Russia'}",
+            "status": statuses[i % 3],
+            "image_url": None,
+            "created_at": (start + timedelta(minutes=i)).isoformat(),
+        }
+        for i in range(n)
+    ]
+
+
+def peak_rss_mb() -> float:
+    kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return kb / 1024 if sys.platform != "darwin" else kb / 1024 / 1024
+
+
+def percentile(samples: list[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    s = sorted(samples)
+    idx = min(len(s) - 1, max(0, int(round(q / 100.0 * (len(s) - 1)))))
+    return s[idx]
+
+
+# ---------- Fake Telegram Bot API ----------
+def _bot_api_types():
+    from aiogram.client.session.base import BaseSession
+    from aiogram.methods.base import Response
+    return BaseSession, Response
+
+
+def make_fake_session(latency_ms: float = 0.0):
+    BaseSession, Response = _bot_api_types()
+
+    class FakeTelegramSession(BaseSession):
+        def __init__(self):
+            super().__init__()
+            self.latency = latency_ms / 1000.0
+            self.calls: Counter = Counter()
+            self.sent: list[tuple[str, dict]] = []
+            self.updates: asyncio.Queue = asyncio.Queue()
+            self.files: dict[str, bytes] = {}
+            self.uploads: dict[str, bytes] = {}  # filename -> bytes of documents the bot sent
+            self._msg_ids = itertools.count(1000)
+
+        async def make_request(self, bot, method, timeout=None):
+            api = method.__api_method__
+            self.calls[api] += 1
+            if api == "getUpdates":
+                result = await self._get_updates(method)
+            else:
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                result = self._result_for(api, method)
+                doc = getattr(method, "document", None)
+                if doc is not None and hasattr(doc, "read"):  # an InputFile upload
+                    self.uploads[doc.filename] = b"".join([c async for c in doc.read(bot)])
+            self.sent.append((api, method.model_dump(exclude_none=True)))
+            return Response[method.__returning__].model_validate(
+                {"ok": True, "result": result}, context={"bot": bot}
+            ).result
+
+        async def _get_updates(self, method):
+            # Long poll: one API round trip, then return whatever is queued.
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if method.timeout == 0 and self.updates.empty():
+                return []  # short poll, e.g. confirming an offset
+            batch = [await self.updates.get()]
+            while not self.updates.empty() and len(batch) < (method.limit or 100):
+                batch.append(self.updates.get_nowait())
+            return batch
+
+        def _result_for(self, api: str, method):
+            chat_id = getattr(method, "chat_id", None) or 1
+            if api == "getMe":
+                return {"id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+            if api == "getFile":
+                return {"file_id": method.file_id, "file_unique_id": method.file_id, "file_path": method.file_id}
+            if api in ("sendMessage", "editMessageText", "sendDocument"):
+                return {
+                    "message_id": getattr(method, "message_id", None) or next(self._msg_ids),
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "text": getattr(method, "text", None) or "",
+                }
+            return True
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            data = self.files.get(url.rsplit("/", 1)[-1], b"")
+            for i in range(0, len(data), chunk_size):
+                yield data[i:i + chunk_size]
+
+        async def close(self):
+            pass
+
+    return FakeTelegramSession()
+
+
+_update_ids = itertools.count(1)
+
+
+def message_update(user_id: int, text: str, **extra) -> dict:
+    uid = next(_update_ids)
+    msg = {
+        "message_id": uid,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"},
+        "text": text,
+    }
+    msg.update(extra)
+    return {"update_id": uid, "message": msg}
+
+
+def callback_update(user_id: int, data: str) -> dict:
+    uid = next(_update_ids)
+    return {
+        "update_id": uid,
+        "callback_query": {
+            "id": str(uid),
+            "chat_instance": "bench",
+            "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"},
+            "data": data,
+            "message": {
+                "message_id": uid,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 123456, "is_bot": True, "first_name": "bench"},
+                "text": "menu",
+            },
+        },
+    }
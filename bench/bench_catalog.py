@@ -0,0 +1,84 @@
+"""Microbenchmark: CPU time of menu handlers with prebuilt vs. per-call keyboards.
+
+"before" swaps the catalog lookups back for the raw builders (and the old
+two-level t()), so both runs execute the same handler code.
+
+    python bench/bench_catalog.py
+"""
+import asyncio
+import time
+from types import SimpleNamespace
+
+from _stubs import import_bot
+
+ITER = 20000
+KEYS = ("back", "track", "calc", "lang", "channels", "warehouse", "delivery")
+
+
+def fake_cb(uid: int, data: str):
+    async def noop(*a, **kw):
+        pass
+    return SimpleNamespace(
+        data=data, from_user=SimpleNamespace(id=uid),
+        message=SimpleNamespace(edit_text=noop), answer=noop,
+    )
+
+
+async def run(bot, lang: str) -> float:
+    uid = 42
+    bot.USER_LANG_CACHE.set(uid, lang)
+    cbs = [fake_cb(uid, f"menu:{k}") for k in KEYS if k != "calc"]  # calc writes state
+    t0 = time.process_time()
+    for i in range(ITER):
+        await bot.handle_menu_callbacks(cbs[i % len(cbs)], lang)
+    return (time.process_time() - t0) / ITER * 1e6
+
+
+def legacy_t(bot):
+    def t(user_id, key, **kwargs):
+        base = bot.LANG.get(bot.get_lang(user_id), bot.LANG["ru"])
+        txt = base.get(key, bot.LANG["ru"].get(key, key))
+        if kwargs:
+            txt = txt.format(**kwargs)
+        return txt
+    return t
+
+
+class RenderPerTap(dict):
+    """TEXTS stand-in that formats the warehouse screen on every access, as before."""
+
+    def __init__(self, lang: dict):
+        super().__init__()
+        self.lang = lang
+
+    def __getitem__(self, code):
+        L = self.lang[code]
+        return dict(L, warehouse_text=L["warehouse_text_multi"].format(
+            title=L["warehouse_title_multi"], tj_label=L["warehouse_tj_label"],
+            ru_label=L["warehouse_ru_label"], tj_addr=L["warehouse_tj_address"],
+            ru_addr=L["warehouse_ru_address"]))
+
+
+async def main():
+    bot = import_bot("http://127.0.0.1:9")
+    names = [n for n in bot.KEYBOARDS if hasattr(getattr(bot, n), "build")]
+    cached = {n: getattr(bot, n) for n in names}
+    cached_t, cached_texts = bot.t, bot.TEXTS
+
+    print(f"{'lang':>4} {'before us/cb':>13} {'after us/cb':>12}")
+    for lang in bot.LANG:
+        for n in names:
+            setattr(bot, n, cached[n].build)
+        bot.t = legacy_t(bot)
+        bot.TEXTS = RenderPerTap(bot.LANG)
+        before = await run(bot, lang)
+
+        for n in names:
+            setattr(bot, n, cached[n])
+        bot.t, bot.TEXTS = cached_t, cached_texts
+        after = await run(bot, lang)
+        print(f"{lang:>4} {before:>13.1f} {after:>12.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
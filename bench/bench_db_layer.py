@@ -0,0 +1,75 @@
+"""Load benchmark: tracking lookups against a stub PostgREST, sync vs async client.
+
+Both variants issue the same query (ShipmentRepo.find_by_code: no cache, no
+coalescing, no metrics) at the same offered rate, open loop: request i is due
+at i / rate seconds. Latency is measured from the due time, so time a request
+spends waiting for the loop (blocked by another user's sync call) counts, as
+it would for a real user. Throughput is completed lookups per second of wall
+time; once it falls below --rate the client is saturated and latency grows
+with the backlog.
+
+    python bench/bench_db_layer.py --total 500 --rate 200 --latency 20
+"""
+import argparse
+import asyncio
+import time
+
+from supabase import create_client
+
+from _stubs import PostgRESTStub, import_bot, percentile, synthetic_shipments
+
+
+async def run(label: str, lookup, total: int, rate: float):
+    latencies: list[float] = []
+
+    async def one(i: int, due: float):
+        await lookup(f"YA{i % 1000:09d}")
+        latencies.append(time.perf_counter() - due)
+
+    tasks = []
+    t0 = time.perf_counter()
+    for i in range(total):
+        due = t0 + i / rate
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(one(i, due)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - t0
+    print(
+        f"{label:<10} lookups={total:<6} {total / elapsed:8.1f} lookups/s  "
+        f"p50={percentile(latencies, 50) * 1000:7.1f}ms  p99={percentile(latencies, 99) * 1000:7.1f}ms"
+    )
+
+
+async def main(args):
+    stub = PostgRESTStub(latency_ms=args.latency)
+    stub.seed("shipments", synthetic_shipments(1000))  # before start(): the stub forks
+    stub.start()
+    bot = import_bot(stub.url)
+    sync_db = create_client(stub.url, bot.SUPABASE_SERVICE_ROLE_KEY)
+    select = bot.ShipmentRepo.TRACK_SELECT
+
+    async def blocking(code: str):
+        # Pre-refactor behaviour: sync HTTP call straight from the handler.
+        sync_db.table("shipments").select(select).eq("tracking_code", code).limit(5).execute()
+
+    async def non_blocking(code: str):
+        await bot.shipments_repo.find_by_code(code)
+
+    # Warm up: client creation and the first connection are not part of the comparison
+    for lookup in (blocking, non_blocking):
+        await asyncio.gather(*(lookup(f"YA{i:09d}") for i in range(5)))
+
+    print(f"total={args.total} rate={args.rate:g}/s latency={args.latency}ms")
+    await run("blocking", blocking, args.total, args.rate)
+    await run("async", non_blocking, args.total, args.rate)
+    stub.stop()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--total", type=int, default=500, help="lookups per variant")
+    ap.add_argument("--rate", type=float, default=200.0, help="offered load, lookups/s")
+    ap.add_argument("--latency", type=float, default=20.0, help="stub round-trip latency, ms")
+    asyncio.run(main(ap.parse_args()))
@@ -0,0 +1,152 @@
+"""Offline replay: synthetic user sessions through the real dispatcher.
+
+Each virtual user plays scripted sessions one update at a time (the next
+update is only sent once the previous handler returned, like a person
+tapping); users run concurrently. Telegram is a fake Bot API session and
+Supabase is the PostgREST stub, both with configurable RTT, so nothing leaves
+the machine.
+
+    python bench/bench_replay.py                              # all scenarios
+    python bench/bench_replay.py --scenario track --users 200 --db-latency 20
+    python bench/bench_replay.py --updates recorded.jsonl     # one Update JSON per line
+
+Reports throughput, p50/p95/p99 per-update latency, peak RSS, and the
+slowest metric series the bot itself recorded.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+from _stubs import (PostgRESTStub, callback_update, import_bot, make_fake_session,
+                    message_update, peak_rss_mb, percentile, synthetic_shipments)
+
+ADMIN = 1  # _stubs.FAKE_ENV["ADMIN_IDS"]
+SHIPMENTS = 5000
+
+
+def menu_session(uid: int, rnd: random.Random) -> list[dict]:
+    taps = ["menu:channels", "menu:delivery", "menu:about", "menu:contact", "menu:warehouse", "menu:lang"]
+    ups = [message_update(uid, "/start")]
+    for tap in rnd.sample(taps, 4):
+        ups += [callback_update(uid, tap), callback_update(uid, "menu:back")]
+    return ups
+
+
+def track_session(uid: int, rnd: random.Random) -> list[dict]:
+    ups = [callback_update(uid, "menu:track")]
+    for _ in range(3):
+        if rnd.random() < 0.7:
+            ups += [callback_update(uid, "track:by_code"), message_update(uid, f"YA{rnd.randrange(SHIPMENTS):09d}")]
+        else:
+            ups += [callback_update(uid, "track:by_phone"), message_update(uid, f"+992900{rnd.randrange(SHIPMENTS):06d}")]
+    return ups
+
+
+def calc_session(uid: int, rnd: random.Random) -> list[dict]:
+    unit = rnd.choice(["m", "cm"])
+    dims = [f"{rnd.uniform(0.2, 2):.2f}" if unit == "m" else str(rnd.randrange(20, 200)) for _ in range(3)]
+    return [callback_update(uid, "menu:calc"), callback_update(uid, f"calc:unit:{unit}"),
+            *(message_update(uid, d) for d in dims)]
+
+
+def admin_paging_session(uid: int, rnd: random.Random) -> list[dict]:
+    # Admin screens are keyed by the admin's id; all virtual admins share ADMIN.
+    ups = [callback_update(ADMIN, "menu:admin"), callback_update(ADMIN, "admin:list")]
+    return ups + [callback_update(ADMIN, "list:next:") for _ in range(rnd.randrange(3, 8))]
+
+
+SCENARIOS = {
+    "menu": menu_session,
+    "track": track_session,
+    "calc": calc_session,
+    "admin_paging": admin_paging_session,
+}
+
+
+def next_page_tap(session) -> str:
+    """The list:next:<cursor> button of the most recently rendered list page."""
+    for _, payload in reversed(session.sent[-50:]):
+        for row in (payload.get("reply_markup") or {}).get("inline_keyboard", []):
+            for btn in row:
+                if str(btn.get("callback_data", "")).startswith("list:next:"):
+                    return btn["callback_data"]
+    return "admin:list"
+
+
+async def replay(bot, sessions: list[list[dict]], concurrency: int) -> tuple[float, list[float]]:
+    from aiogram.types import Update
+
+    latencies: list[float] = []
+    queue: asyncio.Queue = asyncio.Queue()
+    for s in sessions:
+        queue.put_nowait(s)
+
+    async def user():
+        while not queue.empty():
+            for u in queue.get_nowait():
+                if u.get("callback_query", {}).get("data") == "list:next:":
+                    u["callback_query"]["data"] = next_page_tap(bot.bot.session)
+                update = Update.model_validate(u, context={"bot": bot.bot})
+                t0 = time.perf_counter()
+                await bot.dp.feed_update(bot.bot, update)
+                latencies.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    return time.perf_counter() - t0, latencies
+
+
+async def main(args):
+    # The bot prints a span tree for every slow update; keep the report readable
+    os.environ.setdefault("SLOW_UPDATE_MS", "1e9")
+    # Virtual users tap far faster than people; measure the handlers, not the flood guard
+    os.environ.setdefault("THROTTLE_RATE", "0")
+    stub = PostgRESTStub(latency_ms=args.db_latency)
+    stub.seed("shipments", synthetic_shipments(SHIPMENTS))
+    stub.start(in_process=args.in_process)
+    bot = import_bot(stub.url)
+    bot.bot.session = make_fake_session(args.api_latency)
+    rnd = random.Random(args.seed)
+
+    if args.updates:
+        with open(args.updates, encoding="utf-8") as f:
+            runs = {"recorded": [[json.loads(line)] for line in f if line.strip()]}
+    else:
+        names = list(SCENARIOS) if args.scenario == "all" else [args.scenario]
+        runs = {
+            name: [SCENARIOS[name](1000 + i, rnd) for i in range(args.users * args.sessions)]
+            for name in names
+        }
+        if args.scenario == "all":
+            mixed = [s for v in runs.values() for s in v]
+            rnd.shuffle(mixed)
+            runs["mixed"] = mixed
+
+    print(f"users={args.users} sessions/user={args.sessions} db_rtt={args.db_latency}ms "
+          f"api_rtt={args.api_latency}ms stub={'in-process' if args.in_process else 'forked'}")
+    print(f"{'scenario':<13} {'updates':>8} {'upd/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'peak RSS MB':>12}")
+    for name, sessions in runs.items():
+        elapsed, lat = await replay(bot, sessions, args.users)
+        print(f"{name:<13} {len(lat):>8} {len(lat) / elapsed:>9.1f} "
+              f"{percentile(lat, 50) * 1000:>8.1f} {percentile(lat, 95) * 1000:>8.1f} "
+              f"{percentile(lat, 99) * 1000:>8.1f} {peak_rss_mb():>12.1f}")
+    if args.metrics:
+        print("\nslowest series (bot METRICS):\n" + bot.METRICS.summary(args.metrics))
+    stub.stop()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--scenario", choices=["all", *SCENARIOS], default="all")
+    ap.add_argument("--users", type=int, default=50, help="concurrent virtual users")
+    ap.add_argument("--sessions", type=int, default=4, help="sessions per user")
+    ap.add_argument("--db-latency", type=float, default=10.0, help="stub PostgREST RTT, ms")
+    ap.add_argument("--api-latency", type=float, default=30.0, help="fake Bot API RTT, ms")
+    ap.add_argument("--in-process", action="store_true", help="run the stub in this process (RSS includes it)")
+    ap.add_argument("--updates", help="JSONL file of recorded Update objects (each one its own session)")
+    ap.add_argument("--metrics", type=int, default=8, help="print the N slowest metric series (0 = off)")
+    ap.add_argument("--seed", type=int, default=1)
+    asyncio.run(main(ap.parse_args()))
@@ -0,0 +1,86 @@
+"""Microbenchmark: message_router dispatch cost vs. number of registered flows.
+
+The old router walked one `if` per (flow, step) over separate state dicts, so
+a user in the last flow paid for every check before it. Three columns:
+
+- router: the real message_router, i.e. state load from STATE_STORAGE (JSON
+  decode) plus the bot_flow_seconds histogram on top of the lookup;
+- table: the FLOW_HANDLERS lookup alone, state already in a dict, which is
+  what the if-chain column does too;
+- if-chain: the pre-FSM shape.
+
+Both table columns should stay flat as flows are added; the if-chain grows
+linearly, and with few flows it is cheaper than the full router.
+
+    python bench/bench_router.py
+"""
+import asyncio
+import time
+from types import SimpleNamespace
+
+from _stubs import import_bot
+
+ITER = 20000
+
+
+async def noop(message, st, lang):
+    pass
+
+
+async def measure(bot, n_flows: int) -> tuple[float, float, float]:
+    for i in range(n_flows):
+        bot.flow_step(f"bench{i}", "step")(noop)
+    uid = 10_000
+    await bot.set_state(uid, f"bench{n_flows - 1}", "step")
+    msg = SimpleNamespace(from_user=SimpleNamespace(id=uid), text="x")
+
+    t0 = time.perf_counter()
+    for _ in range(ITER):
+        await bot.message_router(msg, "ru")
+    router = (time.perf_counter() - t0) / ITER * 1e9
+
+    states = {uid: bot.UserState(f"bench{n_flows - 1}", "step")}
+
+    async def table_dispatch(message):
+        u = message.from_user.id
+        st = states.get(u)
+        handler = bot.FLOW_HANDLERS.get((st.flow, st.step))
+        if handler is None or (st.flow in bot.ADMIN_FLOWS and u not in bot.ADMIN_IDS):
+            return
+        return await handler(message, st, "ru")
+
+    t0 = time.perf_counter()
+    for _ in range(ITER):
+        await table_dispatch(msg)
+    table = (time.perf_counter() - t0) / ITER * 1e9
+
+    # Pre-FSM shape: one state dict per step, checked in order.
+    chain = [{} for _ in range(n_flows)]
+    chain[-1][uid] = "step"
+
+    async def if_chain(message):
+        u = message.from_user.id
+        for states in chain:
+            if states.get(u) == "step":
+                return await noop(message, None, "ru")
+
+    t0 = time.perf_counter()
+    for _ in range(ITER):
+        await if_chain(msg)
+    linear = (time.perf_counter() - t0) / ITER * 1e9
+    return router, table, linear
+
+
+async def main():
+    bot = import_bot("http://127.0.0.1:9")
+    base = dict(bot.FLOW_HANDLERS)
+    print(f"{'flows':>6} {'router ns/msg':>14} {'table ns/msg':>13} {'if-chain ns/msg':>16}")
+    for n in (10, 25, 50, 100, 1000):
+        bot.FLOW_HANDLERS.clear()
+        bot.FLOW_HANDLERS.update(base)
+        router, table, linear = await measure(bot, n)
+        print(f"{n:>6} {router:>14.0f} {table:>13.0f} {linear:>16.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
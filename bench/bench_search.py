@@ -0,0 +1,87 @@
+"""Admin fuzzy search: query latency on a large synthetic shipments table.
+
+Builds the bot's in-memory TrigramIndex (the SEARCH_BACKEND=local stand-in
+for the search_shipments RPC) and times typical admin queries against it and
+against a plain scan over the same texts, the analogue of Postgres without
+the trigram index.
+
+    python bench/bench_search.py                  # 1,000,000 rows
+    python bench/bench_search.py --rows 200000 --repeat 50
+
+For the database itself, load the same shape of data and compare
+`explain analyze select * from search_shipments('<q>', 11, 0)` with and
+without shipments_search_trgm_idx (migrations/008_shipments_search.sql).
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from _stubs import import_bot, peak_rss_mb, percentile
+
+WORDS = ["телефон", "кроссовки", "куртка", "часы", "ноутбук", "платье", "наушники", "сумка",
+         "игрушки", "косметика", "запчасти", "книги", "посуда", "планшет", "очки", "джинсы"]
+
+
+def synthetic_rows(n: int, rnd: random.Random) -> list[dict]:
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    rows = [
+        {
+            "id": i + 1,
+            "tracking_code": f"YA{i:09d}",
+            "phone": f"+99290{rnd.randrange(10_000_000):07d}",
+            "description": f"{rnd.choice(WORDS)} {rnd.choice(WORDS)}, Страна: {'Tajikistan' if i % 3 else 'Russia'}",
+            "status": "В пути",
+            "created_at": (start + timedelta(seconds=i)).isoformat(),
+        }
+        for i in range(n)
+    ]
+    rows.reverse()  # newest first, as the index expects
+    return rows
+
+
+def queries(rows: list[dict], rnd: random.Random) -> dict[str, list[str]]:
+    sample = rnd.sample(rows, 20)
+    return {
+        "exact code": [r["tracking_code"] for r in sample],
+        "code part": [r["tracking_code"][-6:] for r in sample],
+        "phone tail": [r["phone"][-5:] for r in sample],
+        "word": [rnd.choice(WORDS) for _ in sample],
+        "typo": [r["tracking_code"][:7] + "x" + r["tracking_code"][8:] for r in sample],
+    }
+
+
+def main(args):
+    bot = import_bot("http://127.0.0.1:9")
+    rnd = random.Random(args.seed)
+    rows = synthetic_rows(args.rows, rnd)
+
+    t0 = time.perf_counter()
+    idx = bot.TrigramIndex(rows)
+    build = time.perf_counter() - t0
+    print(f"rows={len(idx)} trigrams={len(idx.postings)} build={build:.1f}s peak RSS={peak_rss_mb():.0f} MB")
+
+    print(f"{'query':<11} {'hits/page':>9} {'index p50 ms':>13} {'index p95 ms':>13} {'scan p50 ms':>12}")
+    for label, qs in queries(rows, rnd).items():
+        lat, hits = [], 0
+        for _ in range(args.repeat):
+            for q in qs:
+                t0 = time.perf_counter()
+                hits += len(idx.search(q, bot.SEARCH_PAGE_SIZE + 1))
+                lat.append(time.perf_counter() - t0)
+        scan = []
+        for q in qs[:3]:
+            ql = q.lower()
+            t0 = time.perf_counter()
+            [i for i, text in enumerate(idx.texts) if ql in text]
+            scan.append(time.perf_counter() - t0)
+        print(f"{label:<11} {hits / len(lat):>9.1f} {percentile(lat, 50) * 1000:>13.2f} "
+              f"{percentile(lat, 95) * 1000:>13.2f} {percentile(scan, 50) * 1000:>12.1f}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=1_000_000)
+    ap.add_argument("--repeat", type=int, default=5, help="passes over each query set")
+    ap.add_argument("--seed", type=int, default=1)
+    main(ap.parse_args())
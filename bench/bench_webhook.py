@@ -0,0 +1,156 @@
+"""Replay recorded updates through long polling and through the webhook app.
+
+Both modes run the real dispatcher against a fake Bot API (with an RTT per
+call, getUpdates included) and the PostgREST stub. Latency is measured from
+the moment an update "arrives at Telegram" to the end of its handler.
+
+    python bench/bench_webhook.py --users 50 --rate 200 --api-latency 40
+    python bench/bench_webhook.py --updates recorded.jsonl   # one Update JSON per line
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import aiohttp
+
+from _stubs import (PostgRESTStub, callback_update, import_bot, make_fake_session,
+                    message_update, percentile, synthetic_shipments)
+
+SECRET = "bench-secret"
+
+
+def synthetic_recording(users: int) -> list[dict]:
+    ups = []
+    for u in range(100, 100 + users):
+        ups += [
+            callback_update(u, "menu:track"),
+            callback_update(u, "track:by_code"),
+            message_update(u, f"YA{u % 1000:09d}"),
+            callback_update(u, "menu:calc"),
+            callback_update(u, "calc:unit:cm"),
+            message_update(u, "120"),
+            message_update(u, "80"),
+            message_update(u, "60"),
+        ]
+    return ups
+
+
+class Recorder:
+    def __init__(self, expected: int):
+        self.arrived: dict[int, float] = {}
+        self.latencies: list[float] = []
+        self.expected = expected
+        self.done = asyncio.Event()
+
+    async def __call__(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            t0 = self.arrived.pop(event.update_id, None)
+            if t0 is not None:
+                self.latencies.append(time.perf_counter() - t0)
+            if len(self.latencies) >= self.expected:
+                self.done.set()
+
+    def report(self, label: str, elapsed: float):
+        n = len(self.latencies)
+        print(
+            f"{label:<8} updates={n:<6} {n / elapsed:8.1f} upd/s  "
+            f"p50={percentile(self.latencies, 50) * 1000:7.1f}ms  "
+            f"p99={percentile(self.latencies, 99) * 1000:7.1f}ms"
+        )
+
+
+async def paced(updates: list[dict], rate: float, inject):
+    t0 = time.perf_counter()
+    for i, u in enumerate(updates):
+        delay = t0 + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await inject(u)
+
+
+async def run_polling(bot, updates, rate, recorder):
+    session = bot.bot.session
+    task = asyncio.create_task(bot.dp.start_polling(bot.bot, handle_signals=False, close_bot_session=False))
+
+    async def inject(u):
+        recorder.arrived[u["update_id"]] = time.perf_counter()
+        session.updates.put_nowait(u)
+
+    t0 = time.perf_counter()
+    await paced(updates, rate, inject)
+    await recorder.done.wait()
+    elapsed = time.perf_counter() - t0
+    await bot.dp.stop_polling()
+    task.cancel()
+    return elapsed
+
+
+async def run_webhook(bot, updates, rate, recorder, port: int):
+    runner = aiohttp.web.AppRunner(bot.build_webhook_app(), handle_signals=False)
+    await runner.setup()
+    await aiohttp.web.TCPSite(runner, "127.0.0.1", port).start()
+    url = f"http://127.0.0.1:{port}{bot.WEBHOOK_PATH}"
+    async with aiohttp.ClientSession() as http:
+        posts = []
+
+        async def inject(u):
+            recorder.arrived[u["update_id"]] = time.perf_counter()
+            posts.append(asyncio.create_task(
+                http.post(url, json=u, headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+            ))
+
+        t0 = time.perf_counter()
+        await paced(updates, rate, inject)
+        await recorder.done.wait()
+        elapsed = time.perf_counter() - t0
+        for r in await asyncio.gather(*posts):
+            r.release()
+    # The app's shutdown hook closes the bot session; keep the fake one alive.
+    bot.bot.session.close = lambda: asyncio.sleep(0)
+    await runner.cleanup()
+    return elapsed
+
+
+async def main(args):
+    stub = PostgRESTStub(latency_ms=args.db_latency)
+    stub.seed("shipments", synthetic_shipments(1000))
+    stub.start()
+    os.environ["WEBHOOK_SECRET"] = SECRET
+    os.environ.setdefault("THROTTLE_RATE", "0")  # each synthetic user sends 8 updates back to back
+    bot = import_bot(stub.url)
+    bot.bot.session = make_fake_session(args.api_latency)
+
+    if args.updates:
+        with open(args.updates, encoding="utf-8") as f:
+            recording = [json.loads(line) for line in f if line.strip()]
+    else:
+        recording = synthetic_recording(args.users)
+
+    print(f"updates={len(recording)} rate={args.rate}/s api_rtt={args.api_latency}ms db_rtt={args.db_latency}ms")
+    for label in ("polling", "webhook"):
+        rec = Recorder(len(recording))
+        mw = bot.dp.update.outer_middleware(rec)
+        # Fresh update ids per run so arrivals are not confused between modes
+        updates = [dict(u, update_id=u["update_id"] + (0 if label == "polling" else 10_000_000)) for u in recording]
+        if label == "polling":
+            elapsed = await run_polling(bot, updates, args.rate, rec)
+        else:
+            elapsed = await run_webhook(bot, updates, args.rate, rec, args.port)
+        rec.report(label, elapsed)
+        bot.dp.update.outer_middleware._middlewares.remove(mw)
+    stub.stop()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=50)
+    ap.add_argument("--rate", type=float, default=200.0, help="updates per second offered")
+    ap.add_argument("--api-latency", type=float, default=40.0, help="fake Bot API RTT, ms")
+    ap.add_argument("--db-latency", type=float, default=10.0, help="stub PostgREST RTT, ms")
+    ap.add_argument("--port", type=int, default=18080)
+    ap.add_argument("--updates", help="JSONL file of recorded Update objects")
+    asyncio.run(main(ap.parse_args()))
@@ -1,13 +1,40 @@
 # === Part 1: imports, env, clients, i18n, base state ===
 import os
 import re
+import io
+import html
+import csv
+import json
+import sqlite3
+import tempfile
+import signal
+import threading
 import math
+import random
+import secrets
+import time
+import itertools
+import string
+import functools
+import bisect
+import heapq
 import asyncio
-from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+import multiprocessing
+import queue
+from abc import ABC, abstractmethod
+from array import array
+from collections import OrderedDict, deque
+from types import MappingProxyType
+from datetime import date, datetime, timedelta, timezone
+from contextvars import ContextVar
+from aiogram import Bot, Dispatcher, F, BaseMiddleware
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, Update, InputFile
 from aiogram.filters import CommandStart, Command
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from dotenv import load_dotenv
-from supabase import create_client
+from supabase import acreate_client, AClient
 
 load_dotenv()
 
@@ -31,9 +58,19 @@ ADMIN_IDS = set(
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
-# Single Supabase client with service role key for ALL operations
-supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
-supabase_admin = supabase  # alias for clarity if needed
+# Single async Supabase client (service role key) for ALL operations, used by
+# the repositories in Part 3 so a slow PostgREST round trip never blocks the
+# event loop. Created lazily (needs a loop).
+_ASYNC_DB: AClient | None = None
+_ASYNC_DB_LOCK = asyncio.Lock()
+
+async def adb() -> AClient:
+    global _ASYNC_DB
+    if _ASYNC_DB is None:
+        async with _ASYNC_DB_LOCK:
+            if _ASYNC_DB is None:
+                _ASYNC_DB = await acreate_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+    return _ASYNC_DB
 
 # ===== i18n (translations) =====
 LANG = {
@@ -61,7 +98,9 @@ LANG = {
         "track_enter_code": "Введите *трек-код* (например, YA123456789):",
         "track_enter_phone": "Введите *номер телефона* (например, +992XXXXXXXXX):",
         "search_none": "Ничего не найдено. Проверьте данные и попробуйте снова.",
+        "throttled": "⏳ Слишком много запросов. Подождите несколько секунд.",
         "search_again": "Ещё поиск? Выберите способ:",
+        "status_changed": "📦 Отправление {code}: новый статус — {status}",
 
         # Office address + about
         "about_text": (
@@ -175,7 +214,9 @@ LANG = {
         "track_enter_code": "Enter *tracking code* (e.g., YA123456789):",
         "track_enter_phone": "Enter *phone number* (e.g., +1XXXXXXXXXX):",
         "search_none": "No results. Please check and try again.",
+        "throttled": "⏳ Too many requests. Please wait a few seconds.",
         "search_again": "Search again? Choose a method:",
+        "status_changed": "📦 Shipment {code}: new status — {status}",
 
         "about_text": (
             "🌏 **About Yasroikard Logistic**\n\n"
@@ -284,7 +325,9 @@ LANG = {
         "track_enter_code": "Рамзи *трек*-ро ворид кунед:",
         "track_enter_phone": "Рақами *телефон*-ро ворид кунед:",
         "search_none": "Ёфт нашуд. Санҷед ва боз кӯшиш кунед.",
+        "throttled": "⏳ Дархостҳо аз ҳад зиёданд. Якчанд сония интизор шавед.",
         "search_again": "Боз ҷустуҷӯ мекунед? Усулро интихоб кунед:",
+        "status_changed": "📦 Бор {code}: ҳолати нав — {status}",
 
         "about_text": (
             "🌏 **Дар бораи Yasroikard Logistic**\n\n"
@@ -373,57 +416,683 @@ LANG = {
 }
 LANG_NAMES = {"ru": "Русский", "en": "English", "tj": "Тоҷикӣ"}
 
-USER_LANG_CACHE: dict[int, str] = {}
-def get_lang(user_id: int) -> str:
-    lang = USER_LANG_CACHE.get(user_id)
+# ===== Text catalog =====
+def _format_fields(text: str) -> set[str]:
+    return {f for _, f, _, _ in string.Formatter().parse(text) if f}
+
+def build_text_catalog(lang: dict) -> MappingProxyType:
+    """Validate LANG and freeze it into read-only per-language maps.
+
+    Every language must have the same keys with the same {placeholders};
+    static screens that are assembled from several keys are rendered here once.
+    """
+    base = lang["ru"]
+    problems = []
+    for code, texts in lang.items():
+        for key in sorted(base.keys() - texts.keys()):
+            problems.append(f"{code}: missing {key!r}")
+        for key in sorted(texts.keys() - base.keys()):
+            problems.append(f"{code}: {key!r} is not in ru")
+        for key in sorted(base.keys() & texts.keys()):
+            if _format_fields(texts[key]) != _format_fields(base[key]):
+                problems.append(f"{code}: placeholders of {key!r} differ from ru")
+    if problems:
+        raise RuntimeError("LANG is inconsistent:\n" + "\n".join(problems))
+    catalog = {}
+    for code, texts in lang.items():
+        merged = dict(texts)
+        merged["warehouse_text"] = texts["warehouse_text_multi"].format(
+            title=texts["warehouse_title_multi"],
+            tj_label=texts["warehouse_tj_label"],
+            ru_label=texts["warehouse_ru_label"],
+            tj_addr=texts["warehouse_tj_address"],
+            ru_addr=texts["warehouse_ru_address"],
+        )
+        catalog[code] = MappingProxyType(merged)
+    return MappingProxyType(catalog)
+
+TEXTS = build_text_catalog(LANG)
+
+# ===== Small in-process caches =====
+class TTLCache:
+    """Size-bounded LRU map whose entries also expire after a TTL."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        if item[0] < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return item[1]
+
+    def set(self, key, value, ttl: float | None = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def prune(self) -> int:
+        """Drop expired entries now instead of on their next lookup."""
+        now = time.monotonic()
+        dead = [k for k, (exp, _) in self._data.items() if exp < now]
+        for k in dead:
+            del self._data[k]
+        return len(dead)
+
+    def __len__(self):
+        return len(self._data)
+
+# ===== Metrics & tracing =====
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # polling mode: serve /metrics on this port (0 = off)
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "0"))  # print a summary every N s (0 = off)
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "1000"))  # print the span tree of slower updates
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Latency series; also carries the in-flight gauge and error counter of its labels."""
+    __slots__ = ("counts", "sum", "count", "in_flight", "errors")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.in_flight = 0
+        self.errors = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th observation."""
+        rank, seen = q * self.count, 0
+        for bound, n in zip(LATENCY_BUCKETS + (math.inf,), self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return math.inf
+
+class Metrics:
+    """In-process registry rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.histograms: dict[str, dict[tuple, Histogram]] = {}
+        self.gauge_fns: dict[str, callable] = {}  # name -> () -> value, read at render time
+
+    def histogram(self, name: str, labels: tuple = ()) -> Histogram:
+        series = self.histograms.setdefault(name, {})
+        h = series.get(labels)
+        if h is None:
+            h = series[labels] = Histogram()
+        return h
+
+    def observe(self, name: str, seconds: float, labels: tuple = ()):
+        self.histogram(name, labels).observe(seconds)
+
+    @staticmethod
+    def _labels(labels: tuple, extra: tuple = ()) -> str:
+        pairs = labels + extra
+        if not pairs:
+            return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"')
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+    def render(self) -> str:
+        out = []
+        for name, series in sorted(self.histograms.items()):
+            out.append(f"# TYPE {name} histogram")
+            for labels, h in series.items():
+                cum = 0
+                for bound, n in zip(LATENCY_BUCKETS + (math.inf,), h.counts):
+                    cum += n
+                    le = "+Inf" if bound == math.inf else repr(bound)
+                    out.append(f"{name}_bucket{self._labels(labels, (('le', le),))} {cum}")
+                out.append(f"{name}_sum{self._labels(labels)} {h.sum:.6f}")
+                out.append(f"{name}_count{self._labels(labels)} {h.count}")
+            base = name.removesuffix("_seconds")
+            out.append(f"# TYPE {base}_in_flight gauge")
+            out += [f"{base}_in_flight{self._labels(labels)} {h.in_flight}" for labels, h in series.items()]
+            out.append(f"# TYPE {base}_errors_total counter")
+            out += [f"{base}_errors_total{self._labels(labels)} {h.errors}" for labels, h in series.items()]
+        for name, fn in sorted(self.gauge_fns.items()):
+            try:
+                out += [f"# TYPE {name} gauge", f"{name} {fn():g}"]
+            except Exception as e:
+                print(f"metric {name} error:", e)
+        return "\n".join(out) + "\n"
+
+    def summary(self, top: int = 10) -> str:
+        """Slowest series by total time, for the periodic log dump."""
+        rows = [
+            (h.sum, name, labels, h) for name, series in self.histograms.items()
+            for labels, h in series.items() if h.count
+        ]
+        rows.sort(key=lambda r: r[0], reverse=True)
+        lines = []
+        for total, name, labels, h in rows[:top]:
+            tag = ",".join(str(v) for _, v in labels) or "-"
+            lines.append(
+                f"{name}[{tag}] n={h.count} err={h.errors} total={total:.2f}s "
+                f"avg={total / h.count * 1000:.1f}ms p95<={h.quantile(0.95) * 1000:g}ms"
+            )
+        return "\n".join(lines)
+
+METRICS = Metrics()
+# Per update: {"id", "start", "handler", "spans": [(start_offset_s, depth, name, seconds, ok)]}
+TRACE: ContextVar[dict | None] = ContextVar("TRACE", default=None)
+_SPAN_DEPTH: ContextVar[int] = ContextVar("_SPAN_DEPTH", default=0)
+
+def trace_id() -> str:
+    trace = TRACE.get()
+    return trace["id"] if trace else "-"
+
+async def measured(h: Histogram, span: str, fn, *args, **kwargs):
+    """Run fn, recording latency, errors and in-flight count in `h` plus a trace span."""
+    trace = TRACE.get()
+    if trace is not None:
+        depth = _SPAN_DEPTH.get()
+        token = _SPAN_DEPTH.set(depth + 1)
+    h.in_flight += 1
+    t0 = time.perf_counter()
+    ok = False
+    try:
+        result = await fn(*args, **kwargs)
+        ok = True
+        return result
+    finally:
+        elapsed = time.perf_counter() - t0
+        h.in_flight -= 1
+        h.observe(elapsed)
+        if not ok:
+            h.errors += 1
+        if trace is not None:
+            _SPAN_DEPTH.reset(token)
+            trace["spans"].append((t0 - trace["start"], depth, span, elapsed, ok))
+
+def timed(fn):
+    """Time a helper as a `bot_step_seconds{step=...}` series and a trace span."""
+    h = METRICS.histogram("bot_step_seconds", (("step", fn.__name__),))
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await measured(h, fn.__name__, fn, *args, **kwargs)
+    return wrapper
+
+def format_trace(trace: dict, total: float) -> str:
+    lines = [f"[trace {trace['id']}] slow update: {trace.get('handler') or '-'} {total * 1000:.0f}ms"]
+    for _, depth, name, seconds, ok in sorted(trace["spans"]):
+        lines.append(f"  {'  ' * depth}{name} {seconds * 1000:.1f}ms{'' if ok else ' (error)'}")
+    return "\n".join(lines)
+
+class TraceMiddleware(BaseMiddleware):
+    """Outer update middleware: trace id, whole-update latency, slow-update log."""
+
+    async def __call__(self, handler, event, data):
+        trace = {"id": f"{event.update_id:x}-{os.urandom(3).hex()}", "start": time.perf_counter(),
+                 "handler": None, "spans": []}
+        token = TRACE.set(trace)
+        try:
+            return await handler(event, data)
+        finally:
+            TRACE.reset(token)
+            total = time.perf_counter() - trace["start"]
+            METRICS.observe("bot_update_seconds", total)
+            if total * 1000 >= SLOW_UPDATE_MS:
+                print(format_trace(trace, total))
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner middleware: runs once the handler is chosen, so it is labelled by name."""
+
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        trace = TRACE.get()
+        if trace is not None:
+            trace["handler"] = name
+        try:
+            return await measured(METRICS.histogram("bot_handler_seconds", (("handler", name),)), name, handler, event, data)
+        except Exception as e:
+            print(f"[trace {trace_id()}] {name} failed: {e!r}")
+            raise
+
+dp.update.outer_middleware(TraceMiddleware())
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+
+async def metrics_endpoint(_request: web.Request) -> web.Response:
+    return web.Response(text=METRICS.render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+# ===== Flood control =====
+# Runs before the language lookup and any handler, so a burst from one user
+# costs a dict lookup per update instead of DB queries and API calls.
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "1"))  # sustained updates/s per user (0 = off)
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "6"))
+THROTTLE_NOTICE_INTERVAL = float(os.getenv("THROTTLE_NOTICE_INTERVAL", "10"))  # at most one "slow down" per user
+THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS", "100000"))
+THROTTLE_STATS = {"dropped": 0, "coalesced": 0}
+
+class UserThrottle:
+    """Per-user token buckets. `allow` never waits: an update either fits or is rejected."""
+
+    def __init__(self, rate: float, burst: float, max_users: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        # user_id -> [tokens, updated]; the least recently seen user is forgotten first,
+        # which is harmless: an idle user's bucket would be full anyway
+        self.buckets: OrderedDict[int, list[float]] = OrderedDict()
+
+    def allow(self, user_id: int) -> bool:
+        now = time.monotonic()
+        b = self.buckets.get(user_id)
+        if b is None:
+            if len(self.buckets) >= self.max_users:
+                self.buckets.popitem(last=False)
+            self.buckets[user_id] = [self.burst - 1, now]
+            return True
+        self.buckets.move_to_end(user_id)
+        b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate)
+        b[1] = now
+        if b[0] >= 1:
+            b[0] -= 1
+            return True
+        return False
+
+class ThrottleMiddleware(BaseMiddleware):
+    """Drops updates over the user's rate and repeats of one still being handled.
+
+    A repeat is the same user sending the same text or tapping the same button
+    while the first one is in flight; the first answer covers both. Admins are
+    never throttled.
+    """
+
+    def __init__(self):
+        self.throttle = UserThrottle(THROTTLE_RATE, THROTTLE_BURST, THROTTLE_MAX_USERS)
+        self.in_flight: set[tuple] = set()
+        self.noticed = TTLCache(THROTTLE_MAX_USERS, THROTTLE_NOTICE_INTERVAL)
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or THROTTLE_RATE <= 0 or user.id in ADMIN_IDS:
+            return await handler(event, data)
+        is_cb = isinstance(event, CallbackQuery)
+        payload = event.data if is_cb else event.text
+        key = (user.id, is_cb, payload) if payload else None
+        if key in self.in_flight:
+            THROTTLE_STATS["coalesced"] += 1
+            if is_cb:
+                await event.answer()  # stop the button spinner
+            return
+        if not self.throttle.allow(user.id):
+            THROTTLE_STATS["dropped"] += 1
+            await self.reject(event, user.id, is_cb)
+            return
+        if key is None:
+            return await handler(event, data)
+        self.in_flight.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight.discard(key)
+
+    async def reject(self, event, user_id: int, is_cb: bool):
+        notice = None
+        if self.noticed.get(user_id) is None:
+            self.noticed.set(user_id, True)
+            notice = t(user_id, "throttled")  # cached or default language; no lookup for a rejected update
+        try:
+            if is_cb or notice:  # a callback is always answered so its button stops spinning
+                await event.answer(notice)
+        except Exception as e:
+            print("throttle notice error:", e)
+
+# Registered before LangMiddleware so rejected updates never reach the language lookup
+THROTTLE_MIDDLEWARE = ThrottleMiddleware()
+dp.message.outer_middleware(THROTTLE_MIDDLEWARE)
+dp.callback_query.outer_middleware(THROTTLE_MIDDLEWARE)
+METRICS.gauge_fns["bot_throttle_dropped"] = lambda: THROTTLE_STATS["dropped"]
+METRICS.gauge_fns["bot_throttle_coalesced"] = lambda: THROTTLE_STATS["coalesced"]
+
+# ===== User language preferences =====
+DEFAULT_LANG = "ru"
+LANG_CACHE_SIZE = int(os.getenv("LANG_CACHE_SIZE", "50000"))
+LANG_CACHE_TTL = float(os.getenv("LANG_CACHE_TTL", "3600"))
+LANG_NEGATIVE_TTL = float(os.getenv("LANG_NEGATIVE_TTL", "300"))  # unknown users / lookup errors
+
+USER_LANG_CACHE = TTLCache(LANG_CACHE_SIZE, LANG_CACHE_TTL)
+_LANG_INFLIGHT: dict[int, asyncio.Future] = {}
+# (user_id, lang) of the update being handled; set once by LangMiddleware
+CURRENT_LANG: ContextVar[tuple[int, str] | None] = ContextVar("CURRENT_LANG", default=None)
+# callables (user_ids) run once new languages are in the DB, e.g. to tell other workers
+LANG_INVALIDATION_HOOKS: list = []
+
+async def resolve_lang(user_id: int) -> str:
+    """Cached language lookup; concurrent misses for one user share one DB query."""
+    lang = USER_LANG_CACHE.get(user_id) or user_writes.pending_language(user_id)
     if lang:
         return lang
+    pending = _LANG_INFLIGHT.get(user_id)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    fut = asyncio.get_running_loop().create_future()
+    _LANG_INFLIGHT[user_id] = fut
+    lang = None
     try:
-        r = supabase.table("users").select("language").eq("id", user_id).limit(1).execute()
-        lang = (r.data or [{}])[0].get("language") or "ru"
-    except Exception:
-        lang = "ru"
-    # Safety: normalize bad legacy values
-    if lang not in LANG:
-        lang = "ru"
-    USER_LANG_CACHE[user_id] = lang
+        lang = await users_repo.get_language(user_id)
+    except Exception as e:
+        print("get_lang error:", e)
+    finally:
+        _LANG_INFLIGHT.pop(user_id, None)
+        ttl = None
+        # Unknown user, lookup error or bad legacy value: cache the default briefly
+        if lang not in LANG:
+            lang, ttl = DEFAULT_LANG, LANG_NEGATIVE_TTL
+        USER_LANG_CACHE.set(user_id, lang, ttl)
+        fut.set_result(lang)
     return lang
 
-def set_lang(user_id: int, lang: str):
-    USER_LANG_CACHE[user_id] = lang
-    try:
-        supabase.table("users").update({"language": lang}).eq("id", user_id).execute()
-    except Exception as e:
-        print("set_lang error:", e)
+async def resolve_langs(user_ids: list[int]) -> dict[int, str]:
+    """resolve_lang for many users: cache misses are fetched 200 per query."""
+    out, missing = {}, []
+    for uid in user_ids:
+        lang = USER_LANG_CACHE.get(uid) or user_writes.pending_language(uid)
+        if lang:
+            out[uid] = lang
+        else:
+            missing.append(uid)
+    for i in range(0, len(missing), 200):
+        chunk = missing[i:i + 200]
+        try:
+            found = await users_repo.get_languages(chunk)
+        except Exception as e:
+            print("get_langs error:", e)
+            found = {}
+        for uid in chunk:
+            lang, ttl = found.get(uid), None
+            if lang not in LANG:
+                lang, ttl = DEFAULT_LANG, LANG_NEGATIVE_TTL
+            USER_LANG_CACHE.set(uid, lang, ttl)
+            out[uid] = lang
+    return out
+
+def get_lang(user_id: int) -> str:
+    """Non-blocking: the middleware has already resolved the current user."""
+    cur = CURRENT_LANG.get()
+    if cur and cur[0] == user_id:
+        return cur[1]
+    return USER_LANG_CACHE.get(user_id) or DEFAULT_LANG
+
+def invalidate_lang(user_ids: list[int]):
+    """Drop cached languages, e.g. when another worker reports a change."""
+    for uid in user_ids:
+        USER_LANG_CACHE.pop(uid)
+
+def run_lang_hooks(user_ids: list[int]):
+    for hook in LANG_INVALIDATION_HOOKS:
+        try:
+            hook(user_ids)
+        except Exception as e:
+            print("lang invalidation hook error:", e)
+
+async def set_lang(user_id: int, lang: str):
+    USER_LANG_CACHE.set(user_id, lang)
+    cur = CURRENT_LANG.get()
+    if cur and cur[0] == user_id:
+        CURRENT_LANG.set((user_id, lang))
+    # Written by the user write-behind buffer, which runs the hooks once it is in the DB
+    user_writes.set_language(user_id, lang)
 
 def t(user_id: int, key: str, **kwargs) -> str:
-    lang = get_lang(user_id)
-    base = LANG.get(lang, LANG["ru"])
-    txt = base.get(key, LANG["ru"].get(key, key))
-    if kwargs:
-        txt = txt.format(**kwargs)
-    return txt
+    txt = (TEXTS.get(get_lang(user_id)) or TEXTS[DEFAULT_LANG]).get(key, key)
+    return txt.format(**kwargs) if kwargs else txt
+
+class LangMiddleware(BaseMiddleware):
+    """Resolves the sender's language once per update and injects it as `lang`."""
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        lang = await resolve_lang(user.id)
+        data["lang"] = lang
+        token = CURRENT_LANG.set((user.id, lang))
+        try:
+            return await handler(event, data)
+        finally:
+            CURRENT_LANG.reset(token)
+
+dp.message.outer_middleware(LangMiddleware())
+dp.callback_query.outer_middleware(LangMiddleware())
 
 # Base states
-ADMIN_FLOW_STATE: dict[int, str | None] = {}
-ADMIN_NEW_SHIPMENT: dict[int, dict] = {}
-USER_TRACK_STATE: dict[int, bool] = {}
-USER_TRACK_MODE: dict[int, str] = {}
-ADMIN_STATUS_STATE: dict[int, str | None] = {}
-ADMIN_STATUS_TARGET: dict[int, str] = {}
-USER_REQ_STATE: dict[int, str | None] = {}
-USER_REQ_DATA: dict[int, dict] = {}
-ADMIN_REQ_CONTEXT: dict[int, int | None] = {}
+# Conversation state: at most one active flow per user, e.g.
+#   admin_add: tracking -> phone -> description      status: tracking -> choose
+#   request: track -> phone_code[_custom] -> phone_local -> country[_custom]
+#   calc: unit -> h -> w -> l    benefit: whatsapp -> ordered -> paid -> real_cost -> user_paid
+#   track: query    admin_search: query
+class UserState:
+    __slots__ = ("flow", "step", "data")
+
+    def __init__(self, flow: str, step: str, data: dict | None = None):
+        self.flow = flow
+        self.step = step
+        self.data = data if data is not None else {}
+
+# ---- Pluggable storage for UserState (survives restarts, shared by workers) ----
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")  # memory | sqlite:///path.db | redis://host:6379/0
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", "86400"))  # abandoned flows expire after this
+
+class StateStorage(ABC):
+    """Key -> serialized state with per-key expiry."""
+
+    @abstractmethod
+    async def get(self, key: int) -> str | None: ...
+
+    @abstractmethod
+    async def set(self, key: int, value: str, ttl: float): ...
+
+    @abstractmethod
+    async def delete(self, key: int): ...
+
+    async def prune(self) -> int:
+        """Drop expired keys; returns how many were removed."""
+        return 0
+
+    async def close(self):
+        pass
+
+
+class MemoryStateStorage(StateStorage):
+    PRUNE_EVERY = 1024  # writes between opportunistic sweeps
+
+    def __init__(self):
+        self._data: dict[int, tuple[float, str]] = {}
+        self._writes = 0
+
+    async def get(self, key: int) -> str | None:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[0] < time.time():
+            del self._data[key]
+            return None
+        return item[1]
+
+    async def set(self, key: int, value: str, ttl: float):
+        self._data[key] = (time.time() + ttl, value)
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            await self.prune()
+
+    async def delete(self, key: int):
+        self._data.pop(key, None)
+
+    async def prune(self) -> int:
+        now = time.time()
+        dead = [k for k, (exp, _) in self._data.items() if exp < now]
+        for k in dead:
+            del self._data[k]
+        return len(dead)
+
+
+class SQLiteStateStorage(StateStorage):
+    """Single-file store; queries run in a worker thread so the loop never blocks."""
+
+    def __init__(self, path: str, table: str = "fsm_state"):
+        self._lock = threading.Lock()
+        self._table = table
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (key INTEGER PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def _run(self, sql: str, args: tuple = ()):
+        with self._lock:
+            cur = self._conn.execute(sql, args)
+            return cur.fetchone(), cur.rowcount
+
+    async def get(self, key: int) -> str | None:
+        row, _ = await asyncio.to_thread(
+            self._run, f"SELECT value FROM {self._table} WHERE key = ? AND expires_at > ?", (key, time.time())
+        )
+        return row[0] if row else None
+
+    async def set(self, key: int, value: str, ttl: float):
+        await asyncio.to_thread(
+            self._run, f"INSERT OR REPLACE INTO {self._table} (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, time.time() + ttl),
+        )
+
+    async def delete(self, key: int):
+        await asyncio.to_thread(self._run, f"DELETE FROM {self._table} WHERE key = ?", (key,))
+
+    async def prune(self) -> int:
+        _, n = await asyncio.to_thread(self._run, f"DELETE FROM {self._table} WHERE expires_at <= ?", (time.time(),))
+        return n
+
+    async def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisStateStorage(StateStorage):
+    """Redis (or any server speaking GET/SET EX/DEL, e.g. fakeredis); expiry is native."""
+
+    def __init__(self, url: str, prefix: str = "fsm:"):
+        try:
+            from redis import asyncio as aioredis
+        except ImportError:
+            raise RuntimeError("FSM_STORAGE=redis://... needs the 'redis' package (pip install redis)")
+        self._r = aioredis.from_url(url, decode_responses=True)
+        self._prefix = prefix
+
+    async def get(self, key: int) -> str | None:
+        return await self._r.get(f"{self._prefix}{key}")
+
+    async def set(self, key: int, value: str, ttl: float):
+        await self._r.set(f"{self._prefix}{key}", value, ex=max(1, int(ttl)))
+
+    async def delete(self, key: int):
+        await self._r.delete(f"{self._prefix}{key}")
+
+    async def close(self):
+        await self._r.aclose()
+
+
+def make_state_storage(url: str, namespace: str = "fsm") -> StateStorage:
+    """Separate namespaces on one backend never see each other's keys."""
+    if url.startswith("sqlite:///"):
+        return SQLiteStateStorage(url[len("sqlite:///"):], f"{namespace}_state")
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStateStorage(url, f"{namespace}:")
+    if url != "memory":
+        raise RuntimeError(f"Unknown FSM_STORAGE: {url}")
+    return MemoryStateStorage()
+
+STATE_STORAGE: StateStorage = make_state_storage(FSM_STORAGE)
+
+def _dump_state(st: UserState) -> str:
+    return json.dumps([st.flow, st.step, st.data], ensure_ascii=False, separators=(",", ":"))
+
+async def get_state(user_id: int) -> UserState | None:
+    raw = await STATE_STORAGE.get(user_id)
+    if raw is None:
+        return None
+    flow, step, data = json.loads(raw)
+    return UserState(flow, step, data)
+
+async def set_state(user_id: int, flow: str, step: str, data: dict | None = None) -> UserState:
+    """Enter (flow, step); starting a flow drops whatever the user was doing before."""
+    st = UserState(flow, step, data)
+    await STATE_STORAGE.set(user_id, _dump_state(st), FSM_STATE_TTL)
+    return st
+
+async def clear_state(user_id: int):
+    await STATE_STORAGE.delete(user_id)
+
+async def in_step(user_id: int, flow: str, step: str) -> UserState | None:
+    st = await get_state(user_id)
+    return st if st and st.flow == flow and st.step == step else None
+
+# ---- Per-admin panel context (same backend as UserState, own namespace) ----
+# Keys: "list"/"ben" - keyset cursors of the visited list pages ([None] = page 1),
+# "search" - last fuzzy-search query, "req" - request under review.
+# Kept apart from UserState so starting a flow doesn't reset the admin's paging.
+ADMIN_CTX_TTL = float(os.getenv("ADMIN_CTX_TTL", "3600"))
+ADMIN_CONTEXT: StateStorage = make_state_storage(FSM_STORAGE, "admin")
+
+async def get_admin_ctx(admin_id: int) -> dict:
+    raw = await ADMIN_CONTEXT.get(admin_id)
+    return json.loads(raw) if raw else {}
+
+async def update_admin_ctx(admin_id: int, **values):
+    """Merge values into the admin's context; None drops the key."""
+    ctx = await get_admin_ctx(admin_id)
+    for k, v in values.items():
+        if v is None:
+            ctx.pop(k, None)
+        else:
+            ctx[k] = v
+    await ADMIN_CONTEXT.set(admin_id, json.dumps(ctx, ensure_ascii=False, separators=(",", ":")), ADMIN_CTX_TTL)
+
 PAGE_SIZE = 10
-ADMIN_LIST_PAGE: dict[int, int] = {}
-CALC_STATE: dict[int, str | None] = {}
-CALC_DATA: dict[int, dict] = {}
-# Benefit flow (admin)
-BEN_STATE: dict[int, str | None] = {}   # "whatsapp"|"ordered"|"paid"|"real_cost"|"user_paid"|None
-BEN_DATA: dict[int, dict] = {}          # temp: {"whatsapp": str, "ordered": bool, "paid": bool, "real_cost": float, "user_paid": float}
+LIST_COUNT_TTL = float(os.getenv("LIST_COUNT_TTL", "120"))
+LIST_COUNT_CACHE = TTLCache(4, LIST_COUNT_TTL)
 # Benefits list paging
 BEN_PAGE_SIZE = 10
-ADMIN_BEN_PAGE: dict[int, int] = {}  # admin_user_id -> current page (1-based)
+# Fuzzy search (migrations/008): pages are offsets into the ranking of the admin's last query
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "db")  # db | local (in-memory index, for tests and dev)
+SEARCH_PAGE_SIZE = 10
+SEARCH_MAX_PAGES = int(os.getenv("SEARCH_MAX_PAGES", "20"))
+SEARCH_MIN_CHARS = 3  # shorter queries have no trigrams to use the index with
+SEARCH_LOCAL_TTL = float(os.getenv("SEARCH_LOCAL_TTL", "300"))  # rebuild the local index after this
+# Totals come from DB aggregates; cached between page flips, cleared on insert
+BEN_TOTALS_TTL = float(os.getenv("BEN_TOTALS_TTL", "300"))
+BENEFIT_TOTALS_CACHE = TTLCache(16, BEN_TOTALS_TTL)
+BEN_PERIODS = {"day": "по дням", "week": "по неделям", "month": "по месяцам"}
+BEN_PERIOD_ROWS = 12
+# Analytics dashboard: reads only the rollups of migrations/009; short cache between taps
+ANALYTICS_PERIODS = {7: "7 дней", 30: "30 дней", 90: "90 дней"}
+ANALYTICS_TTL = float(os.getenv("ANALYTICS_TTL", "60"))
+ANALYTICS_CACHE = TTLCache(len(ANALYTICS_PERIODS), ANALYTICS_TTL)
+# Time between statuses, from the status history (migrations/010)
+ANALYTICS_TRANSITIONS = [("В пути", "Прибыло"), ("Прибыло", "На складе")]
 
 STATUS_OPTIONS = {"in_transit": "В пути", "arrived": "Прибыло", "warehouse": "На складе"}
 PHONE_RE = re.compile(r"^\+?\d{7,15}$")
@@ -445,8 +1114,33 @@ def is_phone(text: str) -> bool:
 ############################################################################
 
 # === Part 2: keyboards + calculator helpers ===
+# Keyboards that depend only on the language (or nothing) are built once at
+# import and shared; treat the returned markup as read-only.
+KEYBOARDS: dict[str, MappingProxyType] = {}
+
+def per_lang(build):
+    built = MappingProxyType({code: build(code) for code in LANG})
+    KEYBOARDS[build.__name__] = built
+
+    @functools.wraps(build)
+    def lookup(lang_code: str) -> InlineKeyboardMarkup:
+        return built.get(lang_code) or built[DEFAULT_LANG]
+    lookup.build = build
+    return lookup
+
+def prebuilt(build):
+    kb = build()
+    KEYBOARDS[build.__name__] = MappingProxyType({"*": kb})
+
+    @functools.wraps(build)
+    def lookup() -> InlineKeyboardMarkup:
+        return kb
+    lookup.build = build
+    return lookup
+
+@per_lang
 def main_menu_kb(lang_code: str) -> InlineKeyboardMarkup:
-    L = LANG.get(lang_code, LANG["ru"])
+    L = TEXTS[lang_code]
     return InlineKeyboardMarkup(inline_keyboard=[
         [
             InlineKeyboardButton(text=L["btn_channels"], callback_data="menu:channels"),
@@ -470,8 +1164,9 @@ def main_menu_kb(lang_code: str) -> InlineKeyboardMarkup:
         ],
     ])
 
+@per_lang
 def channels_kb(lang_code: str) -> InlineKeyboardMarkup:
-    L = LANG.get(lang_code, LANG["ru"])
+    L = TEXTS[lang_code]
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="👗 Одежда", url="https://t.me/yasroikard_gr")],
         [InlineKeyboardButton(text="📱 Электроника", url="https://t.me/yasroikard_elektronika")],
@@ -479,20 +1174,28 @@ def channels_kb(lang_code: str) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text=L["btn_back"], callback_data="menu:back")]
     ])
 
+@prebuilt
 def admin_menu_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="➕ Добавить отправление", callback_data="admin:add")],
         [InlineKeyboardButton(text="🔍 Поиск (тел/трек)", callback_data="admin:search")],
+        [InlineKeyboardButton(text="🔎 Поиск по части / описанию", callback_data="admin:fsearch")],
         [InlineKeyboardButton(text="📄 Все отправления", callback_data="admin:list")],
         [InlineKeyboardButton(text="✏️ Изменить статус", callback_data="admin:status")],
         [InlineKeyboardButton(text="📝 Заявки (польз.)", callback_data="admin:reqs")],
         [InlineKeyboardButton(text="💹 Benefit (учёт прибыли)", callback_data="admin:benefit")],
         [InlineKeyboardButton(text="📊 Benefits (статистика)", callback_data="admin:benefits")],
+        [InlineKeyboardButton(text="📈 Аналитика", callback_data="analytics:7")],
+        [InlineKeyboardButton(text="📥 Импорт (CSV/XLSX)", callback_data="admin:import")],
+        [InlineKeyboardButton(text="📤 Экспорт (CSV/XLSX)", callback_data="admin:export")],
+        [InlineKeyboardButton(text="🗂 Массовый статус", callback_data="admin:bulkstatus")],
+        [InlineKeyboardButton(text="📣 Рассылка", callback_data="admin:broadcast")],
         [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu:back")],
     ])
 
+@per_lang
 def track_choice_kb(lang_code: str) -> InlineKeyboardMarkup:
-    L = LANG.get(lang_code, LANG["ru"])
+    L = TEXTS[lang_code]
     return InlineKeyboardMarkup(inline_keyboard=[
         [
             InlineKeyboardButton(text=L["btn_by_code"], callback_data="track:by_code"),
@@ -501,19 +1204,25 @@ def track_choice_kb(lang_code: str) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text=L["btn_back"], callback_data="menu:back")]
     ])
 
-def ben_list_nav_kb(page: int, total_pages: int) -> InlineKeyboardMarkup:
+def ben_list_nav_kb(page: int, next_cursor: str | None) -> InlineKeyboardMarkup:
     row = []
     if page > 1:
         row.append(InlineKeyboardButton(text="⬅️ Пред.", callback_data="benlist:prev"))
-    if page < total_pages:
-        row.append(InlineKeyboardButton(text="➡️ След.", callback_data="benlist:next"))
+    if next_cursor:
+        row.append(InlineKeyboardButton(text="➡️ След.", callback_data=f"benlist:next:{next_cursor}"))
     if not row:
         row = [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin:benefits")]
     return InlineKeyboardMarkup(inline_keyboard=[
         row,
+        [
+            InlineKeyboardButton(text="📅 Дни", callback_data="benperiod:day"),
+            InlineKeyboardButton(text="🗓 Недели", callback_data="benperiod:week"),
+            InlineKeyboardButton(text="📆 Месяцы", callback_data="benperiod:month"),
+        ],
         [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu:admin")],
     ])
 
+@prebuilt
 def status_choice_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -526,6 +1235,26 @@ def status_choice_kb() -> InlineKeyboardMarkup:
         ],
     ])
 
+@prebuilt
+def bulk_status_kb() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=label, callback_data=f"bulkstatus:set:{key}")]
+        for key, label in STATUS_OPTIONS.items()
+    ] + [[InlineKeyboardButton(text="⬅️ Отмена", callback_data="status:cancel")]])
+
+@prebuilt
+def broadcast_confirm_kb() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🚀 Запустить рассылку", callback_data="bcast:start")],
+        [InlineKeyboardButton(text="⬅️ Отмена", callback_data="bcast:cancel")],
+    ])
+
+def broadcast_progress_kb(bc_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⏹ Остановить", callback_data=f"bcast:stop:{bc_id}")],
+    ])
+
+@prebuilt
 def phone_code_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -537,6 +1266,7 @@ def phone_code_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="✏️ Свой код", callback_data="req:code:custom")],
     ])
 
+@prebuilt
 def country_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -559,12 +1289,31 @@ def request_review_kb(req_id: int) -> InlineKeyboardMarkup:
             InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"req:approve:{req_id}"),
             InlineKeyboardButton(text="❌ Отклонить", callback_data=f"req:reject:{req_id}"),
         ],
-        [InlineKeyboardButton(text="➡️ Следующая заявка", callback_data="req:next")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu:admin")],
+        [
+            InlineKeyboardButton(text="➡️ Следующая заявка", callback_data="req:next"),
+            InlineKeyboardButton(text="📋 Пакетом", callback_data="req:batch"),
+        ],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="req:leave")],
     ])
 
+def request_batch_kb(reqs: list[dict], selected: set[int]) -> InlineKeyboardMarkup:
+    rows = [
+        [InlineKeyboardButton(text=f"{'☑️' if r['id'] in selected else '⬜'} #{r['id']} {r.get('tracking_code') or ''}",
+                              callback_data=f"req:pick:{r['id']}")]
+        for r in reqs
+    ]
+    rows.append([InlineKeyboardButton(text="Выбрать все", callback_data="req:pick:all")])
+    if selected:
+        rows.append([
+            InlineKeyboardButton(text=f"✅ Подтвердить ({len(selected)})", callback_data="req:batch:approve"),
+            InlineKeyboardButton(text=f"❌ Отклонить ({len(selected)})", callback_data="req:batch:reject"),
+        ])
+    rows.append([InlineKeyboardButton(text="⬅️ По одной", callback_data="admin:reqs")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+@per_lang
 def lang_kb(lang_code: str) -> InlineKeyboardMarkup:
-    L = LANG.get(lang_code, LANG["ru"])
+    L = TEXTS[lang_code]
     return InlineKeyboardMarkup(inline_keyboard=[
         [
             InlineKeyboardButton(text="🇷🇺 Русский", callback_data="lang:set:ru"),
@@ -574,6 +1323,7 @@ def lang_kb(lang_code: str) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text=L["btn_back"], callback_data="menu:back")]
     ])
 
+@functools.lru_cache(maxsize=16)
 def yes_no_kb(prefix: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -583,14 +1333,16 @@ def yes_no_kb(prefix: str) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="⬅️ Отмена", callback_data="ben:cancel")],
     ])
 
+@prebuilt
 def benefit_menu_btn_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="⬅️ В админ-панель", callback_data="menu:admin")],
     ])
 
 # Calculator helpers (localized prompts)
+@per_lang
 def calc_unit_kb(lang_code: str) -> InlineKeyboardMarkup:
-    L = LANG.get(lang_code, LANG["ru"])
+    L = TEXTS[lang_code]
     return InlineKeyboardMarkup(inline_keyboard=[
         [
             InlineKeyboardButton(text="Метры (м)", callback_data="calc:unit:m"),
@@ -599,8 +1351,9 @@ def calc_unit_kb(lang_code: str) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text=L["btn_back"], callback_data="menu:back")],
     ])
 
+@per_lang
 def calc_again_kb(lang_code: str) -> InlineKeyboardMarkup:
-    L = LANG.get(lang_code, LANG["ru"])
+    L = TEXTS[lang_code]
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=L["btn_calc_again"], callback_data="menu:calc")],
         [InlineKeyboardButton(text=L["btn_menu_back"], callback_data="menu:back")],
@@ -622,7 +1375,316 @@ def _parse_pos_float(s: str) -> float | None:
 
 
 # === Part 3: DB helpers (search/save/list) ===
-def format_shipment_row(row: dict) -> str:
+# ---------- Async repositories ----------
+# Every query from a handler goes through one of these; each call awaits the
+# async PostgREST client, so other updates keep being processed meanwhile.
+# Keyset cursors: (created_at, id) of the last row shown, packed into callback
+# data as "<epoch µs base36>.<id base36>" to stay well under Telegram's 64 bytes.
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def encode_cursor(row: dict) -> str:
+    ts = datetime.fromisoformat(row["created_at"])
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    us = (ts - _EPOCH) // timedelta(microseconds=1)
+    return f"{_b36(us)}.{_b36(int(row['id']))}"
+
+def decode_cursor(cursor: str) -> tuple[str, int]:
+    us, rid = cursor.split(".", 1)
+    ts = _EPOCH + timedelta(microseconds=int(us, 36))
+    return ts.isoformat(), int(rid, 36)
+
+def _b36(n: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = digits[r] + out
+        if not n:
+            return out
+
+def _created_between(q, since: date | None, until: date | None):
+    """UTC calendar days, both ends inclusive."""
+    if since:
+        q = q.gte("created_at", f"{since.isoformat()}T00:00:00+00:00")
+    if until:
+        q = q.lt("created_at", f"{(until + timedelta(days=1)).isoformat()}T00:00:00+00:00")
+    return q
+
+def _after_cursor(q, cursor: str | None):
+    """Newest-first on (created_at, id), starting strictly after `cursor`."""
+    if cursor:
+        ts, rid = decode_cursor(cursor)
+        q = q.or_(f'created_at.lt."{ts}",and(created_at.eq."{ts}",id.lt.{rid})')
+    return q.order("created_at", desc=True).order("id", desc=True)
+
+class _Repo:
+    table = ""
+
+    def __init_subclass__(cls, **kwargs):
+        # Every public query method is timed as bot_db_seconds{table, op}
+        super().__init_subclass__(**kwargs)
+        for name, fn in list(vars(cls).items()):
+            if not name.startswith("_") and asyncio.iscoroutinefunction(fn):
+                setattr(cls, name, cls._timed(fn, name))
+
+    @classmethod
+    def _timed(cls, fn, op: str):
+        h = METRICS.histogram("bot_db_seconds", (("table", cls.table), ("op", op)))
+        span = f"db {cls.table}.{op}"
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            return await measured(h, span, fn, *args, **kwargs)
+        return wrapper
+
+    async def _t(self):
+        return (await adb()).table(self.table)
+
+    async def _rpc(self, fn: str, params: dict | None = None) -> list[dict]:
+        res = await (await adb()).rpc(fn, params or {}).execute()
+        return res.data or []
+
+
+def _status_differs(q, status: str):
+    # A status re-applied by an admin must not re-notify subscribers; NULL counts as different
+    return q.or_(f'status.is.null,status.neq."{status}"')
+
+
+class ShipmentRepo(_Repo):
+    table = "shipments"
+    # Tracking lookups embed the status history (migrations/010): still one round trip.
+    # A shipment has a handful of events; they are sorted in format_timeline.
+    TRACK_SELECT = "*, shipment_events(status, created_at)"
+
+    async def find_by_phone(self, phone: str, limit: int = 20) -> list[dict]:
+        res = await (await self._t()).select(self.TRACK_SELECT).eq("phone", phone).order("created_at", desc=True).limit(limit).execute()
+        return res.data or []
+
+    async def find_by_code(self, code: str, limit: int = 5) -> list[dict]:
+        res = await (await self._t()).select(self.TRACK_SELECT).eq("tracking_code", code).limit(limit).execute()
+        return res.data or []
+
+    async def get_by_code(self, code: str, columns: str = "*") -> dict | None:
+        res = await (await self._t()).select(columns).eq("tracking_code", code).limit(1).execute()
+        return (res.data or [None])[0]
+
+    async def insert_new(self, rows: list[dict]) -> list[dict]:
+        """Batch insert skipping codes that already exist; returns only inserted rows.
+        Needs the unique index from migrations/003_shipments_tracking_code_unique.sql."""
+        res = await (await self._t()).upsert(rows, on_conflict="tracking_code", ignore_duplicates=True).execute()
+        return res.data or []
+
+    async def set_status(self, code: str, status: str) -> list[dict]:
+        """Empty if the code is unknown or already has this status."""
+        res = await _status_differs((await self._t()).update({"status": status}).eq("tracking_code", code), status).execute()
+        return res.data or []
+
+    async def set_status_many(self, codes: list[str], status: str) -> list[dict]:
+        """Only rows whose status actually changes are updated (and returned)."""
+        q = (await self._t()).update({"status": status}).in_("tracking_code", codes)
+        res = await _status_differs(q, status).execute()
+        return res.data or []
+
+    async def existing_codes(self, codes: list[str]) -> set[str]:
+        res = await (await self._t()).select("tracking_code").in_("tracking_code", codes).execute()
+        return {r["tracking_code"] for r in res.data or []}
+
+    async def page_after(self, cursor: str | None, limit: int) -> list[dict]:
+        res = await _after_cursor((await self._t()).select("*"), cursor).limit(limit).execute()
+        return res.data or []
+
+    async def count_estimate(self) -> int:
+        # Planner estimate on big tables (exact below PostgREST's threshold)
+        res = await (await self._t()).select("id", count="estimated").limit(1).execute()
+        return res.count or 0
+
+    async def export_page(self, columns: str, cursor: str | None, limit: int,
+                          since: date | None = None, until: date | None = None, status: str | None = None) -> list[dict]:
+        q = _created_between((await self._t()).select(columns), since, until)
+        if status:
+            q = q.eq("status", status)
+        res = await _after_cursor(q, cursor).limit(limit).execute()
+        return res.data or []
+
+    async def search(self, query: str, limit: int, offset: int = 0) -> list[dict]:
+        """Ranked fuzzy match; see migrations/008_shipments_search.sql."""
+        return await self._rpc("search_shipments", {"p_query": query, "p_limit": limit, "p_offset": offset})
+
+
+class RequestRepo(_Repo):
+    table = "shipment_requests"
+
+    async def claim(self, admin_id: int, limit: int, lease_seconds: float) -> list[dict]:
+        """Claim or renew the admin's window of oldest pending requests; see migrations/012_request_review_queue.sql."""
+        return await self._rpc("claim_pending_requests",
+                               {"p_admin": admin_id, "p_limit": limit, "p_lease_seconds": lease_seconds}) or []
+
+    async def release(self, admin_id: int, req_ids: list[int]):
+        await self._rpc("release_request_claims", {"p_admin": admin_id, "p_req_ids": req_ids})
+
+    async def pending_before(self, cutoff: datetime) -> tuple[int, dict | None]:
+        """(how many pending requests were created before cutoff, the oldest one)."""
+        res = await (await self._t()).select("id, created_at", count="exact").eq("status", "pending") \
+            .lt("created_at", cutoff.isoformat()).order("created_at", desc=False).limit(1).execute()
+        return res.count or 0, (res.data or [None])[0]
+
+    async def create(self, row: dict) -> list[dict]:
+        res = await (await self._t()).insert(row).execute()
+        return res.data or []
+
+    async def approve_many(self, req_ids: list[int], admin_id: int) -> list[dict]:
+        """Approve pending requests and create their shipments in one transaction.
+
+        Requests that are gone, no longer pending or claimed by another admin
+        are left out; see migrations/012_request_review_queue.sql for the
+        returned columns.
+        """
+        return await self._rpc("approve_shipment_requests", {"p_req_ids": req_ids, "p_admin": admin_id}) or []
+
+    async def reject_many(self, req_ids: list[int], admin_id: int) -> list[dict]:
+        """Same rules as approve_many; returns (id, user_id) of the rejected requests."""
+        return await self._rpc("reject_shipment_requests", {"p_req_ids": req_ids, "p_admin": admin_id}) or []
+
+    async def subscribers(self, codes: list[str]) -> list[dict]:
+        """Users whose approved requests cover these tracking codes."""
+        res = await (await self._t()).select("user_id, tracking_code").in_("tracking_code", codes).eq("status", "approved").execute()
+        return res.data or []
+
+
+class BenefitRepo(_Repo):
+    table = "order_benefits"
+
+    async def insert(self, row: dict) -> list[dict]:
+        res = await (await self._t()).insert(row).execute()
+        return res.data or []
+
+    async def page_after(self, cursor: str | None, limit: int) -> list[dict]:
+        q = (await self._t()).select("id, whatsapp, paid, real_cost, user_paid, benefit, created_at")
+        res = await _after_cursor(q, cursor).limit(limit).execute()
+        return res.data or []
+
+    async def export_page(self, columns: str, cursor: str | None, limit: int,
+                          since: date | None = None, until: date | None = None, status: str | None = None) -> list[dict]:
+        q = _created_between((await self._t()).select(columns), since, until)
+        res = await _after_cursor(q, cursor).limit(limit).execute()
+        return res.data or []
+
+    # Aggregates live in the DB (migrations/001_benefit_totals.sql)
+    async def totals(self) -> dict:
+        return (await self._rpc("benefits_totals") or [{}])[0]
+
+    async def by_period(self, period: str, limit: int = 12) -> list[dict]:
+        return await self._rpc("benefits_by_period", {"p_period": period, "p_limit": limit})
+
+
+class UserRepo(_Repo):
+    table = "users"
+
+    async def get_language(self, user_id: int) -> str | None:
+        res = await (await self._t()).select("language").eq("id", user_id).limit(1).execute()
+        return (res.data or [{}])[0].get("language")
+
+    async def get_languages(self, user_ids: list[int]) -> dict[int, str | None]:
+        res = await (await self._t()).select("id, language").in_("id", user_ids).execute()
+        return {r["id"]: r.get("language") for r in res.data or []}
+
+    async def upsert_many(self, rows: list[dict]) -> None:
+        # Language is only set for new users (migrations/013_upsert_users.sql)
+        await self._rpc("upsert_users", {"p_rows": rows})
+
+    async def set_languages(self, rows: list[dict]) -> None:
+        # Per-row values in one UPDATE (migrations/007_set_user_languages.sql)
+        await self._rpc("set_user_languages", {"p_rows": rows})
+
+    async def page_by_id(self, after_id: int, limit: int) -> list[dict]:
+        res = await (await self._t()).select("id, language").gt("id", after_id).order("id").limit(limit).execute()
+        return res.data or []
+
+    async def count_estimate(self) -> int:
+        res = await (await self._t()).select("id", count="estimated").limit(1).execute()
+        return res.count or 0
+
+
+class BroadcastRepo(_Repo):
+    table = "broadcasts"  # migrations/005_broadcasts.sql
+
+    async def create(self, row: dict) -> dict:
+        res = await (await self._t()).insert(row).execute()
+        return res.data[0]
+
+    async def update(self, bc_id: int, fields: dict) -> None:
+        await (await self._t()).update(fields).eq("id", bc_id).execute()
+
+    async def running(self) -> list[dict]:
+        res = await (await self._t()).select("*").eq("status", "running").order("id").execute()
+        return res.data or []
+
+
+class ShipmentEventRepo(_Repo):
+    table = "shipment_events"  # migrations/010_shipment_events.sql, written by a trigger on shipments
+
+    async def durations(self, from_status: str, to_status: str, days: int) -> dict:
+        rows = await self._rpc("status_durations", {"p_from": from_status, "p_to": to_status, "p_days": days})
+        return (rows or [{}])[0]
+
+
+class JobLockRepo(_Repo):
+    table = "job_locks"  # migrations/011_job_locks.sql
+
+    async def try_lock(self, name: str, owner: str, lease_seconds: float) -> bool:
+        return bool(await self._rpc("try_job_lock", {"p_name": name, "p_owner": owner, "p_lease_seconds": lease_seconds}))
+
+
+class AnalyticsRepo(_Repo):
+    table = "shipment_stats_daily"  # migrations/009_analytics_rollups.sql
+
+    async def report(self, days: int) -> dict:
+        return await self._rpc("analytics_report", {"p_days": days}) or {}
+
+    async def refresh(self) -> None:
+        await self._rpc("refresh_analytics_rollups")
+
+
+class OutboxRepo(_Repo):
+    table = "notification_outbox"  # migrations/004_notification_outbox.sql
+
+    async def add(self, rows: list[dict]) -> list[dict]:
+        res = await (await self._t()).insert(rows).execute()
+        return res.data or []
+
+    async def pending(self, limit: int) -> list[dict]:
+        res = await (await self._t()).select("id, chat_id, text").eq("status", "pending").order("id").limit(limit).execute()
+        return res.data or []
+
+    async def mark(self, ids: list[int], status: str, error: str | None = None) -> None:
+        await (await self._t()).update({"status": status, "error": error}).in_("id", ids).execute()
+
+
+shipments_repo = ShipmentRepo()
+requests_repo = RequestRepo()
+benefits_repo = BenefitRepo()
+users_repo = UserRepo()
+outbox_repo = OutboxRepo()
+broadcasts_repo = BroadcastRepo()
+analytics_repo = AnalyticsRepo()
+events_repo = ShipmentEventRepo()
+job_locks_repo = JobLockRepo()
+
+TIMELINE_EVENTS = 10  # latest events shown under a tracking result
+
+def format_timeline(events: list[dict]) -> list[str]:
+    """Status history, oldest first."""
+    lines = []
+    for e in sorted(events, key=lambda e: e.get("created_at") or "")[-TIMELINE_EVENTS:]:
+        try:
+            ts = datetime.fromisoformat(e["created_at"]).astimezone(timezone.utc).strftime("%d.%m.%Y %H:%M")
+        except (KeyError, TypeError, ValueError):
+            ts = "—"
+        lines.append(f"  {ts} — {e.get('status') or '—'}")
+    return lines
+
+def format_shipment_row(row: dict, timeline: bool = True) -> str:
     parts = [
         f"Трек: {row.get('tracking_code')}",
         f"Тел: {row.get('phone') or '—'}",
@@ -630,8 +1692,26 @@ def format_shipment_row(row: dict) -> str:
     ]
     if row.get("description"):
         parts.append(f"Описание: {row['description']}")
+    if timeline and row.get("shipment_events"):
+        parts.append("🕓 История (UTC):")
+        parts += format_timeline(row["shipment_events"])
     return "\n".join(parts)
 
+MESSAGE_MAX_CHARS = 4000  # Telegram rejects texts over 4096
+
+def chunk_blocks(blocks: list[str], sep: str = "\n\n", limit: int = MESSAGE_MAX_CHARS) -> list[str]:
+    """Join blocks into as few messages as possible, each under `limit` characters."""
+    chunks, cur = [], ""
+    for block in blocks:
+        block = block[:limit]
+        if cur and len(cur) + len(sep) + len(block) > limit:
+            chunks.append(cur)
+            cur = ""
+        cur = cur + sep + block if cur else block
+    if cur:
+        chunks.append(cur)
+    return chunks
+
 def format_request_row(r: dict) -> str:
     return (
         f"Заявка #{r.get('id')}\n"
@@ -642,51 +1722,884 @@ def format_request_row(r: dict) -> str:
         f"Статус: {r.get('status')}"
     )
 
+# ---------- Tracking lookup cache ----------
+# Customers poll the same code/phone many times a day, while a shipment changes
+# only a few times; writes below drop exactly the affected keys.
+TRACK_CACHE_TTL = float(os.getenv("TRACK_CACHE_TTL", "300"))
+TRACK_CACHE_SIZE = int(os.getenv("TRACK_CACHE_SIZE", "20000"))
+TRACK_CACHE = TTLCache(TRACK_CACHE_SIZE, TRACK_CACHE_TTL)
+TRACK_CACHE_STATS = {"hits": 0, "misses": 0, "invalidations": 0, "coalesced": 0}
+# Lookups on their way to the DB; identical concurrent misses share one query
+_TRACK_INFLIGHT: dict[tuple[str, str], asyncio.Future] = {}
+# callables (keys) run after a local invalidation, e.g. to tell other workers
+TRACK_INVALIDATION_HOOKS: list = []
+
+def drop_tracking_keys(keys: list[tuple[str, str]]):
+    for key in keys:
+        if TRACK_CACHE.pop(key) is not None:
+            TRACK_CACHE_STATS["invalidations"] += 1
+
+def invalidate_tracking(rows: list[dict]):
+    """Forget cached lookups touching these shipments (by code and by phone)."""
+    keys = [
+        key for r in rows
+        for key in (("code", r.get("tracking_code")), ("phone", r.get("phone"))) if key[1]
+    ]
+    drop_tracking_keys(keys)
+    if keys:
+        for hook in TRACK_INVALIDATION_HOOKS:
+            try:
+                hook(keys)
+            except Exception as e:
+                print("track invalidation hook error:", e)
+
+@timed
 async def find_shipments(query: str, mode: str | None = None) -> list[dict]:
     q = query.strip()
+    if mode == "phone" or (mode != "code" and is_phone(q)):
+        key = ("phone", normalize_phone(q))
+    else:
+        key = ("code", q)
+    cached = TRACK_CACHE.get(key)
+    if cached is not None:
+        TRACK_CACHE_STATS["hits"] += 1
+        return cached
+    pending = _TRACK_INFLIGHT.get(key)
+    if pending is not None:
+        TRACK_CACHE_STATS["coalesced"] += 1
+        return await asyncio.shield(pending)
+    TRACK_CACHE_STATS["misses"] += 1
+    fut = asyncio.get_running_loop().create_future()
+    _TRACK_INFLIGHT[key] = fut
+    rows = []
     try:
-        if mode == "phone":
-            res = supabase.table("shipments").select("*").eq("phone", normalize_phone(q)).order("created_at", desc=True).limit(20).execute()
-        elif mode == "code":
-            res = supabase.table("shipments").select("*").eq("tracking_code", q).limit(5).execute()
+        if key[0] == "phone":
+            rows = await shipments_repo.find_by_phone(key[1])
         else:
-            if is_phone(q):
-                res = supabase.table("shipments").select("*").eq("phone", normalize_phone(q)).order("created_at", desc=True).limit(20).execute()
-            else:
-                res = supabase.table("shipments").select("*").eq("tracking_code", q).limit(5).execute()
-        return res.data or []
+            rows = await shipments_repo.find_by_code(key[1])
+        TRACK_CACHE.set(key, rows)  # empty results too: invalidated on insert
     except Exception as e:
         print("Search error:", e)
-        return []
+    finally:
+        _TRACK_INFLIGHT.pop(key, None)
+        fut.set_result(rows)
+    return rows
 
+@timed
 async def save_shipment_to_db(data: dict) -> tuple[bool, str]:
     tracking = data.get("tracking_code")
     phone = data.get("phone")
     description = data.get("description")
     try:
-        dup = supabase_admin.table("shipments").select("id").eq("tracking_code", tracking).limit(1).execute()
-        if dup.data:
-            return False, "❗ Отправление с таким трек-кодом уже существует."
-    except Exception as e:
-        return False, f"Ошибка проверки дубликата: {e}"
-    try:
-        ins = supabase_admin.table("shipments").insert({
+        # ON CONFLICT (tracking_code) DO NOTHING: nothing comes back for a duplicate
+        ins = await shipments_repo.insert_new([{
             "tracking_code": tracking, "phone": phone, "description": description,
             "status": "В пути", "image_url": None,
-        }).execute()
-        return (True, "✅ Отправление сохранено.") if ins.data else (False, "Не удалось сохранить отправление.")
+        }])
     except Exception as e:
         return False, f"Ошибка сохранения: {e}"
+    if not ins:
+        return False, "❗ Отправление с таким трек-кодом уже существует."
+    invalidate_tracking(ins)
+    return True, "✅ Отправление сохранено."
+
+# ---------- Request review queue ----------
+REVIEW_WINDOW = int(os.getenv("REVIEW_WINDOW", "8"))  # requests claimed per admin at once
+REVIEW_LEASE = float(os.getenv("REVIEW_LEASE", "900"))  # seconds a claim keeps others away
+
+class ReviewQueue:
+    """Each admin's claimed window of pending requests.
+
+    One claim RPC fetches and locks the next REVIEW_WINDOW requests, so
+    flipping through them costs no round trips and two admins never get the
+    same request. The window is renewed when it runs out or its lease is
+    close to expiring; requests skipped without a decision come round again.
+    An admin's updates always land on the same worker, so this can live in
+    process memory.
+    """
+
+    def __init__(self):
+        self.held: dict[int, dict[int, dict]] = {}  # admin -> id -> request, oldest first
+        self.renew_at: dict[int, float] = {}
+        self.selected: dict[int, set[int]] = {}  # ticked on the batch screen
+
+    async def _refill(self, admin_id: int) -> dict[int, dict]:
+        rows = await requests_repo.claim(admin_id, REVIEW_WINDOW, REVIEW_LEASE)
+        rows.sort(key=lambda r: (r.get("created_at") or "", r["id"]))
+        held = self.held[admin_id] = {r["id"]: r for r in rows}
+        self.renew_at[admin_id] = time.monotonic() + REVIEW_LEASE * 0.8
+        self.selected[admin_id] = self.selected.get(admin_id, set()) & held.keys()
+        return held
+
+    async def window(self, admin_id: int) -> dict[int, dict]:
+        held = self.held.get(admin_id)
+        if not held or time.monotonic() >= self.renew_at.get(admin_id, 0):
+            held = await self._refill(admin_id)
+        return held
+
+    async def next(self, admin_id: int, after: int | None = None) -> dict | None:
+        """The request to show after `after` (None = from the start of the window)."""
+        held = await self.window(admin_id)
+        ids = list(held)
+        if ids and ids[-1] == after:  # end of the window: claim further requests
+            held = await self._refill(admin_id)
+            ids = list(held)
+        if after in held:
+            i = ids.index(after)
+            ids = ids[i + 1:] + ids[:i + 1]
+        return held[ids[0]] if ids else None
+
+    def before(self, admin_id: int, req_id: int) -> int | None:
+        """The request shown before req_id, to carry on from there once req_id is decided."""
+        prev = None
+        for rid in self.held.get(admin_id, ()):
+            if rid == req_id:
+                return prev
+            prev = rid
+        return None
+
+    def done(self, admin_id: int, req_ids: list[int]):
+        held, selected = self.held.get(admin_id, {}), self.selected.get(admin_id, set())
+        for rid in req_ids:
+            held.pop(rid, None)
+            selected.discard(rid)
+
+    async def approve(self, admin_id: int, req_ids: list[int]) -> list[dict]:
+        rows = await requests_repo.approve_many(req_ids, admin_id)
+        self.done(admin_id, req_ids)  # the ones not returned were decided elsewhere
+        return rows
+
+    async def reject(self, admin_id: int, req_ids: list[int]) -> list[dict]:
+        rows = await requests_repo.reject_many(req_ids, admin_id)
+        self.done(admin_id, req_ids)
+        return rows
+
+    async def release(self, admin_id: int):
+        held = self.held.pop(admin_id, {})
+        self.renew_at.pop(admin_id, None)
+        self.selected.pop(admin_id, None)
+        if held:
+            try:
+                await requests_repo.release(admin_id, list(held))
+            except Exception as e:
+                print("Release request claims error:", e)  # the lease runs out on its own
+
+review_queue = ReviewQueue()
+
+# ---------- User write-behind ----------
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "1.0"))  # seconds
+USER_FLUSH_SIZE = int(os.getenv("USER_FLUSH_SIZE", "500"))  # pending users that force a flush
+
+class UserWriteBuffer:
+    """Coalesces /start upserts and language changes per user id.
+
+    A flush sends all profile rows in one upsert and all language changes
+    in one RPC. Rows from a failed flush are merged back (newer writes win) and
+    retried on the next tick.
+    """
 
-async def get_next_pending_request() -> dict | None:
+    def __init__(self):
+        self.profiles: dict[int, dict] = {}
+        self.languages: dict[int, str] = {}
+        self._kick = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+        self.stats = {"enqueued": 0, "coalesced": 0, "flushes": 0, "rows": 0, "errors": 0,
+                      "last_flush_ms": 0.0, "max_flush_ms": 0.0}
+
+    def __len__(self):
+        return len(self.profiles.keys() | self.languages.keys())
+
+    def _enqueued(self, user_id: int, known: bool):
+        self.stats["enqueued"] += 1
+        if known:
+            self.stats["coalesced"] += 1
+        if len(self) >= USER_FLUSH_SIZE:
+            self._kick.set()
+
+    def upsert(self, row: dict):
+        uid = row["id"]
+        known = uid in self.profiles or uid in self.languages
+        self.profiles[uid] = dict(row)  # never carries language: /start must not overwrite the saved one
+        self._enqueued(uid, known)
+
+    def set_language(self, user_id: int, lang: str):
+        known = user_id in self.profiles or user_id in self.languages
+        self.languages[user_id] = lang
+        self._enqueued(user_id, known)
+
+    def pending_language(self, user_id: int) -> str | None:
+        return self.languages.get(user_id)
+
+    async def flush(self):
+        async with self._flush_lock:
+            profiles, self.profiles = self.profiles, {}
+            languages, self.languages = self.languages, {}
+            if not profiles and not languages:
+                return
+            t0 = time.perf_counter()
+            try:
+                if profiles:
+                    await users_repo.upsert_many(list(profiles.values()))
+            except Exception as e:
+                print("user upsert flush error:", e)
+                self.stats["errors"] += 1
+                for uid, row in profiles.items():
+                    self.profiles[uid] = {**row, **self.profiles.get(uid, {})}
+                    if uid in languages:  # a new user's row must exist before its language is set
+                        self.languages.setdefault(uid, languages.pop(uid))
+                profiles = {}
+            try:
+                if languages:
+                    await users_repo.set_languages([{"id": u, "language": l} for u, l in languages.items()])
+            except Exception as e:
+                print("language flush error:", e)
+                self.stats["errors"] += 1
+                for uid, lang in languages.items():
+                    self.languages.setdefault(uid, lang)
+                languages = {}
+            ms = (time.perf_counter() - t0) * 1000
+            METRICS.observe("bot_user_flush_seconds", ms / 1000)
+            self.stats["flushes"] += 1
+            self.stats["rows"] += len(profiles) + len(languages)
+            self.stats["last_flush_ms"] = ms
+            self.stats["max_flush_ms"] = max(self.stats["max_flush_ms"], ms)
+        if languages:
+            run_lang_hooks(sorted(languages))
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._kick.wait(), USER_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._kick.clear()
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+user_writes = UserWriteBuffer()
+METRICS.gauge_fns["bot_user_write_queue"] = lambda: len(user_writes)
+
+# ---------- Outbound notifications ----------
+NOTIFY_GLOBAL_RATE = float(os.getenv("NOTIFY_GLOBAL_RATE", "25"))   # msgs/s, Telegram allows ~30
+NOTIFY_CHAT_INTERVAL = float(os.getenv("NOTIFY_CHAT_INTERVAL", "1.1"))  # s between msgs to one chat
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "4"))
+NOTIFY_MAX_ATTEMPTS = 5
+NOTIFY_MAX_CHARS = 4000  # batched message stays under Telegram's 4096
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now); continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class Notifier:
+    """Background sender for customer notifications.
+
+    Every message is written to the outbox table first, so whatever is still
+    unsent at shutdown is picked up again on the next start. Messages queued
+    for one chat while it waits for its per-chat slot go out as one message.
+    """
+
+    def __init__(self):
+        self.pending: dict[int, list[dict]] = {}  # chat_id -> [{"id", "text", "attempts"}]
+        self.ready: asyncio.Queue[int] = asyncio.Queue()
+        self.next_slot: dict[int, float] = {}
+        self.bucket = TokenBucket(NOTIFY_GLOBAL_RATE)
+        self.workers: list[asyncio.Task] = []
+        self.stats = {"sent": 0, "batched": 0, "retry_after": 0, "failed": 0}
+
+    def _push(self, chat_id: int, items: list[dict], front: bool = False):
+        queued = chat_id in self.pending
+        cur = self.pending.setdefault(chat_id, [])
+        self.pending[chat_id] = items + cur if front else cur + items
+        if not queued:
+            self.ready.put_nowait(chat_id)
+
+    async def send(self, messages: list[tuple[int, str]]):
+        """Queue (chat_id, text) pairs; returns once they are persisted."""
+        if not messages:
+            return
+        rows = [{"chat_id": c, "text": txt} for c, txt in messages]
+        try:
+            saved = await outbox_repo.add(rows)
+        except Exception as e:
+            print("outbox insert error:", e)  # still deliver, just not restart-safe
+            saved = []
+        ids = [r.get("id") for r in saved] if len(saved) == len(rows) else [None] * len(rows)
+        for (chat_id, text), oid in zip(messages, ids):
+            self._push(chat_id, [{"id": oid, "text": text, "attempts": 0}])
+
+    async def start(self, load_outbox: bool = True):
+        if load_outbox:
+            try:
+                for r in await outbox_repo.pending(10000):
+                    self._push(r["chat_id"], [{"id": r["id"], "text": r["text"], "attempts": 0}])
+            except Exception as e:
+                print("outbox load error:", e)
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(NOTIFY_WORKERS)]
+
+    async def stop(self, timeout: float = 5.0):
+        """Give queued messages a moment to go out; the rest stay in the outbox."""
+        if not self.workers:
+            return
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for w in self.workers:
+            w.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def _take_batch(self, chat_id: int) -> list[dict]:
+        items = self.pending.pop(chat_id, [])
+        batch, size = [], 0
+        while items and (not batch or size + len(items[0]["text"]) + 2 <= NOTIFY_MAX_CHARS):
+            size += len(items[0]["text"]) + 2
+            batch.append(items.pop(0))
+        if items:
+            self._push(chat_id, items)
+        return batch
+
+    async def _mark(self, batch: list[dict], status: str, error: str | None = None):
+        ids = [i["id"] for i in batch if i["id"] is not None]
+        if ids:
+            try:
+                await outbox_repo.mark(ids, status, error)
+            except Exception as e:
+                print("outbox update error:", e)
+
+    async def _worker(self):
+        while True:
+            chat_id = await self.ready.get()
+            # One worker per chat at a time: a chat is only in `ready` once
+            wait = self.next_slot.get(chat_id, 0) - time.monotonic()
+            if wait > 0:
+                # Re-queue when its slot opens; workers never sit out a chat's backoff
+                asyncio.get_running_loop().call_later(wait, self.ready.put_nowait, chat_id)
+                continue
+            batch = self._take_batch(chat_id)
+            if not batch:
+                continue
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(chat_id, "\n\n".join(i["text"] for i in batch))
+            except TelegramRetryAfter as e:
+                self.stats["retry_after"] += 1
+                self.bucket.pause(e.retry_after)
+                self.next_slot[chat_id] = time.monotonic() + e.retry_after
+                self._push(chat_id, batch, front=True)
+                continue
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # Blocked the bot / chat gone: retrying will not help
+                self.stats["failed"] += len(batch)
+                await self._mark(batch, "failed", str(e))
+                continue
+            except Exception as e:
+                retry = [i for i in batch if i["attempts"] + 1 < NOTIFY_MAX_ATTEMPTS]
+                for i in retry:
+                    i["attempts"] += 1
+                dead = [i for i in batch if i not in retry]
+                if dead:
+                    self.stats["failed"] += len(dead)
+                    await self._mark(dead, "failed", str(e))
+                if retry:
+                    self.next_slot[chat_id] = time.monotonic() + 2 ** retry[0]["attempts"]
+                    self._push(chat_id, retry, front=True)
+                continue
+            now = time.monotonic()
+            self.next_slot[chat_id] = now + NOTIFY_CHAT_INTERVAL
+            if len(self.next_slot) > 10000:
+                self.next_slot = {c: ts for c, ts in self.next_slot.items() if ts > now}
+            self.stats["sent"] += 1
+            self.stats["batched"] += len(batch) - 1
+            await self._mark(batch, "sent")
+
+notifier = Notifier()
+METRICS.gauge_fns["bot_notify_pending"] = lambda: sum(len(v) for v in notifier.pending.values())
+
+@timed
+async def notify_status_change(rows: list[dict]):
+    """Tell customers with approved requests that their shipment status changed."""
+    by_code = {r.get("tracking_code"): r.get("status") for r in rows if r.get("tracking_code")}
+    if not by_code:
+        return
     try:
-        res = supabase_admin.table("shipment_requests").select("*").eq("status", "pending").order("created_at", desc=False).limit(1).execute()
-        return (res.data or [None])[0]
+        subs = []
+        codes = list(by_code)
+        for i in range(0, len(codes), 200):
+            subs += await requests_repo.subscribers(codes[i:i + 200])
     except Exception as e:
-        print("Fetch pending request error:", e)
-        return None
+        print("notify subscribers error:", e); return
+    pairs = {(s["user_id"], s["tracking_code"]) for s in subs}
+    langs = await resolve_langs(list({uid for uid, _ in pairs}))
+    messages = [
+        (uid, TEXTS[langs[uid]]["status_changed"].format(code=code, status=by_code[code]))
+        for uid, code in pairs
+    ]
+    await notifier.send(messages)
+
+# ---------- Broadcasts ----------
+BROADCAST_PAGE = 200          # users per keyset page = checkpoint granularity
+BROADCAST_CONCURRENCY = 8     # sends in flight; the shared bucket sets the rate
+BROADCAST_PROGRESS_EVERY = 3.0  # seconds between progress edits
+BROADCAST_TASKS: dict[int, tuple[dict, asyncio.Task]] = {}  # id -> (live row, sender); one at a time
+_BROADCAST_START_LOCK = asyncio.Lock()
+
+def format_broadcast_progress(bc: dict) -> str:
+    done = bc["delivered"] + bc["blocked"] + bc["failed"]
+    head = {"running": "⏳ идёт", "done": "✅ завершена", "cancelled": "⏹ остановлена"}.get(bc["status"], bc["status"])
+    return (
+        f"📣 Рассылка #{bc['id']} — {head}\n"
+        f"Обработано: {done} из ~{bc.get('total') or '?'}\n"
+        f"✅ Доставлено: {bc['delivered']} • 🚫 Заблокировали: {bc['blocked']} • ⚠️ Ошибки: {bc['failed']}"
+    )
+
+async def _broadcast_one(chat_id: int, text: str) -> str:
+    for _ in range(3):
+        await notifier.bucket.acquire()
+        try:
+            await bot.send_message(chat_id, text)
+            return "delivered"
+        except TelegramRetryAfter as e:
+            notifier.bucket.pause(e.retry_after)
+        except TelegramForbiddenError:
+            return "blocked"
+        except Exception:
+            return "failed"
+    return "failed"
+
+async def _broadcast_progress(bc: dict, final: bool = False):
+    if not bc.get("progress_msg_id"):
+        return
+    try:
+        await bot.edit_message_text(
+            format_broadcast_progress(bc), chat_id=bc["created_by"], message_id=bc["progress_msg_id"],
+            reply_markup=None if final else broadcast_progress_kb(bc["id"]),
+        )
+    except Exception as e:
+        print("broadcast progress error:", e)
+
+async def run_broadcast(bc: dict):
+    """Send bc["texts"] to every user after bc["last_user_id"], checkpointing per page.
+
+    After a crash at most one page (BROADCAST_PAGE users) is sent twice.
+    """
+    texts = bc["texts"]
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    last_progress = 0.0
+
+    async def send(u: dict) -> str:
+        async with sem:
+            return await _broadcast_one(u["id"], texts.get(u.get("language")) or texts[DEFAULT_LANG])
+
+    try:
+        while True:
+            page = await users_repo.page_by_id(bc["last_user_id"], BROADCAST_PAGE)
+            if not page:
+                break
+            for outcome in await asyncio.gather(*(send(u) for u in page)):
+                bc[outcome] += 1
+            bc["last_user_id"] = page[-1]["id"]
+            await broadcasts_repo.update(bc["id"], {k: bc[k] for k in ("last_user_id", "delivered", "blocked", "failed")})
+            if time.monotonic() - last_progress >= BROADCAST_PROGRESS_EVERY:
+                last_progress = time.monotonic()
+                await _broadcast_progress(bc)
+        bc["status"] = "done"
+        await broadcasts_repo.update(bc["id"], {"status": "done", "finished_at": datetime.now(timezone.utc).isoformat()})
+    except asyncio.CancelledError:
+        # Shutdown leaves it "running" so it resumes; stop_broadcast() marks it cancelled
+        raise
+    except Exception as e:
+        print(f"broadcast {bc['id']} error:", e)  # still "running": resumes on restart
+        return
+    finally:
+        BROADCAST_TASKS.pop(bc["id"], None)
+    await _broadcast_progress(bc, final=True)
+
+def start_broadcast(bc: dict):
+    BROADCAST_TASKS[bc["id"]] = (bc, asyncio.create_task(run_broadcast(bc)))
+
+async def stop_broadcast(bc_id: int) -> bool:
+    """Admin stop: cancel the sender, store the final counters as cancelled.
+
+    Returns True if it ran here and its progress message got the final counts.
+    """
+    bc, task = BROADCAST_TASKS.pop(bc_id, (None, None))
+    if task:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    fields = {"status": "cancelled", "finished_at": datetime.now(timezone.utc).isoformat()}
+    if bc:
+        fields |= {k: bc[k] for k in ("last_user_id", "delivered", "blocked", "failed")}
+    await broadcasts_repo.update(bc_id, fields)
+    if not bc:
+        return False
+    bc["status"] = "cancelled"
+    await _broadcast_progress(bc, final=True)
+    return True
+
+async def resume_broadcasts():
+    try:
+        for bc in await broadcasts_repo.running():
+            print(f"Resuming broadcast {bc['id']} after user {bc['last_user_id']}")
+            start_broadcast(bc)
+    except Exception as e:
+        print("broadcast resume error:", e)
+
+async def stop_broadcasts():
+    """Shutdown: cancel senders; checkpoints stay and are resumed on next start."""
+    tasks = [task for _, task in BROADCAST_TASKS.values()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# ---------- Bulk import (admin uploads) ----------
+IMPORT_MAX_BYTES = 20 * 1024 * 1024  # Bot API download limit
+IMPORT_BATCH = int(os.getenv("IMPORT_BATCH", "500"))
+IMPORT_COLUMNS = {
+    "tracking_code": {"tracking_code", "tracking", "track", "трек", "трек-код", "трек код"},
+    "phone": {"phone", "телефон", "тел", "номер"},
+    "description": {"description", "описание", "desc"},
+}
+
+def iter_upload_rows(fileobj, filename: str):
+    """Yield each row of an uploaded CSV/XLSX as a list of stripped strings."""
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise RuntimeError("Для XLSX нужен пакет openpyxl; загрузите CSV.")
+        wb = load_workbook(fileobj, read_only=True, data_only=True)
+        try:
+            for values in wb.active.iter_rows(values_only=True):
+                yield ["" if v is None else str(v).strip() for v in values]
+        finally:
+            wb.close()
+        return
+    text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+    lead = []  # blank lines before the first row with content
+    first = text.readline()
+    while first and not first.strip(" \t\r\n;,"):
+        lead.append(first)
+        first = text.readline()
+    delimiter = ";" if first.count(";") > first.count(",") else ","
+    for row in csv.reader(itertools.chain(lead, [first], text), delimiter=delimiter):
+        yield [c.strip() for c in row]
+
+def _import_column_map(header: list[str]) -> dict[str, int] | None:
+    names = [h.lower() for h in header]
+    found = {}
+    for field, aliases in IMPORT_COLUMNS.items():
+        for i, name in enumerate(names):
+            if name in aliases:
+                found[field] = i
+                break
+    return found if "tracking_code" in found else None
+
+class UploadReader:
+    """Numbered non-empty rows of an upload, parsed IMPORT_BATCH at a time in a
+    worker thread so a large file never stalls other updates.
+
+    `header` is the column map of the first non-empty row if that row is a
+    header (it is then not yielded), otherwise None.
+    """
+
+    def __init__(self, fileobj, filename: str):
+        self._rows = ((n, row) for n, row in enumerate(iter_upload_rows(fileobj, filename), start=1) if any(row))
+        self.header: dict[str, int] | None = None
+
+    def _take(self) -> list[tuple[int, list[str]]]:
+        return list(itertools.islice(self._rows, IMPORT_BATCH))
+
+    async def batches(self):
+        first = True
+        while batch := await asyncio.to_thread(self._take):
+            if first:
+                first = False
+                self.header = _import_column_map(batch[0][1])
+                if self.header:
+                    batch = batch[1:]
+            yield batch
+
+@timed
+async def import_shipments(reader: UploadReader) -> dict:
+    """Validate, de-duplicate and insert shipments in batches of IMPORT_BATCH.
+
+    Columns are taken from a header row if present, otherwise
+    tracking_code, phone, description. Each batch is one upsert round trip.
+    """
+    stats = {"inserted": 0, "duplicate": 0, "invalid": 0, "invalid_lines": []}
+    cols = {"tracking_code": 0, "phone": 1, "description": 2}
+    seen: set[str] = set()
+    batch: list[dict] = []
+
+    async def flush():
+        if not batch:
+            return
+        inserted = await shipments_repo.insert_new(batch)
+        invalidate_tracking(inserted)
+        stats["inserted"] += len(inserted)
+        stats["duplicate"] += len(batch) - len(inserted)
+        batch.clear()
+
+    async for rows in reader.batches():
+        cols = reader.header or cols
+        for line_no, row in rows:
+            def cell(field):
+                i = cols.get(field)
+                return row[i] if i is not None and i < len(row) else ""
+
+            tracking, phone = cell("tracking_code"), normalize_phone(cell("phone"))
+            if len(tracking) < 5 or not PHONE_RE.match(phone):
+                stats["invalid"] += 1
+                if len(stats["invalid_lines"]) < 10:
+                    stats["invalid_lines"].append(line_no)
+                continue
+            if tracking in seen:
+                stats["duplicate"] += 1
+                continue
+            seen.add(tracking)
+            batch.append({
+                "tracking_code": tracking, "phone": phone, "description": cell("description") or None,
+                "status": "В пути", "image_url": None,
+            })
+            if len(batch) >= IMPORT_BATCH:
+                await flush()
+    await flush()
+    return stats
+
+def format_import_summary(stats: dict) -> str:
+    lines = [
+        "📥 Импорт завершён.",
+        f"✅ Добавлено: {stats['inserted']}",
+        f"♻️ Дубликаты (уже есть / повтор в файле): {stats['duplicate']}",
+        f"⚠️ Ошибки формата: {stats['invalid']}",
+    ]
+    if stats["invalid_lines"]:
+        lines.append("Строки с ошибками: " + ", ".join(map(str, stats["invalid_lines"]))
+                     + (" …" if stats["invalid"] > len(stats["invalid_lines"]) else ""))
+    return "\n".join(lines)
+
+# ---------- Export (admin downloads) ----------
+# Whole tables go out in keyset pages through a spooled temp file (on disk past
+# EXPORT_SPOOL_BYTES), so memory stays flat whatever the table size.
+EXPORT_PAGE = int(os.getenv("EXPORT_PAGE", "1000"))
+EXPORT_SPOOL_BYTES = 4 * 1024 * 1024
+EXPORT_MAX_BYTES = 50 * 1024 * 1024  # Bot API upload limit
+EXPORT_PROGRESS_EVERY = 3.0  # seconds between progress edits
+EXPORT_TABLES = {
+    "shipments": ("Отправления", ["id", "tracking_code", "phone", "status", "description", "created_at"]),
+    "benefits": ("Benefits", ["id", "whatsapp", "paid", "real_cost", "user_paid", "benefit", "tg_admin_id", "created_at"]),
+}
+EXPORT_REPOS = {"shipments": shipments_repo, "benefits": benefits_repo}
+EXPORT_TASKS: dict[int, asyncio.Task] = {}  # admin id -> running export
+
+class SpooledInputFile(InputFile):
+    """Uploads an already written (spooled) temp file in chunks."""
+
+    def __init__(self, fileobj, filename: str, chunk_size: int = 64 * 1024):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.fileobj = fileobj
+
+    async def read(self, bot):
+        self.fileobj.seek(0)
+        while chunk := await asyncio.to_thread(self.fileobj.read, self.chunk_size):
+            yield chunk
+
+class _CsvSink:
+    def __init__(self, fileobj, columns: list[str]):
+        # BOM + ";" so Excel with a Russian locale opens it as columns
+        self.text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+        self.writer = csv.writer(self.text, delimiter=";")
+        self.writer.writerow(columns)
+
+    def write(self, rows: list[list]):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.text.flush()
+        self.text.detach()  # leave the temp file open for the upload
+
+class _XlsxSink:
+    def __init__(self, fileobj, columns: list[str]):
+        try:
+            from openpyxl import Workbook
+        except ImportError:
+            raise RuntimeError("Для XLSX нужен пакет openpyxl; выберите CSV.")
+        self.fileobj = fileobj
+        self.wb = Workbook(write_only=True)  # rows go to a temp file, not memory
+        self.ws = self.wb.create_sheet()
+        self.ws.append(columns)
+
+    def write(self, rows: list[list]):
+        for r in rows:
+            self.ws.append(r)
+
+    def close(self):
+        self.wb.save(self.fileobj)
+
+def parse_export_args(args: str) -> dict:
+    """`shipments|benefits [from YYYY-MM-DD] [to YYYY-MM-DD] [status=arrived] [csv|xlsx]`"""
+    tokens = (args or "").split()
+    if not tokens or tokens[0] not in EXPORT_TABLES:
+        raise ValueError("Укажите таблицу: shipments или benefits.")
+    spec = {"table": tokens[0], "fmt": "csv", "since": None, "until": None, "status": None}
+    dates = []
+    for tok in tokens[1:]:
+        if tok in ("csv", "xlsx"):
+            spec["fmt"] = tok
+        elif tok.startswith("status="):
+            if spec["table"] != "shipments" or tok[7:] not in STATUS_OPTIONS:
+                raise ValueError("Статус: " + ", ".join(STATUS_OPTIONS) + " (только для shipments).")
+            spec["status"] = STATUS_OPTIONS[tok[7:]]
+        else:
+            try:
+                dates.append(datetime.strptime(tok, "%Y-%m-%d").date())
+            except ValueError:
+                raise ValueError(f"Не понял «{tok}»: даты в формате ГГГГ-ММ-ДД.")
+    if len(dates) > 2:
+        raise ValueError("Не больше двух дат: начало и конец периода.")
+    spec["since"], spec["until"] = (dates + [None, None])[:2]
+    return spec
+
+def format_export_spec(spec: dict) -> str:
+    parts = [EXPORT_TABLES[spec["table"]][0], spec["fmt"].upper()]
+    if spec["since"] and spec["until"]:
+        parts.append(f"{spec['since']} — {spec['until']}")
+    elif spec["since"] or spec["until"]:
+        parts.append(f"с {spec['since']}" if spec["since"] else f"по {spec['until']}")
+    if spec["status"]:
+        parts.append(spec["status"])
+    return " • ".join(parts)
+
+@timed
+async def export_table(spec: dict, fileobj, on_progress=None) -> int:
+    """Write the matching rows newest first; returns the row count."""
+    columns = EXPORT_TABLES[spec["table"]][1]
+    repo = EXPORT_REPOS[spec["table"]]
+    sink = await asyncio.to_thread(_XlsxSink if spec["fmt"] == "xlsx" else _CsvSink, fileobj, columns)
+    written, cursor = 0, None
+    while True:
+        rows = await repo.export_page(", ".join(columns), cursor, EXPORT_PAGE,
+                                      spec["since"], spec["until"], spec["status"])
+        if rows:
+            await asyncio.to_thread(sink.write, [[r.get(c) for c in columns] for r in rows])
+            written += len(rows)
+            if on_progress:
+                await on_progress(written)
+        if len(rows) < EXPORT_PAGE:
+            break
+        cursor = encode_cursor(rows[-1])
+    await asyncio.to_thread(sink.close)
+    return written
+
+async def run_export(chat_id: int, spec: dict):
+    progress = await bot.send_message(chat_id, f"⏳ Экспорт: {format_export_spec(spec)}…")
+    last_edit = time.monotonic()
+
+    async def on_progress(n: int):
+        nonlocal last_edit
+        if time.monotonic() - last_edit >= EXPORT_PROGRESS_EVERY:
+            last_edit = time.monotonic()
+            try:
+                await progress.edit_text(f"⏳ Экспорт: {format_export_spec(spec)}\nВыгружено строк: {n}…")
+            except Exception as e:
+                print("export progress error:", e)
+
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES) as tmp:
+        try:
+            n = await export_table(spec, tmp, on_progress)
+            size = tmp.seek(0, io.SEEK_END)
+            if not n:
+                await progress.edit_text("Нет строк для выгрузки."); return
+            if size > EXPORT_MAX_BYTES:
+                await progress.edit_text("Файл больше 50 МБ — сузьте период или выберите CSV."); return
+            name = f"{spec['table']}_{datetime.now(timezone.utc):%Y%m%d-%H%M}.{spec['fmt']}"
+            await bot.send_document(chat_id, SpooledInputFile(tmp, name),
+                                    caption=f"{format_export_spec(spec)} • строк: {n}")
+        except Exception as e:
+            print("export error:", e)
+            await progress.edit_text(f"Ошибка экспорта: {e}"); return
+    await progress.edit_text(f"✅ Экспорт готов: {n} строк.")
+
+def start_export(admin_id: int, chat_id: int, spec: dict) -> bool:
+    """Runs in the background so the admin's chat stays responsive; one per admin."""
+    if admin_id in EXPORT_TASKS:
+        return False
+    task = asyncio.create_task(run_export(chat_id, spec))
+    EXPORT_TASKS[admin_id] = task
+    task.add_done_callback(lambda _t: EXPORT_TASKS.pop(admin_id, None))
+    return True
+
+async def stop_exports():
+    tasks = list(EXPORT_TASKS.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# ---------- Bulk status update ----------
+BULK_STATUS_CHUNK = 200    # codes per UPDATE ... WHERE tracking_code IN (...)
+BULK_STATUS_MAX = 5000
+
+def parse_codes_text(text: str) -> list[str]:
+    """Codes from pasted text: any mix of newlines, spaces, commas, semicolons."""
+    return [c for c in re.split(r"[\s,;]+", text or "") if c]
+
+async def read_upload_codes(reader: UploadReader) -> list[str]:
+    """Tracking codes from the file's tracking-code column (the first one without a header)."""
+    codes = []
+    async for rows in reader.batches():
+        col = reader.header["tracking_code"] if reader.header else 0
+        codes += [row[col] for _, row in rows if col < len(row) and row[col]]
+    return codes
+
+@timed
+async def bulk_set_status(codes: list[str], status: str) -> tuple[int, int, list[str]]:
+    """Set `status` on all codes, one round trip per chunk; returns (updated, unchanged, not_found)."""
+    found: set[str] = set()
+    unchanged: set[str] = set()
+    for i in range(0, len(codes), BULK_STATUS_CHUNK):
+        chunk = codes[i:i + BULK_STATUS_CHUNK]
+        rows = await shipments_repo.set_status_many(chunk, status)
+        invalidate_tracking(rows)
+        await notify_status_change(rows)
+        found.update(r.get("tracking_code") for r in rows)
+        rest = [c for c in chunk if c not in found]
+        if rest:  # already in this status, or no such code
+            unchanged |= await shipments_repo.existing_codes(rest)
+    return len(found), len(unchanged), [c for c in codes if c not in found and c not in unchanged]
 
 # ---------- Benefits (profit) helpers ----------
+@timed
 async def save_benefit_row(admin_id: int, data: dict) -> tuple[bool, str]:
     """
     Expects data = {
@@ -697,7 +2610,7 @@ async def save_benefit_row(admin_id: int, data: dict) -> tuple[bool, str]:
     try:
         # Profit = user_paid - real_cost
         benefit = float(data["user_paid"]) - float(data["real_cost"])
-        supabase_admin.table("order_benefits").insert({
+        await benefits_repo.insert({
             "tg_admin_id": admin_id,
             "whatsapp": data["whatsapp"],
             "ordered": data["ordered"],
@@ -705,7 +2618,8 @@ async def save_benefit_row(admin_id: int, data: dict) -> tuple[bool, str]:
             "real_cost": data["real_cost"],
             "user_paid": data["user_paid"],
             "benefit": benefit,
-        }).execute()
+        })
+        BENEFIT_TOTALS_CACHE.clear()
         return True, f"💾 Сохранено. Прибыль: {benefit:.2f}."
     except Exception as e:
         return False, f"Ошибка сохранения: {e}"
@@ -738,35 +2652,142 @@ def format_benefit_row_line(r: dict) -> str:
         f"{_pad(dt, 19)}"
     )
 
-async def fetch_benefits_page(page: int, page_size: int = BEN_PAGE_SIZE) -> tuple[list[dict], int]:
-    if page < 1:
-        page = 1
-    start = (page - 1) * page_size
-    end = start + page_size - 1
-    res = supabase_admin.table("order_benefits") \
-        .select("id, whatsapp, paid, real_cost, user_paid, benefit, created_at", count="exact") \
-        .order("created_at", desc=True).range(start, end).execute()
-    rows = res.data or []
-    total = res.count or 0
-    return rows, total
-
-async def fetch_benefits_totals() -> tuple[float, float, float]:
+@timed
+async def fetch_benefits_page(cursor: str | None, page_size: int = BEN_PAGE_SIZE) -> tuple[list[dict], str | None]:
+    rows = await benefits_repo.page_after(cursor, page_size + 1)
+    next_cursor = encode_cursor(rows[page_size - 1]) if len(rows) > page_size else None
+    return rows[:page_size], next_cursor
+
+@timed
+async def fetch_benefits_totals() -> tuple[int, float, float, float]:
+    """(rows, real_cost, user_paid, benefit) — the row count doubles as the list total."""
+    cached = BENEFIT_TOTALS_CACHE.get("totals")
+    if cached:
+        return cached
     try:
-        res = supabase_admin.table("order_benefits").select("real_cost, user_paid, benefit").execute()
-        items = res.data or []
-        rc = sum(float(x.get("real_cost") or 0) for x in items)
-        up = sum(float(x.get("user_paid") or 0) for x in items)
-        bf = sum(float(x.get("benefit") or 0) for x in items)
-        return rc, up, bf
+        row = await benefits_repo.totals()
     except Exception as e:
         print("Totals fetch error:", e)
-        return 0.0, 0.0, 0.0
+        return 0, 0.0, 0.0, 0.0
+    totals = (
+        int(row.get("rows") or 0), float(row.get("real_cost") or 0),
+        float(row.get("user_paid") or 0), float(row.get("benefit") or 0),
+    )
+    BENEFIT_TOTALS_CACHE.set("totals", totals)
+    return totals
+
+@timed
+async def fetch_benefits_by_period(period: str) -> list[dict]:
+    key = ("period", period)
+    cached = BENEFIT_TOTALS_CACHE.get(key)
+    if cached is not None:
+        return cached
+    try:
+        rows = await benefits_repo.by_period(period, BEN_PERIOD_ROWS)
+    except Exception as e:
+        print("Period totals fetch error:", e)
+        return []
+    BENEFIT_TOTALS_CACHE.set(key, rows)
+    return rows
+
+@timed
+async def render_benefits_period(period: str) -> tuple[str, InlineKeyboardMarkup]:
+    rows = await fetch_benefits_by_period(period)
+    lines = [
+        f"📅 <b>Прибыль {BEN_PERIODS[period]}</b>\n",
+        "<pre>"
+        f"{_pad('Период', 10)}  {_pad('Зап.', 5)}  {_pad('Реал.', 10)}  {_pad('Оплач.', 10)}  {_pad('Профит', 10)}\n"
+        f"{'-'*53}",
+    ]
+    for r in rows:
+        lines.append(
+            f"{_pad((r.get('period') or '')[:10], 10)}  {_pad(r.get('rows') or 0, 5)}  "
+            f"{_pad(_fmt_money(r.get('real_cost') or 0), 10)}  "
+            f"{_pad(_fmt_money(r.get('user_paid') or 0), 10)}  "
+            f"{_pad(_fmt_money(r.get('benefit') or 0), 10)}"
+        )
+    if not rows:
+        lines.append("Нет данных.")
+    lines.append("</pre>")
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⬅️ К списку", callback_data="admin:benefits")],
+    ])
+    return "\n".join(lines), kb
+
+@timed
+async def fetch_analytics(days: int) -> dict:
+    report = ANALYTICS_CACHE.get(days)
+    if report is None:
+        report, *durations = await asyncio.gather(
+            analytics_repo.report(days),
+            *(events_repo.durations(a, b, days) for a, b in ANALYTICS_TRANSITIONS),
+        )
+        report = dict(report, durations=[dict(d, transition=f"{a} → {b}") for (a, b), d in zip(ANALYTICS_TRANSITIONS, durations)])
+        ANALYTICS_CACHE.set(days, report)
+    return report
+
+def analytics_kb(days: int) -> InlineKeyboardMarkup:
+    periods = [
+        InlineKeyboardButton(text=("• " if d == days else "") + label, callback_data=f"analytics:{d}")
+        for d, label in ANALYTICS_PERIODS.items()
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=[
+        periods,
+        [InlineKeyboardButton(text="🔄 Пересчитать", callback_data=f"analytics:refresh:{days}")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu:admin")],
+    ])
+
+async def render_analytics(days: int) -> tuple[str, InlineKeyboardMarkup]:
+    r = await fetch_analytics(days)
+    esc = html.escape
+    lines = [f"📈 <b>Аналитика за {ANALYTICS_PERIODS[days]}</b>\n", "<pre>", "Сейчас по статусам:"]
+    for row in r.get("status_counts") or []:
+        lines.append(f"  {esc(_pad(row['status'], 14))} {row['n']}")
+    if not r.get("status_counts"):
+        lines.append("  нет данных")
+
+    lines += ["", f"{_pad('Страна', 12)}  {_pad('Новых', 6)}  {_pad('Прибыло', 7)}  {_pad('Дней в пути', 11)}", "-" * 43]
+    for row in r.get("by_country") or []:
+        avg = row.get("avg_transit_days")
+        lines.append(
+            f"{esc(_pad(row['country'], 12))}  {_pad(str(row.get('created') or 0), 6)}  "
+            f"{_pad(str(row.get('arrived') or 0), 7)}  {_pad('—' if avg is None else str(avg), 11)}"
+        )
+    if not r.get("by_country"):
+        lines.append("нет данных")
+
+    req = r.get("requests") or {}
+    approved, rejected = req.get("approved", 0), req.get("rejected", 0)
+    decided = approved + rejected
+    rate = f"{approved / decided * 100:.0f}%" if decided else "—"
+    lines += ["", "Время между статусами (часы):"]
+    for d in r.get("durations") or []:
+        if d.get("n"):
+            lines.append(f"  {esc(d['transition'])}: медиана {d['p50_hours']}, p90 {d['p90_hours']}, "
+                         f"среднее {d['avg_hours']} (n={d['n']})")
+        else:
+            lines.append(f"  {esc(d['transition'])}: нет данных")
+
+    lines += ["", f"Заявки: новых {req.get('created', 0)} • одобрено {approved} • отклонено {rejected} • доля одобренных {rate}"]
 
-async def render_benefits_page(page: int) -> tuple[str, InlineKeyboardMarkup]:
-    rows, total = await fetch_benefits_page(page)
-    rc_sum, up_sum, bf_sum = await fetch_benefits_totals()
+    lines += ["", f"{_pad('Админ', 12)}  {_pad('Зап.', 5)}  {_pad('Профит', 12)}", "-" * 33]
+    for row in r.get("profit") or []:
+        lines.append(
+            f"{_pad(row.get('tg_admin_id') or '—', 12)}  {_pad(str(row.get('rows') or 0), 5)}  "
+            f"{_pad(_fmt_money(row.get('benefit') or 0), 12)}"
+        )
+    if not r.get("profit"):
+        lines.append("нет данных")
+    lines.append("</pre>")
+    return "\n".join(lines), analytics_kb(days)
+
+@timed
+async def render_benefits_page(page: int, cursor: str | None) -> tuple[str, InlineKeyboardMarkup]:
+    (rows, next_cursor), (total, rc_sum, up_sum, bf_sum) = await asyncio.gather(
+        fetch_benefits_page(cursor), fetch_benefits_totals()
+    )
 
-    total_pages = max(1, math.ceil((total or 0) / BEN_PAGE_SIZE))
+    total_pages = max(page, math.ceil((total or 0) / BEN_PAGE_SIZE))
     header = (
         "📊 <b>Учёт прибыли</b>\n"
         f"Страница {page}/{total_pages} • Записей: {total}\n"
@@ -784,7 +2805,7 @@ async def render_benefits_page(page: int) -> tuple[str, InlineKeyboardMarkup]:
     )
 
     body = ""
-    if total:
+    if rows:
         body = "\n".join(format_benefit_row_line(r) for r in rows) + "\n"
 
     table_footer = (
@@ -797,12 +2818,12 @@ async def render_benefits_page(page: int) -> tuple[str, InlineKeyboardMarkup]:
     )
 
     text = header + table_header + body + table_footer
-    kb = ben_list_nav_kb(page, total_pages)
+    kb = ben_list_nav_kb(page, next_cursor)
     return text, kb
 
-async def show_admin_benefits(msg, admin_id: int, page: int):
-    ADMIN_BEN_PAGE[admin_id] = page
-    text, kb = await render_benefits_page(page)
+async def show_admin_benefits(msg, admin_id: int, cursors: list[str | None]):
+    await update_admin_ctx(admin_id, ben=cursors)
+    text, kb = await render_benefits_page(len(cursors), cursors[-1])
     await msg.edit_text(text, reply_markup=kb, parse_mode="HTML")
 
 # ---------- Shipments list (unchanged) ----------
@@ -813,45 +2834,183 @@ def format_ship_row_line(r: dict) -> str:
     c = (r.get("created_at") or "")[:19]
     return f"{tcode} | {s} | {p} | {c}"
 
-async def fetch_shipments_page(page: int, page_size: int = PAGE_SIZE) -> tuple[list[dict], int]:
-    if page < 1:
-        page = 1
-    start = (page - 1) * page_size
-    end = start + page_size - 1
-    res = supabase_admin.table("shipments").select("*", count="exact").order("created_at", desc=True).range(start, end).execute()
-    return (res.data or []), (res.count or 0)
-
-def list_nav_kb(page: int, total_pages: int) -> InlineKeyboardMarkup:
+@timed
+async def fetch_shipments_page(cursor: str | None, page_size: int = PAGE_SIZE) -> tuple[list[dict], str | None]:
+    rows = await shipments_repo.page_after(cursor, page_size + 1)
+    next_cursor = encode_cursor(rows[page_size - 1]) if len(rows) > page_size else None
+    return rows[:page_size], next_cursor
+
+@timed
+async def fetch_shipments_count() -> int:
+    total = LIST_COUNT_CACHE.get("shipments")
+    if total is None:
+        total = await shipments_repo.count_estimate()
+        LIST_COUNT_CACHE.set("shipments", total)
+    return total
+
+def list_nav_kb(page: int, next_cursor: str | None) -> InlineKeyboardMarkup:
     rows = []
     row = []
     if page > 1:
         row.append(InlineKeyboardButton(text="⬅️ Пред.", callback_data="list:prev"))
-    if page < total_pages:
-        row.append(InlineKeyboardButton(text="➡️ След.", callback_data="list:next"))
+    if next_cursor:
+        row.append(InlineKeyboardButton(text="➡️ След.", callback_data=f"list:next:{next_cursor}"))
     if not row:
         row = [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin:list")]
     rows.append(row)
     rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu:admin")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
-async def render_shipments_page(page: int) -> tuple[str, InlineKeyboardMarkup]:
-    rows, total = await fetch_shipments_page(page)
-    if total == 0:
+@timed
+async def render_shipments_page(page: int, cursor: str | None) -> tuple[str, InlineKeyboardMarkup]:
+    (rows, next_cursor), total = await asyncio.gather(fetch_shipments_page(cursor), fetch_shipments_count())
+    if not rows and page == 1:
         kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад", callback_data="menu:admin")]])
         return "Пока нет отправлений.", kb
-    total_pages = max(1, math.ceil(total / PAGE_SIZE))
-    header = f"📄 Все отправления — страница {page}/{total_pages}\nПоказано: {len(rows)} из {total}"
+    total_pages = max(page, math.ceil(total / PAGE_SIZE))
+    header = f"📄 Все отправления — страница {page}/≈{total_pages}\nПоказано: {len(rows)} из ≈{total}"
     lines = [header, "```", "Трек | Статус | Телефон | Создано", "-" * 40]
     for r in rows:
         lines.append(format_ship_row_line(r))
     lines.append("```")
-    return "\n".join(lines), list_nav_kb(page, total_pages)
+    return "\n".join(lines), list_nav_kb(page, next_cursor)
 
-async def show_admin_list(msg, admin_id: int, page: int):
-    ADMIN_LIST_PAGE[admin_id] = page
-    text, kb = await render_shipments_page(page)
+async def show_admin_list(msg, admin_id: int, cursors: list[str | None]):
+    await update_admin_ctx(admin_id, list=cursors)
+    text, kb = await render_shipments_page(len(cursors), cursors[-1])
     await msg.edit_text(text, reply_markup=kb, parse_mode="Markdown")
 
+# ---------- Shipment search ----------
+def shipment_search_text(row: dict) -> str:
+    """Same text the DB indexes (shipment_search_text() in migrations/008)."""
+    return f"{row.get('tracking_code') or ''} {row.get('phone') or ''} {row.get('description') or ''}".lower()
+
+def _trigrams(text: str) -> set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class TrigramIndex:
+    """In-memory stand-in for the search_shipments RPC.
+
+    Same matching rules (substring, or at least 60% of the query's trigrams
+    for typos) and roughly the same order: exact code, code prefix, other
+    substrings, then typo matches by similarity; newest first on ties. Rows
+    must come newest first.
+    """
+
+    FUZZY_MIN_SHARE = 0.6
+    FUZZY_MAX_CANDIDATES = 200_000
+
+    def __init__(self, rows: list[dict]):
+        self.rows = rows
+        self.texts = [shipment_search_text(r) for r in rows]
+        self.postings: dict[str, array] = {}
+        for i, text in enumerate(self.texts):
+            for g in _trigrams(text):
+                p = self.postings.get(g)
+                if p is None:
+                    p = self.postings[g] = array("I")
+                p.append(i)
+        # (code, position) for prefix lookups with bisect
+        self.codes = sorted(((r.get("tracking_code") or "").lower(), i) for i, r in enumerate(rows))
+        self.built = time.monotonic()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def search(self, query: str, limit: int, offset: int = 0) -> list[dict]:
+        q = query.strip().lower()
+        grams = _trigrams(q)
+        if not grams:
+            return []
+        want = offset + limit
+        # Exact code and code prefix first
+        ranked: list[tuple[float, int]] = []
+        lo = bisect.bisect_left(self.codes, (q, -1))
+        for j in range(lo, len(self.codes)):  # islice would walk the list from 0
+            code, i = self.codes[j]
+            if not code.startswith(q):
+                break
+            ranked.append((-4.0 if code == q else -3.0, i))
+        ranked.sort()
+        seen = {i for _, i in ranked}
+        # Other substrings: they contain every trigram of the query, so the shortest
+        # posting list holds them all, in newest-first order; stop once the page is full
+        lists = sorted((self.postings.get(g, ()) for g in grams), key=len)
+        for i in lists[0]:
+            if len(ranked) >= want:
+                break
+            if i not in seen and q in self.texts[i]:
+                ranked.append((-1.0, i))
+                seen.add(i)
+        if len(ranked) < want:
+            # Typos: a row sharing enough trigrams must be in one of the rarest lists
+            needed = math.ceil(len(grams) * self.FUZZY_MIN_SHARE)
+            candidates = set(itertools.chain.from_iterable(lists[:len(grams) - needed + 1])) - seen
+            if len(candidates) <= self.FUZZY_MAX_CANDIDATES:
+                fuzzy = []
+                for i in candidates:
+                    text = self.texts[i]
+                    n = sum(g in text for g in grams)
+                    if n >= needed:
+                        fuzzy.append((-n / len(grams), i))
+                ranked += heapq.nsmallest(want - len(ranked), fuzzy)
+        return [dict(self.rows[i], rank=-score) for score, i in ranked[offset:want]]
+
+_LOCAL_SEARCH_INDEX: TrigramIndex | None = None
+_LOCAL_SEARCH_LOCK = asyncio.Lock()
+
+async def local_search_index() -> TrigramIndex:
+    global _LOCAL_SEARCH_INDEX
+    async with _LOCAL_SEARCH_LOCK:
+        idx = _LOCAL_SEARCH_INDEX
+        if idx is None or time.monotonic() - idx.built > SEARCH_LOCAL_TTL:
+            rows, cursor = [], None
+            while True:
+                page = await shipments_repo.page_after(cursor, 1000)
+                rows += page
+                if len(page) < 1000:
+                    break
+                cursor = encode_cursor(page[-1])
+            idx = _LOCAL_SEARCH_INDEX = await asyncio.to_thread(TrigramIndex, rows)
+    return idx
+
+@timed
+async def search_shipments(query: str, page: int) -> tuple[list[dict], bool]:
+    """One ranked page plus whether another one exists (capped at SEARCH_MAX_PAGES)."""
+    offset = (page - 1) * SEARCH_PAGE_SIZE
+    if SEARCH_BACKEND == "local":
+        rows = (await local_search_index()).search(query, SEARCH_PAGE_SIZE + 1, offset)
+    else:
+        rows = await shipments_repo.search(query, SEARCH_PAGE_SIZE + 1, offset)
+    return rows[:SEARCH_PAGE_SIZE], len(rows) > SEARCH_PAGE_SIZE and page < SEARCH_MAX_PAGES
+
+def search_nav_kb(page: int, has_next: bool) -> InlineKeyboardMarkup:
+    row = []
+    if page > 1:
+        row.append(InlineKeyboardButton(text="⬅️ Пред.", callback_data=f"fsearch:page:{page - 1}"))
+    if has_next:
+        row.append(InlineKeyboardButton(text="➡️ След.", callback_data=f"fsearch:page:{page + 1}"))
+    rows = [row] if row else []
+    rows.append([InlineKeyboardButton(text="🔎 Новый поиск", callback_data="admin:fsearch")])
+    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu:admin")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+async def render_search_page(query: str, page: int) -> tuple[str, InlineKeyboardMarkup]:
+    try:
+        rows, has_next = await search_shipments(query, page)
+    except Exception as e:
+        print("Shipment search error:", e)
+        return "Ошибка поиска. Попробуйте позже.", search_nav_kb(1, False)
+    safe_query = query.replace("`", "'")
+    if not rows:
+        return f"🔎 По запросу ничего не найдено.\n```\n{safe_query}\n```", search_nav_kb(page, False)
+    lines = [f"🔎 Результаты поиска — страница {page}", "```", f"Запрос: {safe_query}",
+             "Трек | Статус | Телефон | Создано", "-" * 40]
+    for r in rows:
+        lines.append(format_ship_row_line(r))
+    lines.append("```")
+    return "\n".join(lines), search_nav_kb(page, has_next)
+
 
 
 
@@ -862,14 +3021,12 @@ async def show_admin_list(msg, admin_id: int, page: int):
 # === Part 4: callback handlers ===
 @dp.message(CommandStart())
 async def on_start(message: Message):
-    user_row = {
+    # No language here: the one LangMiddleware resolved may just be the default after a
+    # failed lookup, and the upsert RPC sets a language only for new users
+    user_writes.upsert({
         "id": message.from_user.id, "username": message.from_user.username,
-        "phone": None, "role": "user", "language": "ru",
-    }
-    try:
-        supabase.table("users").upsert(user_row, on_conflict="id").execute()
-    except Exception as e:
-        print("User upsert error:", e)
+        "phone": None, "role": "user",
+    })
     uid = message.from_user.id
     await message.answer(t(uid, "welcome") + "\n" + t(uid, "menu_title"),
                          reply_markup=main_menu_kb(get_lang(uid)))
@@ -880,17 +3037,16 @@ async def open_menu(message: Message):
     await message.answer(t(uid, "menu_title"), reply_markup=main_menu_kb(get_lang(uid)))
 
 @dp.callback_query(F.data.startswith("menu:"))
-async def handle_menu_callbacks(cb: CallbackQuery):
+async def handle_menu_callbacks(cb: CallbackQuery, lang: str):
     key = cb.data.split(":", 1)[1]
     uid = cb.from_user.id
-    lang = get_lang(uid)
 
     if key == "channels":
         await cb.message.edit_text(t(uid, "channels_title"), reply_markup=channels_kb(lang))
     elif key == "track":
         await cb.message.edit_text(t(uid, "track_how"), reply_markup=track_choice_kb(lang))
     elif key == "calc":
-        CALC_STATE[uid] = "calc_unit"; CALC_DATA[uid] = {}
+        await set_state(uid, "calc", "unit")
         await cb.message.edit_text(t(uid, "calc_intro"), reply_markup=calc_unit_kb(lang))
     elif key == "delivery":
         # FIX: use t() to avoid KeyError with legacy/nonstandard lang codes
@@ -902,17 +3058,8 @@ async def handle_menu_callbacks(cb: CallbackQuery):
     elif key == "lang":
         await cb.message.edit_text(t(uid, "lang_pick"), reply_markup=lang_kb(lang))
     elif key == "warehouse":
-        lang = get_lang(uid)
-        L = LANG.get(lang, LANG["ru"])
-        txt = L["warehouse_text_multi"].format(
-            title=L["warehouse_title_multi"],
-            tj_label=L["warehouse_tj_label"],
-            ru_label=L["warehouse_ru_label"],
-            tj_addr=L["warehouse_tj_address"],
-            ru_addr=L["warehouse_ru_address"],
-        )
         # code fences make it copy-friendly and avoid Markdown parse issues
-        await cb.message.edit_text(txt, parse_mode="Markdown")
+        await cb.message.edit_text(TEXTS[lang]["warehouse_text"], parse_mode="Markdown")
 
     elif key == "admin":
         if uid in ADMIN_IDS:
@@ -920,7 +3067,7 @@ async def handle_menu_callbacks(cb: CallbackQuery):
         else:
             await cb.message.edit_text("⛔ Доступ запрещён. Эта панель только для администраторов.")
     elif key == "req":
-        USER_REQ_STATE[uid] = "req_track"; USER_REQ_DATA[uid] = {}
+        await set_state(uid, "request", "track")
         await cb.message.edit_text("📥 Заявка на добавление отправления.\n\nВведите *трек-код*:", parse_mode="Markdown")
     elif key == "back":
         await cb.message.edit_text(t(uid, "menu_title"), reply_markup=main_menu_kb(lang))
@@ -932,8 +3079,7 @@ async def admin_benefit_start(cb: CallbackQuery):
     uid = cb.from_user.id
     if uid not in ADMIN_IDS:
         await cb.answer("Нет доступа", show_alert=True); return
-    BEN_STATE[uid] = "whatsapp"
-    BEN_DATA[uid] = {}
+    await set_state(uid, "benefit", "whatsapp")
     await cb.message.edit_text(
         "💹 Учёт прибыли.\n\nВведите *WhatsApp клиента* (например, +992xxxxxxxxx или 8xxxxxxxxx):",
         parse_mode="Markdown"
@@ -943,30 +3089,31 @@ async def admin_benefit_start(cb: CallbackQuery):
 @dp.callback_query(F.data.startswith("ben:ordered:"))
 async def ben_ordered_cb(cb: CallbackQuery):
     uid = cb.from_user.id
-    if uid not in ADMIN_IDS or BEN_STATE.get(uid) != "ordered":
+    st = await in_step(uid, "benefit", "ordered")
+    if uid not in ADMIN_IDS or not st:
         await cb.answer(); return
     val = cb.data.split(":")[2]  # yes|no
-    BEN_DATA.setdefault(uid, {})["ordered"] = (val == "yes")
-    BEN_STATE[uid] = "paid"
+    st.data["ordered"] = (val == "yes")
+    await set_state(uid, "benefit", "paid", st.data)
     await cb.message.edit_text("Покупатель оплатил заказ?\nВыберите вариант:", reply_markup=yes_no_kb("ben:paid"))
     await cb.answer()
 
 @dp.callback_query(F.data.startswith("ben:paid:"))
 async def ben_paid_cb(cb: CallbackQuery):
     uid = cb.from_user.id
-    if uid not in ADMIN_IDS or BEN_STATE.get(uid) != "paid":
+    st = await in_step(uid, "benefit", "paid")
+    if uid not in ADMIN_IDS or not st:
         await cb.answer(); return
     val = cb.data.split(":")[2]  # yes|no
-    BEN_DATA.setdefault(uid, {})["paid"] = (val == "yes")
-    BEN_STATE[uid] = "real_cost"
+    st.data["paid"] = (val == "yes")
+    await set_state(uid, "benefit", "real_cost", st.data)
     await cb.message.edit_text("Введите *реальную стоимость товара* (число):", parse_mode="Markdown")
     await cb.answer()
 
 @dp.callback_query(F.data == "ben:cancel")
 async def ben_cancel(cb: CallbackQuery):
     uid = cb.from_user.id
-    BEN_STATE[uid] = None
-    BEN_DATA[uid] = {}
+    await clear_state(uid)
     await cb.message.edit_text("Отменено. Админ-панель:", reply_markup=admin_menu_kb())
     await cb.answer()
 
@@ -977,7 +3124,7 @@ async def set_language(cb: CallbackQuery):
     lang = cb.data.split(":")[2]
     if lang not in LANG:
         await cb.answer("Unsupported", show_alert=True); return
-    set_lang(uid, lang)
+    await set_lang(uid, lang)
     await cb.message.edit_text(
         t(uid, "lang_saved", lang_name=LANG_NAMES.get(lang, lang)) + "\n" + t(uid, "menu_title"),
         reply_markup=main_menu_kb(lang)
@@ -989,7 +3136,7 @@ async def admin_benefits_start(cb: CallbackQuery):
     uid = cb.from_user.id
     if uid not in ADMIN_IDS:
         await cb.answer("Нет доступа", show_alert=True); return
-    await show_admin_benefits(cb.message, uid, page=1)
+    await show_admin_benefits(cb.message, uid, [None])
     await cb.answer()
 
 @dp.callback_query(F.data == "benlist:prev")
@@ -997,39 +3144,79 @@ async def ben_list_prev(cb: CallbackQuery):
     uid = cb.from_user.id
     if uid not in ADMIN_IDS:
         await cb.answer("Нет доступа", show_alert=True); return
-    current = max(2, ADMIN_BEN_PAGE.get(uid, 1))
-    await show_admin_benefits(cb.message, uid, page=current - 1)
+    cursors = (await get_admin_ctx(uid)).get("ben", [None])[:-1] or [None]
+    await show_admin_benefits(cb.message, uid, cursors)
     await cb.answer()
 
-@dp.callback_query(F.data == "benlist:next")
+@dp.callback_query(F.data.startswith("benlist:next:"))
 async def ben_list_next(cb: CallbackQuery):
     uid = cb.from_user.id
     if uid not in ADMIN_IDS:
         await cb.answer("Нет доступа", show_alert=True); return
-    current = max(1, ADMIN_BEN_PAGE.get(uid, 1))
-    await show_admin_benefits(cb.message, uid, page=current + 1)
+    cursor = cb.data.split(":", 2)[2]
+    await show_admin_benefits(cb.message, uid, (await get_admin_ctx(uid)).get("ben", [None]) + [cursor])
+    await cb.answer()
+
+@dp.callback_query(F.data.startswith("benperiod:"))
+async def ben_period(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS:
+        await cb.answer("Нет доступа", show_alert=True); return
+    period = cb.data.split(":", 1)[1]
+    if period not in BEN_PERIODS:
+        await cb.answer(); return
+    text, kb = await render_benefits_period(period)
+    await cb.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
+    await cb.answer()
+
+# Admin analytics (rollup tables)
+@dp.callback_query(F.data.startswith("analytics:"))
+async def admin_analytics(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS:
+        await cb.answer("Нет доступа", show_alert=True); return
+    parts = cb.data.split(":")
+    if parts[1] == "refresh":
+        # Rebuild from the base tables; only needed if a rollup drifted
+        try:
+            await analytics_repo.refresh()
+        except Exception as e:
+            print("analytics refresh error:", e)
+            await cb.answer("Не удалось пересчитать", show_alert=True); return
+        ANALYTICS_CACHE.clear()
+        parts = parts[1:]
+    days = int(parts[1]) if parts[1].isdigit() else 0
+    if days not in ANALYTICS_PERIODS:
+        await cb.answer(); return
+    try:
+        text, kb = await render_analytics(days)
+    except Exception as e:
+        print("analytics error:", e)
+        await cb.answer("Ошибка загрузки аналитики", show_alert=True); return
+    try:
+        await cb.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
+    except TelegramBadRequest:
+        pass  # same period tapped again: message is not modified
     await cb.answer()
 
 # Track flow choice
 @dp.callback_query(F.data == "track:by_code")
 async def track_by_code(cb: CallbackQuery):
-    USER_TRACK_STATE[cb.from_user.id] = True; USER_TRACK_MODE[cb.from_user.id] = "code"
+    await set_state(cb.from_user.id, "track", "query", {"mode": "code"})
     await cb.message.edit_text(t(cb.from_user.id, "track_enter_code"), parse_mode="Markdown"); await cb.answer()
 
 @dp.callback_query(F.data == "track:by_phone")
 async def track_by_phone(cb: CallbackQuery):
-    USER_TRACK_STATE[cb.from_user.id] = True; USER_TRACK_MODE[cb.from_user.id] = "phone"
+    await set_state(cb.from_user.id, "track", "query", {"mode": "phone"})
     await cb.message.edit_text(t(cb.from_user.id, "track_enter_phone"), parse_mode="Markdown"); await cb.answer()
 
 # Calculator unit selection
 @dp.callback_query(F.data == "calc:unit:m")
 async def calc_unit_m(cb: CallbackQuery):
-    u = cb.from_user.id; CALC_STATE[u] = "calc_h"; CALC_DATA.setdefault(u, {})["unit"] = "m"
+    u = cb.from_user.id; await set_state(u, "calc", "h", {"unit": "m"})
     await cb.message.edit_text(t(u, "calc_enter_h_m"), parse_mode="Markdown"); await cb.answer()
 
 @dp.callback_query(F.data == "calc:unit:cm")
 async def calc_unit_cm(cb: CallbackQuery):
-    u = cb.from_user.id; CALC_STATE[u] = "calc_h"; CALC_DATA.setdefault(u, {})["unit"] = "cm"
+    u = cb.from_user.id; await set_state(u, "calc", "h", {"unit": "cm"})
     await cb.message.edit_text(t(u, "calc_enter_h_cm"), parse_mode="Markdown"); await cb.answer()
 
 # Admin: search shortcut
@@ -1039,342 +3226,1274 @@ async def admin_search_start(cb: CallbackQuery):
         await cb.answer("Нет доступа", show_alert=True); return
     await cb.message.edit_text("Как искать отправление?", reply_markup=track_choice_kb(get_lang(cb.from_user.id))); await cb.answer()
 
+# Admin: fuzzy search (partial code, phone digits, description words)
+@dp.callback_query(F.data == "admin:fsearch")
+async def admin_fsearch_start(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS:
+        await cb.answer("Нет доступа", show_alert=True); return
+    await set_state(cb.from_user.id, "admin_search", "query")
+    await cb.message.edit_text(
+        f"🔎 Введите часть трек-кода, последние цифры телефона или слово из описания (от {SEARCH_MIN_CHARS} символов):"
+    ); await cb.answer()
+
+@dp.callback_query(F.data.startswith("fsearch:page:"))
+async def admin_fsearch_page(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS:
+        await cb.answer("Нет доступа", show_alert=True); return
+    query = (await get_admin_ctx(cb.from_user.id)).get("search")
+    if not query:
+        await cb.answer("Поиск устарел, начните заново", show_alert=True); return
+    page = min(max(1, int(cb.data.rsplit(":", 1)[1])), SEARCH_MAX_PAGES)
+    text, kb = await render_search_page(query, page)
+    await cb.message.edit_text(text, reply_markup=kb, parse_mode="Markdown"); await cb.answer()
+
 # Admin: add shipment
 @dp.callback_query(F.data == "admin:add")
 async def admin_add_start(cb: CallbackQuery):
     if cb.from_user.id not in ADMIN_IDS:
         await cb.answer("Нет доступа", show_alert=True); return
-    ADMIN_FLOW_STATE[cb.from_user.id] = "awaiting_tracking"; ADMIN_NEW_SHIPMENT[cb.from_user.id] = {}
+    await set_state(cb.from_user.id, "admin_add", "tracking")
     await cb.message.edit_text("➕ Добавление отправления.\n\nВведите *трек-код* (например, YA123456789):", parse_mode="Markdown")
     await cb.answer()
 
+# Admin: bulk import from a file
+@dp.callback_query(F.data == "admin:import")
+async def admin_import_start(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS:
+        await cb.answer("Нет доступа", show_alert=True); return
+    await set_state(cb.from_user.id, "import", "file")
+    await cb.message.edit_text(
+        "📥 Импорт отправлений.\n\nПришлите файл *CSV* или *XLSX* с колонками:\n"
+        "`tracking_code, phone, description` (или трек, телефон, описание).\n"
+        "Строка заголовков необязательна.",
+        parse_mode="Markdown",
+    )
+    await cb.answer()
+
+# Admin: broadcast to all users
+@dp.callback_query(F.data == "admin:broadcast")
+async def admin_broadcast_start(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS:
+        await cb.answer("Нет доступа", show_alert=True); return
+    if BROADCAST_TASKS:
+        await cb.answer("Уже идёт рассылка — дождитесь её окончания или остановите.", show_alert=True); return
+    await set_state(cb.from_user.id, "broadcast", "ru")
+    await cb.message.edit_text("📣 Рассылка всем пользователям.\n\nПришлите текст на *русском* (он же — по умолчанию):", parse_mode="Markdown")
+    await cb.answer()
+
+@dp.callback_query(F.data == "bcast:cancel")
+async def broadcast_cancel(cb: CallbackQuery):
+    await clear_state(cb.from_user.id)
+    await cb.message.edit_text("Рассылка отменена. Админ-панель:", reply_markup=admin_menu_kb()); await cb.answer()
+
+@dp.callback_query(F.data == "bcast:start")
+async def broadcast_confirm(cb: CallbackQuery):
+    uid = cb.from_user.id
+    if uid not in ADMIN_IDS:
+        await cb.answer("Нет доступа", show_alert=True); return
+    st = await in_step(uid, "broadcast", "confirm")
+    if not st:
+        await cb.answer("Начните заново через «📣 Рассылка».", show_alert=True); return
+    await clear_state(uid)
+    async with _BROADCAST_START_LOCK:  # two confirms at once must not both get past the check
+        if BROADCAST_TASKS:
+            await cb.message.edit_text("Уже идёт рассылка — новая не запущена.", reply_markup=admin_menu_kb())
+            await cb.answer(); return
+        try:
+            total = await users_repo.count_estimate()
+            bc = await broadcasts_repo.create({
+                "created_by": uid, "texts": st.data, "status": "running", "total": total,
+                "last_user_id": 0, "delivered": 0, "blocked": 0, "failed": 0,
+                "progress_msg_id": cb.message.message_id,
+            })
+        except Exception as e:
+            await cb.message.edit_text(f"Ошибка запуска рассылки: {e}", reply_markup=admin_menu_kb()); await cb.answer(); return
+        await cb.message.edit_text(format_broadcast_progress(bc), reply_markup=broadcast_progress_kb(bc["id"]))
+        start_broadcast(bc)
+    await cb.answer("Рассылка запущена")
+
+@dp.callback_query(F.data.startswith("bcast:stop:"))
+async def broadcast_stop(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS:
+        await cb.answer("Нет доступа", show_alert=True); return
+    bc_id = int(cb.data.split(":")[2])
+    try:
+        shown = await stop_broadcast(bc_id)
+    except Exception as e:
+        await cb.answer(f"Ошибка: {e}", show_alert=True); return
+    if not shown:  # not running in this process: at least drop the stop button
+        await cb.message.edit_reply_markup(reply_markup=None)
+    await cb.answer("Рассылка остановлена")
+
 # Admin: change status
 @dp.callback_query(F.data == "admin:status")
 async def admin_status_start(cb: CallbackQuery):
     if cb.from_user.id not in ADMIN_IDS:
         await cb.answer("Нет доступа", show_alert=True); return
-    ADMIN_STATUS_STATE[cb.from_user.id] = "awaiting_status_tracking"; ADMIN_STATUS_TARGET[cb.from_user.id] = ""
+    await set_state(cb.from_user.id, "status", "tracking")
     await cb.message.edit_text("✏️ Изменение статуса.\n\nВведите *трек-код* отправления:", parse_mode="Markdown"); await cb.answer()
 
+# Admin: bulk status by list of codes
+@dp.callback_query(F.data == "admin:bulkstatus")
+async def admin_bulk_status_start(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS:
+        await cb.answer("Нет доступа", show_alert=True); return
+    await set_state(cb.from_user.id, "bulk_status", "codes")
+    await cb.message.edit_text(
+        "🗂 Массовое изменение статуса.\n\nВставьте список трек-кодов (через пробел, запятую или с новой строки) "
+        "или пришлите файл CSV/XLSX — коды в первой колонке."
+    )
+    await cb.answer()
+
+@dp.callback_query(F.data.startswith("bulkstatus:set:"))
+async def bulk_status_set(cb: CallbackQuery):
+    uid = cb.from_user.id
+    if uid not in ADMIN_IDS:
+        await cb.answer("Нет доступа", show_alert=True); return
+    st = await in_step(uid, "bulk_status", "choose")
+    new_status = STATUS_OPTIONS.get(cb.data.split(":", 2)[2])
+    if not st or not new_status:
+        await cb.answer("Начните заново через «🗂 Массовый статус».", show_alert=True); return
+    await clear_state(uid)
+    codes = st.data["codes"]
+    await cb.message.edit_text(f"⏳ Обновляю {len(codes)} трек-кодов…")
+    try:
+        updated, unchanged, missing = await bulk_set_status(codes, new_status)
+    except Exception as e:
+        await cb.message.edit_text(f"Ошибка обновления статуса: {e}", reply_markup=admin_menu_kb()); await cb.answer(); return
+    text = f"✅ Статус «{new_status}» установлен: {updated} из {len(codes)}."
+    if unchanged:
+        text += f"\nУже были в этом статусе: {unchanged}."
+    if missing:
+        shown = missing[:50]
+        text += f"\n❗ Не найдено ({len(missing)}):\n" + "\n".join(shown)
+        if len(missing) > len(shown):
+            text += f"\n… и ещё {len(missing) - len(shown)}"
+    await cb.message.edit_text(text, reply_markup=admin_menu_kb())
+    await cb.answer()
+
 @dp.callback_query(F.data == "status:cancel")
 async def status_cancel(cb: CallbackQuery):
-    u = cb.from_user.id; ADMIN_STATUS_STATE[u] = None; ADMIN_STATUS_TARGET[u] = ""
+    await clear_state(cb.from_user.id)
     await cb.message.edit_text("Отменено. Админ-панель:", reply_markup=admin_menu_kb()); await cb.answer()
 
 @dp.callback_query(F.data.startswith("status:set:"))
 async def status_set(cb: CallbackQuery):
     if cb.from_user.id not in ADMIN_IDS:
         await cb.answer("Нет доступа", show_alert=True); return
-    tracking = ADMIN_STATUS_TARGET.get(cb.from_user.id)
+    st = await in_step(cb.from_user.id, "status", "choose")
+    tracking = st.data.get("tracking") if st else None
     if not tracking:
         await cb.answer("Не выбран трек-код. Начните заново через «✏️ Изменить статус».", show_alert=True); return
     key = cb.data.split(":", 2)[2]; new_status = STATUS_OPTIONS.get(key)
     if not new_status:
         await cb.answer("Неизвестный статус.", show_alert=True); return
     try:
-        upd = supabase_admin.table("shipments").update({"status": new_status}).eq("tracking_code", tracking).execute()
-        if upd.data:
+        upd = await shipments_repo.set_status(tracking, new_status)
+        invalidate_tracking(upd)
+        await notify_status_change(upd)
+        if upd:
             await cb.message.edit_text(f"✅ Статус обновлён.\nТрек: *{tracking}*\nНовый статус: *{new_status}*", parse_mode="Markdown", reply_markup=admin_menu_kb())
+        elif await shipments_repo.existing_codes([tracking]):
+            await cb.message.edit_text(f"Статус уже «{new_status}», уведомления не отправлялись.\nТрек: {tracking}", reply_markup=admin_menu_kb())
         else:
             await cb.message.edit_text("Не удалось обновить статус. Проверьте трек-код и попробуйте снова.", reply_markup=admin_menu_kb())
     except Exception as e:
         await cb.message.edit_text(f"Ошибка обновления статуса: {e}", reply_markup=admin_menu_kb())
-    ADMIN_STATUS_TARGET[cb.from_user.id] = ""; ADMIN_STATUS_STATE[cb.from_user.id] = None
+    await clear_state(cb.from_user.id)
     await cb.answer()
 
 # Admin: requests review
+async def decide_requests(admin_id: int, req_ids: list[int], approve: bool) -> str:
+    """Approve or reject in one DB call, notify the users; returns a summary line."""
+    if approve:
+        rows = await review_queue.approve(admin_id, req_ids)
+        invalidate_tracking(rows)
+        await notifier.send([
+            (r["user_id"], f"✅ Ваша заявка одобрена!\nТеперь вы можете отслеживать отправление:\nТрек: {r['tracking_code']}\nТелефон: {r['phone']}")
+            for r in rows
+        ])
+        existing = sum(1 for r in rows if not r["shipment_created"])
+        done = f"Подтверждено: {len(rows)} ✅" if len(req_ids) > 1 else "Заявка подтверждена и добавлена в отправления. ✅"
+        if existing:
+            done += f"\nОтправление с таким трек-кодом уже было в базе: {existing}."
+    else:
+        rows = await review_queue.reject(admin_id, req_ids)
+        await notifier.send([(r["user_id"], "❌ Ваша заявка отклонена. Проверьте данные и отправьте снова.") for r in rows])
+        done = f"Отклонено: {len(rows)} ❌" if len(req_ids) > 1 else "Заявка отклонена. ❌"
+    if not rows:
+        return "Заявка не найдена или уже обработана." if len(req_ids) == 1 else "Эти заявки уже обработаны."
+    if len(rows) < len(req_ids):
+        done += f"\nУже обработаны другим админом: {len(req_ids) - len(rows)}."
+    return done
+
+async def show_next_request(cb: CallbackQuery, after: int | None = None, note: str = ""):
+    uid = cb.from_user.id
+    try:
+        req = await review_queue.next(uid, after)
+    except Exception as e:
+        print("Fetch pending request error:", e)
+        req = None
+    prefix = note + "\n\n" if note else ""
+    if not req:
+        await update_admin_ctx(uid, req=None)
+        await cb.message.edit_text(prefix + "Нет новых заявок. 🎉", reply_markup=admin_menu_kb()); return
+    await update_admin_ctx(uid, req=req["id"])
+    try:
+        await cb.message.edit_text(prefix + "Заявка на добавление:\n\n" + format_request_row(req), reply_markup=request_review_kb(req["id"]))
+    except TelegramBadRequest:
+        pass  # the only request left was skipped: message is not modified
+
+async def show_request_batch(cb: CallbackQuery, note: str = ""):
+    uid = cb.from_user.id
+    held = await review_queue.window(uid)
+    if not held:
+        await cb.message.edit_text((note + "\n\n" if note else "") + "Нет новых заявок. 🎉", reply_markup=admin_menu_kb()); return
+    selected = review_queue.selected.setdefault(uid, set())
+    lines = [f"#{r['id']} • {r.get('tracking_code')} • {r.get('phone')} • {r.get('country')}" for r in held.values()]
+    text = (note + "\n\n" if note else "") + f"Заявки ({len(held)}), отметьте нужные:\n\n" + "\n".join(lines)
+    try:
+        await cb.message.edit_text(text, reply_markup=request_batch_kb(list(held.values()), selected))
+    except TelegramBadRequest:
+        pass  # "all" tapped with everything already ticked
+
 @dp.callback_query(F.data == "admin:reqs")
 async def admin_reqs(cb: CallbackQuery):
     if cb.from_user.id not in ADMIN_IDS:
         await cb.answer("Нет доступа", show_alert=True); return
-    req = await get_next_pending_request()
-    if not req:
-        await cb.message.edit_text("Нет новых заявок. 🎉", reply_markup=admin_menu_kb()); await cb.answer(); return
-    ADMIN_REQ_CONTEXT[cb.from_user.id] = req["id"]
-    await cb.message.edit_text("Заявка на добавление:\n\n" + format_request_row(req), reply_markup=request_review_kb(req["id"]))
+    await show_next_request(cb)
     await cb.answer()
 
 @dp.callback_query(F.data == "req:next")
 async def req_next(cb: CallbackQuery):
     if cb.from_user.id not in ADMIN_IDS:
         await cb.answer("Нет доступа", show_alert=True); return
-    req = await get_next_pending_request()
-    if not req:
-        await cb.message.edit_text("Нет новых заявок. 🎉", reply_markup=admin_menu_kb()); await cb.answer(); return
-    ADMIN_REQ_CONTEXT[cb.from_user.id] = req["id"]
-    await cb.message.edit_text("Заявка на добавление:\n\n" + format_request_row(req), reply_markup=request_review_kb(req["id"]))
+    await show_next_request(cb, after=(await get_admin_ctx(cb.from_user.id)).get("req"))
     await cb.answer()
 
-@dp.callback_query(F.data.startswith("req:approve:"))
-async def req_approve(cb: CallbackQuery):
+@dp.callback_query(F.data.startswith("req:approve:") | F.data.startswith("req:reject:"))
+async def req_decide(cb: CallbackQuery):
     if cb.from_user.id not in ADMIN_IDS:
         await cb.answer("Нет доступа", show_alert=True); return
-    req_id = int(cb.data.split(":")[2])
+    _, action, req_id = cb.data.split(":")
+    after = review_queue.before(cb.from_user.id, int(req_id))
     try:
-        r = supabase_admin.table("shipment_requests").select("*").eq("id", req_id).limit(1).execute()
-        req = (r.data or [None])[0]
-        if not req or req.get("status") != "pending":
-            await cb.message.edit_text("Заявка не найдена или уже обработана.", reply_markup=admin_menu_kb()); await cb.answer(); return
+        note = await decide_requests(cb.from_user.id, [int(req_id)], approve=action == "approve")
     except Exception as e:
-        await cb.message.edit_text(f"Ошибка загрузки заявки: {e}", reply_markup=admin_menu_kb()); await cb.answer(); return
+        what = "подтверждения" if action == "approve" else "отклонения"
+        await cb.message.edit_text(f"Ошибка {what}: {e}", reply_markup=admin_menu_kb()); await cb.answer(); return
+    await show_next_request(cb, after=after, note=note)
+    await cb.answer()
+
+@dp.callback_query(F.data == "req:batch")
+async def req_batch(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS:
+        await cb.answer("Нет доступа", show_alert=True); return
     try:
-        supabase_admin.table("shipments").insert({
-            "tracking_code": req["tracking_code"], "phone": req["phone"],
-            "description": f"Страна: {req['country']}", "status": "В пути", "image_url": None,
-        }).execute()
-        supabase_admin.table("shipment_requests").update({"status": "approved"}).eq("id", req_id).execute()
+        await show_request_batch(cb)
     except Exception as e:
-        await cb.message.edit_text(f"Ошибка подтверждения: {e}", reply_markup=admin_menu_kb()); await cb.answer(); return
+        await cb.message.edit_text(f"Ошибка загрузки заявок: {e}", reply_markup=admin_menu_kb())
+    await cb.answer()
+
+@dp.callback_query(F.data.startswith("req:pick:"))
+async def req_pick(cb: CallbackQuery):
+    uid = cb.from_user.id
+    if uid not in ADMIN_IDS:
+        await cb.answer("Нет доступа", show_alert=True); return
+    held = review_queue.held.get(uid, {})
+    selected = review_queue.selected.setdefault(uid, set())
+    key = cb.data.split(":")[2]
+    if key == "all":
+        selected.update(held)
+    elif int(key) in selected:
+        selected.discard(int(key))
+    elif int(key) in held:
+        selected.add(int(key))
     try:
-        await bot.send_message(req["user_id"], f"✅ Ваша заявка одобрена!\nТеперь вы можете отслеживать отправление:\nТрек: {req['tracking_code']}\nТелефон: {req['phone']}")
-    except Exception:
-        pass
-    await cb.message.edit_text("Заявка подтверждена и добавлена в отправления. ✅", reply_markup=admin_menu_kb()); await cb.answer()
+        await show_request_batch(cb)
+    except Exception as e:
+        await cb.message.edit_text(f"Ошибка загрузки заявок: {e}", reply_markup=admin_menu_kb())
+    await cb.answer()
 
-@dp.callback_query(F.data.startswith("req:reject:"))
-async def req_reject(cb: CallbackQuery):
-    if cb.from_user.id not in ADMIN_IDS:
+@dp.callback_query(F.data.in_({"req:batch:approve", "req:batch:reject"}))
+async def req_batch_decide(cb: CallbackQuery):
+    uid = cb.from_user.id
+    if uid not in ADMIN_IDS:
         await cb.answer("Нет доступа", show_alert=True); return
-    req_id = int(cb.data.split(":")[2])
+    ids = sorted(review_queue.selected.get(uid, ()))
+    if not ids:
+        await cb.answer("Ничего не выбрано", show_alert=True); return
+    approve = cb.data.endswith("approve")
     try:
-        supabase_admin.table("shipment_requests").update({"status": "rejected"}).eq("id", req_id).execute()
+        note = await decide_requests(uid, ids, approve=approve)
+        await show_request_batch(cb, note=note)
     except Exception as e:
-        await cb.message.edit_text(f"Ошибка отклонения: {e}", reply_markup=admin_menu_kb()); await cb.answer(); return
+        what = "подтверждения" if approve else "отклонения"
+        await cb.message.edit_text(f"Ошибка {what}: {e}", reply_markup=admin_menu_kb())
+    await cb.answer()
+
+@dp.callback_query(F.data == "req:leave")
+async def req_leave(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS:
+        await cb.answer("Нет доступа", show_alert=True); return
+    await review_queue.release(cb.from_user.id)  # let other admins take the rest of the window now
+    await update_admin_ctx(cb.from_user.id, req=None)
+    await cb.message.edit_text("Админ-панель: выберите действие.", reply_markup=admin_menu_kb()); await cb.answer()
+
+@dp.message(Command("cachestats"))
+async def cache_stats(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    s = TRACK_CACHE_STATS
+    w = user_writes.stats
+    lookups = s["hits"] + s["misses"]
+    ratio = (s["hits"] / lookups * 100) if lookups else 0.0
+    await message.answer(
+        "🧮 Кэш отслеживания\n"
+        f"Попаданий: {s['hits']} • Промахов (запросов в БД): {s['misses']} • {ratio:.1f}% из кэша\n"
+        f"Сбросов: {s['invalidations']} • Записей: {len(TRACK_CACHE)}/{TRACK_CACHE_SIZE} • "
+        f"Общих запросов: {s['coalesced']}\n"
+        f"Антифлуд: отклонено {THROTTLE_STATS['dropped']} • повторов {THROTTLE_STATS['coalesced']}\n"
+        f"Языки в кэше: {len(USER_LANG_CACHE)}\n"
+        f"Буфер пользователей: в очереди {len(user_writes)} • записано {w['rows']} за {w['flushes']} сбросов "
+        f"(склеено {w['coalesced']}, ошибок {w['errors']}) • сброс {w['last_flush_ms']:.0f} мс, макс {w['max_flush_ms']:.0f} мс"
+    )
+
+# Admin export: /export shipments 2025-01-01 2025-01-31 status=arrived xlsx
+EXPORT_HELP = (
+    "📤 Экспорт в файл.\n\n"
+    "Вся таблица — кнопками ниже. С фильтром — командой:\n"
+    "/export shipments [ГГГГ-ММ-ДД] [ГГГГ-ММ-ДД] [status=in_transit|arrived|warehouse] [csv|xlsx]\n"
+    "/export benefits [ГГГГ-ММ-ДД] [ГГГГ-ММ-ДД] [csv|xlsx]"
+)
+
+@dp.message(Command("export"))
+async def export_command(message: Message):
+    uid = message.from_user.id
+    if uid not in ADMIN_IDS:
+        return
     try:
-        r = supabase_admin.table("shipment_requests").select("user_id").eq("id", req_id).limit(1).execute()
-        req_user = (r.data or [None])[0]
-        if req_user:
-            await bot.send_message(req_user["user_id"], "❌ Ваша заявка отклонена. Проверьте данные и отправьте снова.")
-    except Exception:
-        pass
-    await cb.message.edit_text("Заявка отклонена. ❌", reply_markup=admin_menu_kb()); await cb.answer()
+        spec = parse_export_args(message.text.partition(" ")[2])
+    except ValueError as e:
+        await message.answer(f"{e}\n\n{EXPORT_HELP}"); return
+    if not start_export(uid, message.chat.id, spec):
+        await message.answer("Экспорт уже идёт, дождитесь файла.")
+
+@dp.callback_query(F.data == "admin:export")
+async def admin_export_menu(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS:
+        await cb.answer("Нет доступа", show_alert=True); return
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Отправления CSV", callback_data="export:shipments:csv"),
+         InlineKeyboardButton(text="Отправления XLSX", callback_data="export:shipments:xlsx")],
+        [InlineKeyboardButton(text="Benefits CSV", callback_data="export:benefits:csv"),
+         InlineKeyboardButton(text="Benefits XLSX", callback_data="export:benefits:xlsx")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu:admin")],
+    ])
+    await cb.message.edit_text(EXPORT_HELP, reply_markup=kb); await cb.answer()
+
+@dp.callback_query(F.data.startswith("export:"))
+async def admin_export_run(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS:
+        await cb.answer("Нет доступа", show_alert=True); return
+    _, table, fmt = cb.data.split(":")
+    spec = parse_export_args(f"{table} {fmt}")
+    if not start_export(cb.from_user.id, cb.message.chat.id, spec):
+        await cb.answer("Экспорт уже идёт", show_alert=True); return
+    await cb.answer("Экспорт запущен")
 
 # Admin list/pagination
 @dp.callback_query(F.data == "admin:list")
 async def admin_list_start(cb: CallbackQuery):
     if cb.from_user.id not in ADMIN_IDS:
         await cb.answer("Нет доступа", show_alert=True); return
-    await show_admin_list(cb.message, cb.from_user.id, page=1); await cb.answer()
+    await show_admin_list(cb.message, cb.from_user.id, [None]); await cb.answer()
 
 @dp.callback_query(F.data == "list:prev")
 async def admin_list_prev(cb: CallbackQuery):
     if cb.from_user.id not in ADMIN_IDS:
         await cb.answer("Нет доступа", show_alert=True); return
-    current = max(2, ADMIN_LIST_PAGE.get(cb.from_user.id, 1))
-    await show_admin_list(cb.message, cb.from_user.id, page=current - 1); await cb.answer()
+    cursors = (await get_admin_ctx(cb.from_user.id)).get("list", [None])[:-1] or [None]
+    await show_admin_list(cb.message, cb.from_user.id, cursors); await cb.answer()
 
-@dp.callback_query(F.data == "list:next")
+@dp.callback_query(F.data.startswith("list:next:"))
 async def admin_list_next(cb: CallbackQuery):
     if cb.from_user.id not in ADMIN_IDS:
         await cb.answer("Нет доступа", show_alert=True); return
-    current = max(1, ADMIN_LIST_PAGE.get(cb.from_user.id, 1))
-    await show_admin_list(cb.message, cb.from_user.id, page=current + 1); await cb.answer()
+    cursor = cb.data.split(":", 2)[2]
+    await show_admin_list(cb.message, cb.from_user.id, (await get_admin_ctx(cb.from_user.id)).get("list", [None]) + [cursor]); await cb.answer()
 
 
 ##############################################################
 ##############################################################
 
 # === Part 5: message router + runner ===
+# Text input is dispatched on the user's (flow, step) with one dict lookup,
+# however many flows exist. Handlers get (message, state, lang).
+FLOW_HANDLERS: dict[tuple[str, str], object] = {}
+ADMIN_FLOWS: set[str] = set()
+
+def flow_step(flow: str, step: str, admin: bool = False):
+    def register(fn):
+        FLOW_HANDLERS[(flow, step)] = fn
+        if admin:
+            ADMIN_FLOWS.add(flow)
+        return fn
+    return register
+
 @dp.message()
-async def message_router(message: Message):
+async def message_router(message: Message, lang: str):
     uid = message.from_user.id
-    lang = get_lang(uid)
-
-    # Admin add shipment — step 1: tracking
-    if uid in ADMIN_IDS and ADMIN_FLOW_STATE.get(uid) == "awaiting_tracking":
-        tracking = (message.text or "").strip()
-        if not tracking or len(tracking) < 5:
-            await message.answer("Трек-код слишком короткий."); return
-        ADMIN_NEW_SHIPMENT[uid]["tracking_code"] = tracking
-        ADMIN_FLOW_STATE[uid] = "awaiting_phone"
-        await message.answer("📞 Введите *номер телефона* клиента:", parse_mode="Markdown")
+    st = await get_state(uid)
+    if st is None:
         return
-
-    # Step 2: phone
-    if uid in ADMIN_IDS and ADMIN_FLOW_STATE.get(uid) == "awaiting_phone":
-        phone_raw = (message.text or "").strip()
-        phone = normalize_phone(phone_raw)
-        if not PHONE_RE.match(phone):
-            await message.answer("Неверный формат телефона."); return
-        ADMIN_NEW_SHIPMENT[uid]["phone"] = phone
-        ADMIN_FLOW_STATE[uid] = "awaiting_description"
-        await message.answer("📝 Введите *краткое описание*:", parse_mode="Markdown")
+    handler = FLOW_HANDLERS.get((st.flow, st.step))
+    if handler is None or (st.flow in ADMIN_FLOWS and uid not in ADMIN_IDS):
         return
+    h = METRICS.histogram("bot_flow_seconds", (("flow", st.flow), ("step", st.step)))
+    await measured(h, handler.__name__, handler, message, st, lang)
 
-    # Step 3: description -> save
-    if uid in ADMIN_IDS and ADMIN_FLOW_STATE.get(uid) == "awaiting_description":
-        desc = (message.text or "").strip()
-        if len(desc) < 3:
-            await message.answer("Описание слишком короткое."); return
-        ADMIN_NEW_SHIPMENT[uid]["description"] = desc
-        ok, msg = await save_shipment_to_db(ADMIN_NEW_SHIPMENT[uid])
-        ADMIN_FLOW_STATE[uid] = None; ADMIN_NEW_SHIPMENT[uid] = {}
-        await message.answer(msg)
-        await message.answer("Админ-панель:", reply_markup=admin_menu_kb())
-        return
-
-    # Admin change status: ask tracking
-    if uid in ADMIN_IDS and ADMIN_STATUS_STATE.get(uid) == "awaiting_status_tracking":
-        tracking = (message.text or "").strip()
-        if not tracking or len(tracking) < 5:
-            await message.answer("Трек-код слишком короткий."); return
+# Admin add shipment — step 1: tracking
+@flow_step("admin_add", "tracking", admin=True)
+async def admin_add_tracking(message: Message, st: UserState, lang: str):
+    uid = message.from_user.id
+    tracking = (message.text or "").strip()
+    if not tracking or len(tracking) < 5:
+        await message.answer("Трек-код слишком короткий."); return
+    st.data["tracking_code"] = tracking
+    await set_state(uid, "admin_add", "phone", st.data)
+    await message.answer("📞 Введите *номер телефона* клиента:", parse_mode="Markdown")
+
+# Step 2: phone
+@flow_step("admin_add", "phone", admin=True)
+async def admin_add_phone(message: Message, st: UserState, lang: str):
+    uid = message.from_user.id
+    phone_raw = (message.text or "").strip()
+    phone = normalize_phone(phone_raw)
+    if not PHONE_RE.match(phone):
+        await message.answer("Неверный формат телефона."); return
+    st.data["phone"] = phone
+    await set_state(uid, "admin_add", "description", st.data)
+    await message.answer("📝 Введите *краткое описание*:", parse_mode="Markdown")
+
+# Step 3: description -> save
+@flow_step("admin_add", "description", admin=True)
+async def admin_add_description(message: Message, st: UserState, lang: str):
+    uid = message.from_user.id
+    desc = (message.text or "").strip()
+    if len(desc) < 3:
+        await message.answer("Описание слишком короткое."); return
+    st.data["description"] = desc
+    ok, msg = await save_shipment_to_db(st.data)
+    await clear_state(uid)
+    await message.answer(msg)
+    await message.answer("Админ-панель:", reply_markup=admin_menu_kb())
+
+# Admin bulk import: uploaded document
+@flow_step("import", "file", admin=True)
+async def admin_import_file(message: Message, st: UserState, lang: str):
+    uid = message.from_user.id
+    doc = message.document
+    if not doc or not (doc.file_name or "").lower().endswith((".csv", ".txt", ".xlsx", ".xlsm")):
+        await message.answer("Пришлите файл .csv или .xlsx."); return
+    if (doc.file_size or 0) > IMPORT_MAX_BYTES:
+        await message.answer("Файл больше 20 МБ — разбейте его на части."); return
+    await clear_state(uid)
+    progress = await message.answer("⏳ Импортирую…")
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as tmp:
         try:
-            res = supabase_admin.table("shipments").select("id, tracking_code, status")\
-                .eq("tracking_code", tracking).limit(1).execute()
-            if not res.data:
-                await message.answer("❗ Не найдено."); return
+            await bot.download(doc, destination=tmp)
+            stats = await import_shipments(UploadReader(tmp, doc.file_name))
         except Exception as e:
-            await message.answer(f"Ошибка: {e}"); return
-        ADMIN_STATUS_TARGET[uid] = tracking
-        ADMIN_STATUS_STATE[uid] = None
-        await message.answer(
-            f"Текущий статус: {res.data[0].get('status') or '—'}\nВыберите новый статус:",
-            reply_markup=status_choice_kb()
-        )
-        return
+            await progress.edit_text(f"Ошибка импорта: {e}", reply_markup=admin_menu_kb()); return
+    await progress.edit_text(format_import_summary(stats), reply_markup=admin_menu_kb())
 
-    # User request flow
-    if USER_REQ_STATE.get(uid) == "req_track":
-        tracking = (message.text or "").strip()
-        if not tracking or len(tracking) < 5:
-            await message.answer("Трек-код слишком короткий."); return
-        USER_REQ_DATA.setdefault(uid, {})["tracking_code"] = tracking
-        USER_REQ_STATE[uid] = "req_phone_code"
-        await message.answer("Выберите код страны:", reply_markup=phone_code_kb())
+# Admin bulk status: list of codes (text or file)
+@flow_step("bulk_status", "codes", admin=True)
+async def admin_bulk_status_codes(message: Message, st: UserState, lang: str):
+    uid = message.from_user.id
+    doc = message.document
+    if doc:
+        if (doc.file_size or 0) > IMPORT_MAX_BYTES:
+            await message.answer("Файл больше 20 МБ — разбейте его на части."); return
+        with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as tmp:
+            try:
+                await bot.download(doc, destination=tmp)
+                codes = await read_upload_codes(UploadReader(tmp, doc.file_name or ""))
+            except Exception as e:
+                await message.answer(f"Не удалось прочитать файл: {e}"); return
+    else:
+        codes = parse_codes_text(message.text or "")
+    codes = list(dict.fromkeys(codes))  # de-duplicate, keep order
+    if not codes:
+        await message.answer("Не нашёл трек-кодов. Пришлите список ещё раз."); return
+    if len(codes) > BULK_STATUS_MAX:
+        await message.answer(f"Слишком много кодов ({len(codes)}). Максимум {BULK_STATUS_MAX} за раз."); return
+    await set_state(uid, "bulk_status", "choose", {"codes": codes})
+    await message.answer(f"Получено трек-кодов: {len(codes)}.\nВыберите новый статус:", reply_markup=bulk_status_kb())
+
+# Admin broadcast: one text per language, "-" reuses the Russian one
+BROADCAST_NEXT = {"ru": ("en", "English"), "en": ("tj", "тоҷикӣ"), "tj": ("confirm", None)}
+
+@flow_step("broadcast", "ru", admin=True)
+@flow_step("broadcast", "en", admin=True)
+@flow_step("broadcast", "tj", admin=True)
+async def admin_broadcast_text(message: Message, st: UserState, lang: str):
+    uid = message.from_user.id
+    text = (message.text or "").strip()
+    if not text or (st.step == "ru" and text == "-"):
+        await message.answer("Пришлите текст сообщения."); return
+    if text != "-":
+        st.data[st.step] = text
+    nxt, name = BROADCAST_NEXT[st.step]
+    await set_state(uid, "broadcast", nxt, st.data)
+    if nxt != "confirm":
+        await message.answer(f"Текст на языке «{name}» (или «-», чтобы отправить русский):")
         return
+    try:
+        total = await users_repo.count_estimate()
+    except Exception:
+        total = "?"
+    preview = "\n\n".join(f"— {LANG_NAMES[k]}:\n{v}" for k, v in st.data.items())
+    await message.answer(f"Предпросмотр:\n\n{preview}\n\nПолучателей: ~{total}. Запустить?", reply_markup=broadcast_confirm_kb())
 
-    if USER_REQ_STATE.get(uid) == "req_phone_code_custom":
-        code = (message.text or "").strip()
-        if not code.startswith("+") or not re.sub(r"\D", "", code):
-            await message.answer("Неверный код."); return
-        USER_REQ_DATA.setdefault(uid, {})["phone_code"] = code
-        USER_REQ_STATE[uid] = "req_phone_local"
-        await message.answer(f"Код выбран: {code}\nВведите номер без кода:")
-        return
+# Admin change status: ask tracking
+@flow_step("status", "tracking", admin=True)
+async def admin_status_tracking(message: Message, st: UserState, lang: str):
+    uid = message.from_user.id
+    tracking = (message.text or "").strip()
+    if not tracking or len(tracking) < 5:
+        await message.answer("Трек-код слишком короткий."); return
+    try:
+        row = await shipments_repo.get_by_code(tracking, "id, tracking_code, status")
+        if not row:
+            await message.answer("❗ Не найдено."); return
+    except Exception as e:
+        await message.answer(f"Ошибка: {e}"); return
+    await set_state(uid, "status", "choose", {"tracking": tracking})
+    await message.answer(
+        f"Текущий статус: {row.get('status') or '—'}\nВыберите новый статус:",
+        reply_markup=status_choice_kb()
+    )
 
-    if USER_REQ_STATE.get(uid) == "req_phone_local":
-        local = (message.text or "").strip().replace(" ", "").replace("-", "")
-        code = USER_REQ_DATA[uid].get("phone_code", "")
-        full = normalize_phone(code + local)
-        if not PHONE_RE.match(full):
-            await message.answer("Неверный телефон."); return
-        USER_REQ_DATA[uid]["phone"] = full
-        USER_REQ_STATE[uid] = "req_country"
-        await message.answer("Выберите страну:", reply_markup=country_kb())
-        return
+# User request flow
+@flow_step("request", "track")
+async def request_track(message: Message, st: UserState, lang: str):
+    uid = message.from_user.id
+    tracking = (message.text or "").strip()
+    if not tracking or len(tracking) < 5:
+        await message.answer("Трек-код слишком короткий."); return
+    st.data["tracking_code"] = tracking
+    await set_state(uid, "request", "phone_code", st.data)
+    await message.answer("Выберите код страны:", reply_markup=phone_code_kb())
+
+@flow_step("request", "phone_code_custom")
+async def request_phone_code_custom(message: Message, st: UserState, lang: str):
+    uid = message.from_user.id
+    code = (message.text or "").strip()
+    if not code.startswith("+") or not re.sub(r"\D", "", code):
+        await message.answer("Неверный код."); return
+    st.data["phone_code"] = code
+    await set_state(uid, "request", "phone_local", st.data)
+    await message.answer(f"Код выбран: {code}\nВведите номер без кода:")
+
+@flow_step("request", "phone_local")
+async def request_phone_local(message: Message, st: UserState, lang: str):
+    uid = message.from_user.id
+    local = (message.text or "").strip().replace(" ", "").replace("-", "")
+    code = st.data.get("phone_code", "")
+    full = normalize_phone(code + local)
+    if not PHONE_RE.match(full):
+        await message.answer("Неверный телефон."); return
+    st.data["phone"] = full
+    await set_state(uid, "request", "country", st.data)
+    await message.answer("Выберите страну:", reply_markup=country_kb())
+
+@flow_step("request", "country_custom")
+async def request_country_custom(message: Message, st: UserState, lang: str):
+    uid = message.from_user.id
+    country = (message.text or "").strip()
+    if len(country) < 2:
+        await message.answer("Слишком короткое название."); return
+    st.data["country"] = country
+    await clear_state(uid)
+    try:
+        await requests_repo.create({
+            "user_id": uid,
+            "tracking_code": st.data["tracking_code"],
+            "phone": st.data["phone"],
+            "country": st.data["country"],
+        })
+    except Exception as e:
+        await message.answer(f"Ошибка: {e}"); return
+    await message.answer("✅ Заявка отправлена.")
+    await message.answer(t(uid, "menu_title"), reply_markup=main_menu_kb(lang))
+
+# Calculator: height / width / length
+async def _calc_dimension(message: Message, st: UserState, lang: str, key: str, dim_key: str) -> float | None:
+    v = _parse_pos_float(message.text or "")
+    if v is None:
+        uid = message.from_user.id
+        unit = TEXTS[lang]["unit_m"] if st.data.get("unit") == "m" else TEXTS[lang]["unit_cm"]
+        await message.answer(t(uid, "calc_invalid_value_unit", dimension=t(uid, dim_key), unit=unit))
+        return None
+    st.data[key] = v
+    return v
 
-    if USER_REQ_STATE.get(uid) == "req_country_custom":
-        country = (message.text or "").strip()
-        if len(country) < 2:
-            await message.answer("Слишком короткое название."); return
-        USER_REQ_DATA[uid]["country"] = country
-        try:
-            supabase_admin.table("shipment_requests").insert({
-                "user_id": uid,
-                "tracking_code": USER_REQ_DATA[uid]["tracking_code"],
-                "phone": USER_REQ_DATA[uid]["phone"],
-                "country": USER_REQ_DATA[uid]["country"],
-            }).execute()
-        except Exception as e:
-            await message.answer(f"Ошибка: {e}")
-            USER_REQ_STATE[uid] = None; USER_REQ_DATA[uid] = {}; return
-        USER_REQ_STATE[uid] = None; USER_REQ_DATA[uid] = {}
-        await message.answer("✅ Заявка отправлена.")
-        await message.answer(t(uid, "menu_title"), reply_markup=main_menu_kb(lang))
+@flow_step("calc", "h")
+async def calc_height(message: Message, st: UserState, lang: str):
+    uid = message.from_user.id
+    if await _calc_dimension(message, st, lang, "h", "dim_height") is None:
         return
+    await set_state(uid, "calc", "w", st.data)
+    await message.answer(t(uid, "calc_enter_w_unit", unit_phrase=t(uid, f"unit_phrase_{st.data['unit']}")), parse_mode="Markdown")
 
-    # Calculator: height
-    if CALC_STATE.get(uid) == "calc_h":
-        v = _parse_pos_float(message.text or "")
-        if v is None:
-            unit = LANG[lang]["unit_m"] if CALC_DATA.get(uid, {}).get("unit") == "m" else LANG[lang]["unit_cm"]
-            await message.answer(t(uid, "calc_invalid_value_unit", dimension=t(uid, "dim_height"), unit=unit)); return
-        CALC_DATA[uid]["h"] = v
-        CALC_STATE[uid] = "calc_w"
-        await message.answer(t(uid, "calc_enter_w_unit", unit_phrase=t(uid, f"unit_phrase_{CALC_DATA[uid]['unit']}")), parse_mode="Markdown")
+@flow_step("calc", "w")
+async def calc_width(message: Message, st: UserState, lang: str):
+    uid = message.from_user.id
+    if await _calc_dimension(message, st, lang, "w", "dim_width") is None:
         return
+    await set_state(uid, "calc", "l", st.data)
+    await message.answer(t(uid, "calc_enter_l_unit", unit_phrase=t(uid, f"unit_phrase_{st.data['unit']}")), parse_mode="Markdown")
 
-    # Calculator: width
-    if CALC_STATE.get(uid) == "calc_w":
-        v = _parse_pos_float(message.text or "")
-        if v is None:
-            unit = LANG[lang]["unit_m"] if CALC_DATA[uid]["unit"] == "m" else LANG[lang]["unit_cm"]
-            await message.answer(t(uid, "calc_invalid_value_unit", dimension=t(uid, "dim_width"), unit=unit)); return
-        CALC_DATA[uid]["w"] = v
-        CALC_STATE[uid] = "calc_l"
-        await message.answer(t(uid, "calc_enter_l_unit", unit_phrase=t(uid, f"unit_phrase_{CALC_DATA[uid]['unit']}")), parse_mode="Markdown")
+@flow_step("calc", "l")
+async def calc_length(message: Message, st: UserState, lang: str):
+    uid = message.from_user.id
+    if await _calc_dimension(message, st, lang, "l", "dim_length") is None:
         return
-
-    # Calculator: length
-    if CALC_STATE.get(uid) == "calc_l":
-        v = _parse_pos_float(message.text or "")
-        if v is None:
-            unit = LANG[lang]["unit_m"] if CALC_DATA[uid]["unit"] == "m" else LANG[lang]["unit_cm"]
-            await message.answer(t(uid, "calc_invalid_value_unit", dimension=t(uid, "dim_length"), unit=unit)); return
-        CALC_DATA[uid]["l"] = v
-        h, w, l_ = CALC_DATA[uid]["h"], CALC_DATA[uid]["w"], CALC_DATA[uid]["l"]
-        if CALC_DATA[uid]["unit"] == "cm":
-            h, w, l_ = h/100, w/100, l_/100
-        volume = h * w * l_
-        CALC_STATE[uid] = None; CALC_DATA[uid] = {}
-        await message.answer(t(uid, "calc_result", volume=volume), parse_mode="Markdown",
-                             reply_markup=calc_again_kb(lang))
+    h, w, l_ = st.data["h"], st.data["w"], st.data["l"]
+    if st.data["unit"] == "cm":
+        h, w, l_ = h/100, w/100, l_/100
+    volume = h * w * l_
+    await clear_state(uid)
+    await message.answer(t(uid, "calc_result", volume=volume), parse_mode="Markdown",
+                         reply_markup=calc_again_kb(lang))
+
+# Admin benefit flow
+@flow_step("benefit", "whatsapp", admin=True)
+async def benefit_whatsapp(message: Message, st: UserState, lang: str):
+    uid = message.from_user.id
+    wa = (message.text or "").strip()
+    if not re.search(r"\d", wa):
+        await message.answer("Неверный формат WhatsApp."); return
+    st.data["whatsapp"] = wa
+    await set_state(uid, "benefit", "ordered", st.data)
+    await message.answer("Покупатель оформил заказ?", reply_markup=yes_no_kb("ben:ordered"))
+
+@flow_step("benefit", "real_cost", admin=True)
+async def benefit_real_cost(message: Message, st: UserState, lang: str):
+    uid = message.from_user.id
+    val = _parse_pos_float(message.text or "")
+    if val is None:
+        await message.answer("Введите корректное число."); return
+    st.data["real_cost"] = float(val)
+    await set_state(uid, "benefit", "user_paid", st.data)
+    await message.answer("Введите сумму, которую оплатил покупатель:")
+
+@flow_step("benefit", "user_paid", admin=True)
+async def benefit_user_paid(message: Message, st: UserState, lang: str):
+    uid = message.from_user.id
+    val = _parse_pos_float(message.text or "")
+    if val is None:
+        await message.answer("Введите корректное число."); return
+    st.data["user_paid"] = float(val)
+    await clear_state(uid)
+    ok, msg = await save_benefit_row(uid, st.data)
+    await message.answer(msg, reply_markup=benefit_menu_btn_kb())
+
+# Tracking search flow
+@flow_step("admin_search", "query", admin=True)
+async def admin_search_query(message: Message, st: UserState, lang: str):
+    uid = message.from_user.id
+    query = (message.text or "").strip()
+    if len(query) < SEARCH_MIN_CHARS:
+        await message.answer(f"Слишком короткий запрос (минимум {SEARCH_MIN_CHARS} символа)."); return
+    await clear_state(uid)
+    await update_admin_ctx(uid, search=query)
+    text, kb = await render_search_page(query, 1)
+    await message.answer(text, reply_markup=kb, parse_mode="Markdown")
+
+@flow_step("track", "query")
+async def track_query(message: Message, st: UserState, lang: str):
+    uid = message.from_user.id
+    query = (message.text or "").strip()
+    if not query:
+        await message.answer("Пустой запрос."); return
+    await clear_state(uid)
+    results = await find_shipments(query, st.data.get("mode"))
+    if not results:
+        await message.answer(t(uid, "search_none"))
+        await message.answer(t(uid, "search_again"), reply_markup=track_choice_kb(lang))
         return
+    # Several matches (a phone search): current status only, the history is for a single shipment
+    for text in chunk_blocks([format_shipment_row(r, timeline=len(results) == 1) for r in results]):
+        await message.answer(text)
+    await message.answer(t(uid, "search_again"), reply_markup=track_choice_kb(lang))
+
+# ===== Scheduled jobs =====
+SCHEDULER_ENABLED = os.getenv("SCHEDULER", "1") != "0"
+PENDING_REMIND_CRON = os.getenv("PENDING_REMIND_CRON", "0 6,14 * * *")  # UTC
+PENDING_REMIND_AFTER_H = float(os.getenv("PENDING_REMIND_AFTER_H", "24"))
+STATE_PRUNE_INTERVAL = float(os.getenv("STATE_PRUNE_INTERVAL", "600"))
+# Refresh just before the caches expire so admins never wait on these queries
+CACHE_WARM_INTERVAL = float(os.getenv("CACHE_WARM_INTERVAL", str(0.8 * min(BEN_TOTALS_TTL, LIST_COUNT_TTL))))
+
+def _cron_field(spec: str, lo: int, hi: int) -> frozenset[int]:
+    values = set()
+    for part in spec.split(","):
+        rng, _, step = part.partition("/")
+        if rng == "*":
+            a, b = lo, hi
+        elif "-" in rng:
+            a, b = map(int, rng.split("-", 1))
+        else:
+            a = int(rng)
+            b = hi if step else a  # "5/15" = from 5 every 15
+        if not lo <= a <= b <= hi:
+            raise ValueError(f"cron field out of range: {part}")
+        values.update(range(a, b + 1, int(step or 1)))
+    return frozenset(values)
+
+class Cron:
+    """Five-field cron schedule in UTC: minute hour day-of-month month day-of-week (0 = Sunday).
+    Unlike classic cron, a restricted day-of-month and day-of-week must both match."""
+
+    def __init__(self, spec: str):
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron needs 5 fields: {spec!r}")
+        ranges = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+        self.minute, self.hour, self.dom, self.month, self.dow = (
+            _cron_field(f, lo, hi) for f, (lo, hi) in zip(fields, ranges)
+        )
+        self.spec = spec
+
+    def next_after(self, ts: datetime) -> datetime:
+        t = ts.astimezone(timezone.utc).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = t + timedelta(days=366 * 4)
+        while t < limit:
+            if t.month not in self.month:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif t.day not in self.dom or t.isoweekday() % 7 not in self.dow:
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hour:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minute:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f"cron never fires: {self.spec!r}")
 
-    # Admin benefit flow
-    if uid in ADMIN_IDS and BEN_STATE.get(uid) == "whatsapp":
-        wa = (message.text or "").strip()
-        if not re.search(r"\d", wa):
-            await message.answer("Неверный формат WhatsApp."); return
-        BEN_DATA.setdefault(uid, {})["whatsapp"] = wa
-        BEN_STATE[uid] = "ordered"
-        await message.answer("Покупатель оформил заказ?", reply_markup=yes_no_kb("ben:ordered"))
-        return
+class Job:
+    __slots__ = ("name", "fn", "every", "cron", "jitter", "lock", "runs", "skipped", "errors")
 
-    if uid in ADMIN_IDS and BEN_STATE.get(uid) == "real_cost":
-        val = _parse_pos_float(message.text or "")
-        if val is None:
-            await message.answer("Введите корректное число."); return
-        BEN_DATA.setdefault(uid, {})["real_cost"] = float(val)
-        BEN_STATE[uid] = "user_paid"
-        await message.answer("Введите сумму, которую оплатил покупатель:")
-        return
+    def __init__(self, name: str, fn, every: float | None = None, cron: Cron | None = None,
+                 jitter: float = 0.0, lock: bool = True):
+        self.name, self.fn, self.every, self.cron, self.jitter, self.lock = name, fn, every, cron, jitter, lock
+        self.runs = self.skipped = self.errors = 0
 
-    if uid in ADMIN_IDS and BEN_STATE.get(uid) == "user_paid":
-        val = _parse_pos_float(message.text or "")
-        if val is None:
-            await message.answer("Введите корректное число."); return
-        BEN_DATA.setdefault(uid, {})["user_paid"] = float(val)
-        ok, msg = await save_benefit_row(uid, BEN_DATA[uid])
-        BEN_STATE[uid] = None; BEN_DATA[uid] = {}
-        await message.answer(msg, reply_markup=benefit_menu_btn_kb())
-        return
+    def next_delay(self) -> float:
+        if self.every:
+            base = self.every
+        else:
+            now = datetime.now(timezone.utc)
+            base = (self.cron.next_after(now) - now).total_seconds()
+        return base + random.uniform(0, self.jitter)
+
+    def lease(self) -> float:
+        """How long a run claims the job: most of the gap to the next run, but past any jitter."""
+        if self.every:
+            return self.every * 0.8
+        slot = self.cron.next_after(datetime.now(timezone.utc))
+        return (self.cron.next_after(slot) - slot).total_seconds() * 0.8
+
+class Scheduler:
+    """Interval and cron jobs on the event loop.
+
+    Jobs with lock=True run in one process only: each run first takes a lease
+    in the DB (migrations/011), so several workers or dynos can all run the
+    scheduler. lock=False jobs touch only the process's own memory and run
+    everywhere.
+    """
 
-    # Tracking search flow
-    if USER_TRACK_STATE.get(uid):
-        query = (message.text or "").strip()
-        if not query:
-            await message.answer("Пустой запрос."); return
-        mode = USER_TRACK_MODE.get(uid)
-        results = await find_shipments(query, mode)
-        USER_TRACK_STATE[uid] = False; USER_TRACK_MODE[uid] = ""
-        if not results:
-            await message.answer(t(uid, "search_none"))
-            await message.answer(t(uid, "search_again"), reply_markup=track_choice_kb(lang))
+    def __init__(self):
+        self.jobs: dict[str, Job] = {}
+        self.tasks: list[asyncio.Task] = []
+        self.owner = f"{os.getpid()}-{os.urandom(3).hex()}"
+
+    def every(self, seconds: float, jitter: float = 0.0, lock: bool = True):
+        def register(fn):
+            self.jobs[fn.__name__] = Job(fn.__name__, fn, every=seconds, jitter=jitter, lock=lock)
+            return fn
+        return register
+
+    def cron(self, spec: str, jitter: float = 0.0, lock: bool = True):
+        def register(fn):
+            self.jobs[fn.__name__] = Job(fn.__name__, fn, cron=Cron(spec), jitter=jitter, lock=lock)
+            return fn
+        return register
+
+    def start(self):
+        if not SCHEDULER_ENABLED:
             return
-        if len(results) == 1:
-            await message.answer(format_shipment_row(results[0]))
-        else:
-            await message.answer("\n\n".join(format_shipment_row(r) for r in results))
-        await message.answer(t(uid, "search_again"), reply_markup=track_choice_kb(lang))
+        self.tasks = [asyncio.create_task(self._loop(job)) for job in self.jobs.values()]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def _loop(self, job: Job):
+        while True:
+            await asyncio.sleep(job.next_delay())
+            await self.run(job)
+
+    async def run(self, job: Job) -> bool:
+        if job.lock:
+            try:
+                if not await job_locks_repo.try_lock(job.name, self.owner, job.lease()):
+                    job.skipped += 1
+                    return False
+            except Exception as e:
+                print(f"job {job.name}: lock error:", e)
+                return False
+        try:
+            await measured(METRICS.histogram("bot_job_seconds", (("job", job.name),)), f"job {job.name}", job.fn)
+            job.runs += 1
+            return True
+        except Exception as e:
+            job.errors += 1
+            print(f"job {job.name} failed:", e)
+            return False
+
+scheduler = Scheduler()
+
+@scheduler.cron(PENDING_REMIND_CRON, jitter=30)
+async def remind_pending_requests():
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=PENDING_REMIND_AFTER_H)
+    n, oldest = await requests_repo.pending_before(cutoff)
+    if not n:
         return
+    text = (
+        f"⏰ Заявок без ответа дольше {PENDING_REMIND_AFTER_H:g} ч: {n}.\n"
+        f"Самая старая: #{oldest['id']} от {(oldest.get('created_at') or '')[:16].replace('T', ' ')} UTC.\n"
+        "Откройте «📝 Заявки» в админ-панели."
+    )
+    await notifier.send([(admin_id, text) for admin_id in ADMIN_IDS])
+
+@scheduler.every(STATE_PRUNE_INTERVAL, jitter=30, lock=False)
+async def prune_local_state():
+    # Abandoned flows and expired cache entries otherwise stay until their key is touched again
+    await STATE_STORAGE.prune()
+    await ADMIN_CONTEXT.prune()
+    TRACK_CACHE.prune()
+    USER_LANG_CACHE.prune()
+
+@scheduler.every(CACHE_WARM_INTERVAL, jitter=10, lock=False)
+async def warm_admin_caches():
+    BENEFIT_TOTALS_CACHE.pop("totals")
+    LIST_COUNT_CACHE.pop("shipments")
+    await asyncio.gather(fetch_benefits_totals(), fetch_shipments_count())
 
 # Runner
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")  # public https://host Telegram can reach
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# Checked against X-Telegram-Bot-Api-Secret-Token. Without one in .env a fresh secret is
+# made per start; set_webhook registers it each time, so the check is never off.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or os.getenv("PORT") or "8080")
+SHUTDOWN_GRACE = float(os.getenv("SHUTDOWN_GRACE", "25"))  # seconds to let in-flight handlers finish
+
+# Tasks currently inside a handler; drained on shutdown in both modes
+IN_FLIGHT: set[asyncio.Task] = set()
+
+class InFlightMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        task = asyncio.current_task()
+        IN_FLIGHT.add(task)
+        try:
+            return await handler(event, data)
+        finally:
+            IN_FLIGHT.discard(task)
+
+dp.update.outer_middleware(InFlightMiddleware())
+METRICS.gauge_fns["bot_updates_in_flight"] = lambda: len(IN_FLIGHT)
+METRICS.gauge_fns["bot_track_cache_entries"] = lambda: len(TRACK_CACHE)
+
+async def log_metrics_forever():
+    while True:
+        await asyncio.sleep(METRICS_LOG_INTERVAL)
+        print("metrics:\n" + (METRICS.summary() or "(no data yet)"))
+
+async def start_metrics_server(port: int = METRICS_PORT) -> web.AppRunner:
+    """Stand-alone /metrics for polling mode (webhook mode serves it on the bot app)."""
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_endpoint)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, port).start()
+    print(f"Metrics on {WEBHOOK_HOST}:{port}/metrics")
+    return runner
+
+async def drain_in_flight(timeout: float = SHUTDOWN_GRACE):
+    pending = {t for t in IN_FLIGHT if t is not asyncio.current_task()}
+    if pending:
+        print(f"Waiting for {len(pending)} in-flight update(s)...")
+        await asyncio.wait(pending, timeout=timeout)
+
+async def stop_background():
+    await scheduler.stop()
+    await stop_exports()
+    await stop_broadcasts()
+    await notifier.stop()
+    await user_writes.stop()
+
+class StrictRequestHandler(SimpleRequestHandler):
+    """aiogram's handler, but a bad secret header is always a 401 and a body
+    that is not a JSON object a 400 (both were 500s)."""
+
+    def verify_secret(self, telegram_secret_token: str, bot: Bot) -> bool:
+        # bytes: compare_digest refuses non-ASCII str
+        return secrets.compare_digest(telegram_secret_token.encode(), self.secret_token.encode())
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.bot):
+            try:
+                raw = json.loads(await request.text())  # aiohttp keeps the body for the second read
+            except ValueError:
+                return web.Response(status=400)
+            if not isinstance(raw, dict):
+                return web.Response(status=400)
+        return await super().handle(request)
+
+def build_webhook_app() -> web.Application:
+    app = web.Application()
+    handler = StrictRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET)
+
+    async def on_shutdown(_app):
+        await drain_in_flight()
+        await stop_background()
+
+    # Registered before the request handler so draining happens before it closes the bot session
+    app.on_shutdown.append(on_shutdown)
+    handler.register(app, path=WEBHOOK_PATH)
+    app.router.add_get("/metrics", metrics_endpoint)
+    setup_application(app, dp, bot=bot)
+    return app
+
+async def run_webhook():
+    if not WEBHOOK_BASE_URL:
+        raise RuntimeError("WEBHOOK_BASE_URL is missing in .env (needed for BOT_MODE=webhook)")
+    runner = web.AppRunner(build_webhook_app())
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await bot.set_webhook(
+        WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    print(f"Webhook listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    # Stops accepting requests, drains handlers, then closes the session.
+    # The webhook stays registered so Telegram queues updates during a redeploy.
+    await runner.cleanup()
+
+async def run_polling():
+    metrics_runner = await start_metrics_server() if METRICS_PORT else None
+    await bot.delete_webhook()  # getUpdates is refused while a webhook is set
+    await dp.start_polling(bot, close_bot_session=False)
+    await drain_in_flight()
+    await stop_background()
+    await bot.session.close()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+
+# ===== Sharded mode (WORKERS > 1) =====
+# One ingress process receives updates (polling or webhook) and forwards the raw
+# JSON to worker processes by chat id, so a chat (and its user's conversation
+# state, caches and write buffer) always lives on the same worker. Workers run
+# the normal dispatcher; updates of one chat are handled strictly in order.
+WORKERS = int(os.getenv("WORKERS", "1"))
+
+def update_chat_id(raw: dict) -> int:
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if key in raw:
+            return raw[key]["chat"]["id"]
+    cq = raw.get("callback_query")
+    if cq:
+        return cq["message"]["chat"]["id"] if cq.get("message") else cq["from"]["id"]
+    for value in raw.values():
+        if isinstance(value, dict):
+            for ref in ("chat", "from", "user"):
+                if isinstance(value.get(ref), dict):
+                    return value[ref]["id"]
+    return raw.get("update_id", 0)
+
+def shard_of(chat_id: int) -> int:
+    return chat_id % WORKERS
+
+class ChatSerializer:
+    """Runs jobs of one chat one after another; different chats run concurrently."""
+
+    def __init__(self):
+        self.queues: dict[int, deque] = {}
+
+    def submit(self, chat_id: int, job):
+        q = self.queues.get(chat_id)
+        if q is not None:
+            q.append(job)
+            return
+        self.queues[chat_id] = deque([job])
+        asyncio.create_task(self._drain(chat_id))
+
+    async def _drain(self, chat_id: int):
+        q = self.queues[chat_id]
+        try:
+            while q:
+                try:
+                    await q.popleft()()
+                except Exception as e:
+                    print(f"chat {chat_id} update failed:", e)
+        finally:
+            del self.queues[chat_id]
+
+    async def join(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        while self.queues and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+class PipeSender:
+    """Sends on a pipe from its own thread: a full pipe (the other end busy)
+    must never block the event loop."""
+
+    def __init__(self, conn, label: str):
+        self.conn = conn
+        self.label = label
+        self.outbox: queue.SimpleQueue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._send_forever, daemon=True)
+        self.thread.start()
+
+    def send(self, msg: tuple):
+        self.outbox.put(msg)
+
+    def close(self):
+        self.outbox.put(None)
+
+    def _send_forever(self):
+        while True:
+            msg = self.outbox.get()
+            if msg is None:
+                return
+            try:
+                self.conn.send(msg)
+            except (BrokenPipeError, OSError) as e:
+                print(f"{self.label} pipe closed:", e)
+                return
+            if msg[0] == "stop":
+                return
+
+class WorkerLink:
+    """Ingress end of one worker's pipe."""
+
+    def __init__(self, index: int, ctx):
+        self.index = index
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=worker_main, args=(index, child), name=f"bot-worker-{index}")
+        self.process.start()
+        child.close()
+        self.sender = PipeSender(self.conn, f"worker {index}")
+
+    def send(self, msg: tuple):
+        self.sender.send(msg)
+
+def worker_main(index: int, conn):
+    # The ingress coordinates shutdown; a platform SIGTERM to the whole group must not kill handlers mid-way
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(run_worker(index, conn))
+
+async def run_worker(index: int, conn):
+    notifier.bucket = TokenBucket(NOTIFY_GLOBAL_RATE / WORKERS)  # the global limit is shared
+    upstream = PipeSender(conn, f"worker {index} -> ingress")
+    TRACK_INVALIDATION_HOOKS.append(lambda keys: upstream.send(("track_invalidate", keys)))
+    # Other shards (notify_status_change on an admin's shard, say) must not keep serving the old language
+    LANG_INVALIDATION_HOOKS.append(lambda user_ids: upstream.send(("lang_invalidate", user_ids)))
+    user_writes.start()
+    # Only worker 0 picks up leftovers, or every worker would resend them
+    await notifier.start(load_outbox=index == 0)
+    scheduler.start()  # locked jobs run on one worker, local ones on each
+    if index == 0:
+        await resume_broadcasts()
+    metrics_runner = await start_metrics_server(METRICS_PORT + 1 + index) if METRICS_PORT else None
+
+    serializer = ChatSerializer()
+    readable = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_reader(conn.fileno(), readable.set)
+    print(f"Worker {index} ready (pid {os.getpid()})")
+    running = True
+    while running:
+        await readable.wait()
+        readable.clear()
+        try:
+            while running and conn.poll():
+                msg = conn.recv()
+                if msg[0] == "update":
+                    raw = json.loads(msg[1])
+                    try:
+                        update = Update.model_validate(raw, context={"bot": bot})
+                    except ValueError as e:  # the ingress only checks that it is JSON
+                        print("bad update dropped:", e)
+                        continue
+                    serializer.submit(update_chat_id(raw), functools.partial(dp.feed_update, bot, update))
+                elif msg[0] == "track_invalidate":
+                    drop_tracking_keys(msg[1])
+                elif msg[0] == "lang_invalidate":
+                    invalidate_lang(msg[1])
+                elif msg[0] == "stop":
+                    running = False
+        except EOFError:  # ingress is gone
+            running = False
+    loop.remove_reader(conn.fileno())
+    await serializer.join(SHUTDOWN_GRACE)
+    await drain_in_flight()
+    await stop_background()
+    upstream.close()
+    await bot.session.close()
+    await STATE_STORAGE.close()
+    await ADMIN_CONTEXT.close()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+
+async def _ingress_polling(route, stop: asyncio.Event):
+    await bot.delete_webhook()
+    allowed = dp.resolve_used_update_types()
+    offset = None
+    stopped = asyncio.create_task(stop.wait())
+    while not stop.is_set():
+        poll = asyncio.create_task(bot.get_updates(offset=offset, timeout=25, allowed_updates=allowed))
+        await asyncio.wait({poll, stopped}, return_when=asyncio.FIRST_COMPLETED)
+        if not poll.done():
+            poll.cancel()
+            break
+        try:
+            updates = poll.result()
+        except Exception as e:
+            print("getUpdates error:", e)
+            await asyncio.sleep(1)
+            continue
+        for u in updates:
+            raw = u.model_dump(mode="json", exclude_none=True, by_alias=True)
+            route(raw, json.dumps(raw, ensure_ascii=False))
+            offset = u.update_id + 1
+    if offset is not None:
+        await bot.get_updates(offset=offset, timeout=0, limit=1)  # acknowledge what was forwarded
+
+async def _ingress_webhook(route, stop: asyncio.Event):
+    if not WEBHOOK_BASE_URL:
+        raise RuntimeError("WEBHOOK_BASE_URL is missing in .env (needed for BOT_MODE=webhook)")
+
+    async def receive(request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not secrets.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            return web.Response(status=401)
+        body = await request.text()
+        try:
+            raw = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(raw, dict):
+            return web.Response(status=400)
+        route(raw, body)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, receive)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await bot.set_webhook(
+        WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    print(f"Webhook ingress on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    await stop.wait()
+    await runner.cleanup()
+
+async def run_sharded():
+    ctx = multiprocessing.get_context("spawn")  # workers build their own loop, clients and sessions
+    links = [WorkerLink(i, ctx) for i in range(WORKERS)]
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+
+    def relay(src: WorkerLink):
+        # Cache invalidations (tracking, language) from one worker are fanned out to the others
+        try:
+            while src.conn.poll():
+                msg = src.conn.recv()
+                for link in links:
+                    if link is not src:
+                        link.send(msg)
+        except (EOFError, OSError):
+            # Its chats would go unanswered; exit so the platform restarts the whole set
+            print(f"worker {src.index} exited, stopping")
+            loop.remove_reader(src.conn.fileno())
+            stop.set()
+
+    for link in links:
+        loop.add_reader(link.conn.fileno(), relay, link)
+
+    def route(raw: dict, body: str):
+        links[shard_of(update_chat_id(raw))].send(("update", body))
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    print(f"Ingress ({BOT_MODE}) routing to {WORKERS} workers")
+    try:
+        if BOT_MODE == "webhook":
+            await _ingress_webhook(route, stop)
+        else:
+            await _ingress_polling(route, stop)
+    finally:
+        for link in links:
+            if link.process.is_alive():
+                loop.remove_reader(link.conn.fileno())
+                link.send(("stop",))
+        for link in links:
+            await asyncio.to_thread(link.process.join, SHUTDOWN_GRACE + 10)
+            if link.process.is_alive():
+                link.process.terminate()
+        await bot.session.close()
+
 async def main():
-    await dp.start_polling(bot)
+    if WORKERS > 1:
+        await run_sharded()
+        await STATE_STORAGE.close()
+        await ADMIN_CONTEXT.close()
+        return
+    user_writes.start()
+    await notifier.start()
+    scheduler.start()
+    await resume_broadcasts()
+    metrics_log = asyncio.create_task(log_metrics_forever()) if METRICS_LOG_INTERVAL > 0 else None
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await run_polling()
+    finally:
+        if metrics_log:
+            metrics_log.cancel()
+        await STATE_STORAGE.close()
+        await ADMIN_CONTEXT.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
-
-
-
@@ -0,0 +1,77 @@
+-- Benefit totals computed in the database instead of summing order_benefits in Python.
+-- Apply in the Supabase SQL editor (or psql) once; safe to re-run.
+
+create index if not exists order_benefits_created_at_id_idx
+    on order_benefits (created_at desc, id desc);
+
+-- One row per (UTC day, admin): week/month breakdowns read at most a few
+-- hundred rows no matter how long the history is.
+create table if not exists order_benefits_daily (
+    day          date    not null,
+    tg_admin_id  bigint  not null default 0,
+    rows         bigint  not null default 0,
+    real_cost    numeric not null default 0,
+    user_paid    numeric not null default 0,
+    benefit      numeric not null default 0,
+    primary key (day, tg_admin_id)
+);
+
+create or replace function order_benefits_daily_apply(
+    p_day date, p_admin bigint, p_sign int,
+    p_real_cost numeric, p_user_paid numeric, p_benefit numeric
+) returns void language sql as $$
+    insert into order_benefits_daily as d (day, tg_admin_id, rows, real_cost, user_paid, benefit)
+    values (p_day, coalesce(p_admin, 0), p_sign,
+            p_sign * coalesce(p_real_cost, 0), p_sign * coalesce(p_user_paid, 0), p_sign * coalesce(p_benefit, 0))
+    on conflict (day, tg_admin_id) do update set
+        rows      = d.rows + excluded.rows,
+        real_cost = d.real_cost + excluded.real_cost,
+        user_paid = d.user_paid + excluded.user_paid,
+        benefit   = d.benefit + excluded.benefit;
+$$;
+
+create or replace function order_benefits_daily_trg() returns trigger language plpgsql as $$
+begin
+    if tg_op in ('UPDATE', 'DELETE') then
+        perform order_benefits_daily_apply((old.created_at at time zone 'utc')::date, old.tg_admin_id, -1,
+                                           old.real_cost, old.user_paid, old.benefit);
+    end if;
+    if tg_op in ('INSERT', 'UPDATE') then
+        perform order_benefits_daily_apply((new.created_at at time zone 'utc')::date, new.tg_admin_id, 1,
+                                           new.real_cost, new.user_paid, new.benefit);
+    end if;
+    return null;
+end $$;
+
+drop trigger if exists order_benefits_daily_trg on order_benefits;
+create trigger order_benefits_daily_trg
+    after insert or update or delete on order_benefits
+    for each row execute function order_benefits_daily_trg();
+
+-- Backfill existing history (one full scan, once).
+truncate order_benefits_daily;
+insert into order_benefits_daily (day, tg_admin_id, rows, real_cost, user_paid, benefit)
+select (created_at at time zone 'utc')::date, coalesce(tg_admin_id, 0), count(*),
+       coalesce(sum(real_cost), 0), coalesce(sum(user_paid), 0), coalesce(sum(benefit), 0)
+from order_benefits
+group by 1, 2;
+
+create or replace function benefits_totals()
+returns table (rows bigint, real_cost numeric, user_paid numeric, benefit numeric)
+language sql stable as $$
+    select coalesce(sum(rows), 0)::bigint, coalesce(sum(real_cost), 0),
+           coalesce(sum(user_paid), 0), coalesce(sum(benefit), 0)
+    from order_benefits_daily;
+$$;
+
+-- p_period: 'day' | 'week' | 'month'; newest buckets first.
+create or replace function benefits_by_period(p_period text, p_limit int default 12)
+returns table (period date, rows bigint, real_cost numeric, user_paid numeric, benefit numeric)
+language sql stable as $$
+    select date_trunc(p_period, day)::date as period, sum(rows)::bigint,
+           sum(real_cost), sum(user_paid), sum(benefit)
+    from order_benefits_daily
+    group by 1
+    order by 1 desc
+    limit p_limit;
+$$;
@@ -0,0 +1,4 @@
+-- Keyset pagination for the admin shipments list: newest first on (created_at, id).
+-- (order_benefits gets the same index in 001_benefit_totals.sql.)
+create index if not exists shipments_created_at_id_idx
+    on shipments (created_at desc, id desc);
@@ -0,0 +1,6 @@
+-- One shipment per tracking code, enforced by the database.
+-- Lets batch imports use INSERT ... ON CONFLICT (tracking_code) DO NOTHING.
+-- If this fails, list existing duplicates first:
+--   select tracking_code, count(*) from shipments group by 1 having count(*) > 1;
+create unique index if not exists shipments_tracking_code_key
+    on shipments (tracking_code);
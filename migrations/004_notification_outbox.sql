@@ -0,0 +1,18 @@
+-- Customer notifications waiting to be sent (written before sending so a
+-- restart does not drop them). Sent/failed rows can be purged at will:
+--   delete from notification_outbox where status <> 'pending' and created_at < now() - interval '30 days';
+create table if not exists notification_outbox (
+    id          bigserial   primary key,
+    chat_id     bigint      not null,
+    text        text        not null,
+    status      text        not null default 'pending',  -- pending | sent | failed
+    error       text,
+    created_at  timestamptz not null default now()
+);
+
+create index if not exists notification_outbox_pending_idx
+    on notification_outbox (id) where status = 'pending';
+
+-- Push notifications look up who asked for a tracking code
+create index if not exists shipment_requests_tracking_code_idx
+    on shipment_requests (tracking_code) where status = 'approved';
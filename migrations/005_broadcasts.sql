@@ -0,0 +1,16 @@
+-- Admin broadcasts. last_user_id is the keyset checkpoint over users.id:
+-- a broadcast left in status 'running' is resumed from it on the next start.
+create table if not exists broadcasts (
+    id               bigserial   primary key,
+    created_by       bigint      not null,
+    texts            jsonb       not null,  -- {"ru": ..., "en": ..., "tj": ...}
+    status           text        not null default 'running',  -- running | done | cancelled
+    total            bigint,
+    last_user_id     bigint      not null default 0,
+    delivered        bigint      not null default 0,
+    blocked          bigint      not null default 0,
+    failed           bigint      not null default 0,
+    progress_msg_id  bigint,
+    created_at       timestamptz not null default now(),
+    finished_at      timestamptz
+);
@@ -0,0 +1,9 @@
+-- Batched language changes from the bot's write-behind buffer:
+-- select set_user_languages('[{"id": 1, "language": "en"}, ...]');
+-- Updates existing users only (same as the per-tap UPDATE it replaces).
+create or replace function set_user_languages(p_rows jsonb)
+returns void language sql as $$
+    update users u set language = x.language
+    from jsonb_to_recordset(p_rows) as x(id bigint, language text)
+    where u.id = x.id;
+$$;
@@ -0,0 +1,46 @@
+-- Admin fuzzy search over shipments: partial tracking codes, the last digits
+-- of a phone, words of the description, small typos.
+--
+-- One trigram GIN index over a single lower-cased text per row serves both
+-- substring matches (LIKE '%q%') and word similarity (q <% text), so the
+-- query never scans the table. Queries shorter than 3 characters have no
+-- trigrams; the bot rejects them before calling the RPC.
+--
+-- Check the plan with:
+--   explain analyze select * from search_shipments('0123', 21, 0);
+-- It should show a Bitmap Index Scan on shipments_search_trgm_idx.
+create extension if not exists pg_trgm;
+
+create or replace function shipment_search_text(p_code text, p_phone text, p_description text)
+returns text language sql immutable parallel safe as $$
+    select lower(coalesce(p_code, '') || ' ' || coalesce(p_phone, '') || ' ' || coalesce(p_description, ''))
+$$;
+
+create index if not exists shipments_search_trgm_idx
+    on shipments using gin (shipment_search_text(tracking_code, phone, description) gin_trgm_ops);
+
+-- Ranked page of matches. Exact code > code prefix > anything else, then by
+-- word similarity, newest first on ties. Offset paging is fine here: the
+-- bot caps the number of pages an admin can flip through.
+create or replace function search_shipments(p_query text, p_limit int default 10, p_offset int default 0)
+returns table (
+    id bigint, tracking_code text, phone text, status text, description text,
+    created_at timestamptz, rank real
+)
+language sql stable as $$
+    with q as (
+        select lower(trim(p_query)) as v,
+               '%' || replace(replace(replace(lower(trim(p_query)), '\', '\\'), '%', '\%'), '_', '\_') || '%' as pat
+    )
+    select s.id::bigint, s.tracking_code::text, s.phone::text, s.status::text, s.description::text,
+           s.created_at::timestamptz,
+           (case when lower(s.tracking_code) = q.v then 3
+                 when lower(s.tracking_code) like ltrim(q.pat, '%') then 2
+                 else 0 end
+            + word_similarity(q.v, shipment_search_text(s.tracking_code, s.phone, s.description)))::real as rank
+    from shipments s, q
+    where shipment_search_text(s.tracking_code, s.phone, s.description) like q.pat
+       or q.v <% shipment_search_text(s.tracking_code, s.phone, s.description)
+    order by rank desc, s.created_at desc, s.id desc
+    limit least(p_limit, 100) offset p_offset
+$$;
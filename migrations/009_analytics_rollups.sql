@@ -0,0 +1,166 @@
+-- Rollups behind the admin "📈 Аналитика" screen. Triggers keep them current
+-- on every write, so a report reads a few hundred small rows instead of
+-- scanning shipments, shipment_requests and order_benefits. Profit per admin
+-- reuses order_benefits_daily from 001_benefit_totals.sql.
+--
+-- refresh_analytics_rollups() rebuilds everything from the base tables; the
+-- migration runs it once, and it is safe to run again (e.g. from a scheduled
+-- job) if a rollup is ever suspected to have drifted.
+
+-- Country as the bot records it: approved requests write "Страна: X" into the description
+create or replace function shipment_country(p_description text)
+returns text language sql immutable parallel safe as $$
+    select coalesce(nullif(trim(substring(p_description from 'Страна:\s*([^,\n]+)')), ''), '—')
+$$;
+
+-- Current number of shipments per (status, country)
+create table if not exists shipment_status_counts (
+    status   text   not null,
+    country  text   not null,
+    n        bigint not null default 0,
+    primary key (status, country)
+);
+
+-- Daily events per country. event: 'created' (by created_at) or the status a
+-- shipment moved to (by the day of the change). transit_seconds sums
+-- created_at -> change, so avg transit for 'Прибыло' = transit_seconds / n.
+create table if not exists shipment_stats_daily (
+    day              date    not null,
+    country          text    not null,
+    event            text    not null,
+    n                bigint  not null default 0,
+    transit_seconds  numeric not null default 0,
+    primary key (day, country, event)
+);
+
+-- Daily request events: 'created', 'approved', 'rejected'
+create table if not exists request_stats_daily (
+    day    date   not null,
+    event  text   not null,
+    n      bigint not null default 0,
+    primary key (day, event)
+);
+
+create or replace function shipment_status_counts_apply(p_status text, p_country text, p_sign int)
+returns void language sql as $$
+    insert into shipment_status_counts as c (status, country, n)
+    values (coalesce(p_status, '—'), p_country, p_sign)
+    on conflict (status, country) do update set n = c.n + excluded.n;
+$$;
+
+create or replace function shipment_stats_daily_apply(p_day date, p_country text, p_event text, p_transit numeric)
+returns void language sql as $$
+    insert into shipment_stats_daily as d (day, country, event, n, transit_seconds)
+    values (p_day, p_country, p_event, 1, coalesce(p_transit, 0))
+    on conflict (day, country, event) do update set
+        n = d.n + 1,
+        transit_seconds = d.transit_seconds + excluded.transit_seconds;
+$$;
+
+create or replace function request_stats_daily_apply(p_day date, p_event text)
+returns void language sql as $$
+    insert into request_stats_daily as d (day, event, n)
+    values (p_day, p_event, 1)
+    on conflict (day, event) do update set n = d.n + 1;
+$$;
+
+create or replace function shipments_rollup_trg() returns trigger language plpgsql as $$
+begin
+    if tg_op in ('UPDATE', 'DELETE') then
+        perform shipment_status_counts_apply(old.status, shipment_country(old.description), -1);
+    end if;
+    if tg_op in ('INSERT', 'UPDATE') then
+        perform shipment_status_counts_apply(new.status, shipment_country(new.description), 1);
+    end if;
+    if tg_op = 'INSERT' then
+        perform shipment_stats_daily_apply((new.created_at at time zone 'utc')::date,
+                                           shipment_country(new.description), 'created', 0);
+    elsif tg_op = 'UPDATE' and new.status is distinct from old.status then
+        perform shipment_stats_daily_apply((now() at time zone 'utc')::date, shipment_country(new.description),
+                                           coalesce(new.status, '—'),
+                                           extract(epoch from now() - new.created_at));
+    end if;
+    return null;
+end $$;
+
+drop trigger if exists shipments_rollup_trg on shipments;
+create trigger shipments_rollup_trg
+    after insert or update of status, description or delete on shipments
+    for each row execute function shipments_rollup_trg();
+
+create or replace function requests_rollup_trg() returns trigger language plpgsql as $$
+begin
+    if tg_op = 'INSERT' then
+        perform request_stats_daily_apply((new.created_at at time zone 'utc')::date, 'created');
+    elsif new.status is distinct from old.status and new.status in ('approved', 'rejected') then
+        perform request_stats_daily_apply((now() at time zone 'utc')::date, new.status);
+    end if;
+    return null;
+end $$;
+
+drop trigger if exists requests_rollup_trg on shipment_requests;
+create trigger requests_rollup_trg
+    after insert or update of status on shipment_requests
+    for each row execute function requests_rollup_trg();
+
+-- Full rebuild. Status changes made before this migration have no timestamp,
+-- so history only contributes 'created' events and the current status counts;
+-- approvals/rejections are dated by the request's created_at.
+create or replace function refresh_analytics_rollups() returns void language plpgsql as $$
+begin
+    lock table shipment_status_counts, shipment_stats_daily, request_stats_daily in exclusive mode;
+
+    delete from shipment_status_counts;
+    insert into shipment_status_counts (status, country, n)
+    select coalesce(status, '—'), shipment_country(description), count(*)
+    from shipments group by 1, 2;
+
+    delete from shipment_stats_daily where event = 'created';
+    insert into shipment_stats_daily (day, country, event, n)
+    select (created_at at time zone 'utc')::date, shipment_country(description), 'created', count(*)
+    from shipments group by 1, 2;
+
+    delete from request_stats_daily;
+    insert into request_stats_daily (day, event, n)
+    select (created_at at time zone 'utc')::date, 'created', count(*) from shipment_requests group by 1
+    union all
+    select (created_at at time zone 'utc')::date, status, count(*) from shipment_requests
+    where status in ('approved', 'rejected') group by 1, 2;
+end $$;
+
+select refresh_analytics_rollups();
+
+-- Everything the dashboard shows for the last p_days days, in one round trip.
+create or replace function analytics_report(p_days int default 7)
+returns json language sql stable as $$
+    with since as (select ((now() at time zone 'utc')::date - (p_days - 1)) as day)
+    select json_build_object(
+        'status_counts', (
+            select coalesce(json_agg(x order by x.n desc), '[]') from (
+                select status, sum(n)::bigint as n from shipment_status_counts group by status having sum(n) > 0
+            ) x),
+        'by_country', (
+            select coalesce(json_agg(x order by x.created desc, x.country), '[]') from (
+                select d.country,
+                       sum(n) filter (where event = 'created')::bigint as created,
+                       sum(n) filter (where event = 'Прибыло')::bigint as arrived,
+                       round(sum(transit_seconds) filter (where event = 'Прибыло')
+                             / nullif(sum(n) filter (where event = 'Прибыло'), 0) / 86400, 1) as avg_transit_days
+                from shipment_stats_daily d, since
+                where d.day >= since.day
+                group by d.country
+            ) x),
+        'requests', (
+            select coalesce(json_object_agg(event, n), '{}') from (
+                select event, sum(n)::bigint as n from request_stats_daily, since
+                where request_stats_daily.day >= since.day group by event
+            ) x),
+        'profit', (
+            select coalesce(json_agg(x order by x.benefit desc), '[]') from (
+                select tg_admin_id, sum(rows)::bigint as rows, sum(benefit) as benefit
+                from order_benefits_daily, since
+                where order_benefits_daily.day >= since.day
+                group by tg_admin_id
+            ) x)
+    );
+$$;
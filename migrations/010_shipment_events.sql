@@ -0,0 +1,64 @@
+-- Append-only status history. A row trigger on shipments writes the event in
+-- the same transaction as the insert or status change, so every write path
+-- (admin add, approve RPC, import, single and bulk status updates) is covered
+-- and history can never disagree with shipments.status.
+create table if not exists shipment_events (
+    id           bigserial   primary key,
+    shipment_id  bigint      not null references shipments (id) on delete cascade,
+    status       text        not null,
+    created_at   timestamptz not null default now()
+);
+
+-- Timeline of one shipment (embedded in the tracking lookup), newest first
+create index if not exists shipment_events_shipment_idx
+    on shipment_events (shipment_id, created_at desc);
+-- "Reached status X in the last N days" for status_durations()
+create index if not exists shipment_events_status_idx
+    on shipment_events (status, created_at);
+
+create or replace function shipment_events_trg() returns trigger language plpgsql as $$
+begin
+    if tg_op = 'INSERT' or new.status is distinct from old.status then
+        insert into shipment_events (shipment_id, status) values (new.id, coalesce(new.status, '—'));
+    end if;
+    return null;
+end $$;
+
+drop trigger if exists shipment_events_trg on shipments;
+create trigger shipment_events_trg
+    after insert or update of status on shipments
+    for each row execute function shipment_events_trg();
+
+-- Backfill: earlier status changes were never recorded, so existing shipments
+-- start with one event (their current status, dated at creation).
+insert into shipment_events (shipment_id, status, created_at)
+select s.id, coalesce(s.status, '—'), s.created_at
+from shipments s
+where not exists (select 1 from shipment_events e where e.shipment_id = s.id);
+
+-- Time from first reaching p_from to first reaching p_to, for shipments that
+-- reached p_to in the last p_days days. Hours.
+create or replace function status_durations(p_from text, p_to text, p_days int default 30)
+returns table (n bigint, avg_hours numeric, p50_hours numeric, p90_hours numeric)
+language sql stable as $$
+    with reached as (
+        select distinct on (e.shipment_id) e.shipment_id, e.created_at
+        from shipment_events e
+        where e.status = p_to and e.created_at >= now() - make_interval(days => p_days)
+        order by e.shipment_id, e.created_at
+    ), spans as (
+        select extract(epoch from r.created_at - f.created_at) / 3600 as hours
+        from reached r
+        join lateral (
+            select f.created_at from shipment_events f
+            where f.shipment_id = r.shipment_id and f.status = p_from and f.created_at <= r.created_at
+            order by f.created_at
+            limit 1
+        ) f on true
+    )
+    select count(*)::bigint,
+           round(avg(hours)::numeric, 1),
+           round((percentile_cont(0.5) within group (order by hours))::numeric, 1),
+           round((percentile_cont(0.9) within group (order by hours))::numeric, 1)
+    from spans;
+$$;
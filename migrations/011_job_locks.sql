@@ -0,0 +1,21 @@
+-- Leases for scheduled jobs: with several bot processes (WORKERS > 1 or more
+-- than one dyno) each job's run is claimed by exactly one of them. A lease is
+-- kept after the run finishes, so a process whose timer fires a little later
+-- (jitter, clock drift) sees the slot as taken and skips it.
+create table if not exists job_locks (
+    name          text        primary key,
+    owner         text        not null,
+    locked_until  timestamptz not null,
+    last_run_at   timestamptz not null
+);
+
+-- true if p_owner got the lease, null if another process holds it
+create or replace function try_job_lock(p_name text, p_owner text, p_lease_seconds double precision)
+returns boolean language sql as $$
+    insert into job_locks as j (name, owner, locked_until, last_run_at)
+    values (p_name, p_owner, now() + make_interval(secs => p_lease_seconds), now())
+    on conflict (name) do update set
+        owner = excluded.owner, locked_until = excluded.locked_until, last_run_at = excluded.last_run_at
+    where j.locked_until <= now()
+    returning true;
+$$;
@@ -0,0 +1,77 @@
+-- Review queue for pending shipment requests. Each admin claims a window of
+-- the oldest pending requests with a lease; until it runs out nobody else is
+-- offered them, so two admins never review the same request. Claimed rows
+-- stay status = 'pending': an abandoned claim simply expires, no sweep needed,
+-- and the reminder job and analytics keep counting them as pending.
+alter table shipment_requests
+    add column if not exists claimed_by    bigint,
+    add column if not exists claimed_until timestamptz;
+
+-- Oldest-first scan of the queue
+create index if not exists shipment_requests_pending_idx
+    on shipment_requests (created_at, id) where status = 'pending';
+
+-- Claim (or renew) up to p_limit of the oldest pending requests that are free
+-- or already held by p_admin. SKIP LOCKED lets concurrent claims pass each
+-- other instead of queueing on the same rows.
+create or replace function claim_pending_requests(p_admin bigint, p_limit int, p_lease_seconds double precision)
+returns setof shipment_requests language sql as $$
+    with c as (
+        select id from shipment_requests
+        where status = 'pending'
+          and (claimed_by is null or claimed_by = p_admin or claimed_until <= now())
+        order by created_at, id
+        limit least(p_limit, 50)
+        for update skip locked
+    )
+    update shipment_requests sr
+    set claimed_by = p_admin, claimed_until = now() + make_interval(secs => p_lease_seconds)
+    from c
+    where sr.id = c.id
+    returning sr.*;
+$$;
+
+-- Give back claims an admin no longer needs (left the queue)
+create or replace function release_request_claims(p_admin bigint, p_req_ids bigint[])
+returns void language sql as $$
+    update shipment_requests set claimed_by = null, claimed_until = null
+    where id = any(p_req_ids) and claimed_by = p_admin and status = 'pending';
+$$;
+
+-- Approve every request in p_req_ids that is still pending and not under
+-- someone else's live claim, and create the shipments, all in one statement
+-- (ON CONFLICT needs migration 003). Requests sharing a tracking code create
+-- one shipment; two admins approving at once: one gets the rows, the other
+-- gets nothing.
+create or replace function approve_shipment_requests(p_req_ids bigint[], p_admin bigint)
+returns table (id bigint, user_id bigint, tracking_code text, phone text, country text, shipment_created boolean)
+language sql as $$
+    with approved as (
+        update shipment_requests sr
+        set status = 'approved', claimed_by = null, claimed_until = null
+        where sr.id = any(p_req_ids) and sr.status = 'pending'
+          and (sr.claimed_by is null or sr.claimed_by = p_admin or sr.claimed_until <= now())
+        returning sr.*
+    ), inserted as (
+        insert into shipments (tracking_code, phone, description, status, image_url)
+        select distinct on (a.tracking_code) a.tracking_code, a.phone, 'Страна: ' || coalesce(a.country, ''), 'В пути', null
+        from approved a
+        order by a.tracking_code, a.id
+        on conflict (tracking_code) do nothing
+        returning shipments.tracking_code
+    )
+    select a.id::bigint, a.user_id::bigint, a.tracking_code::text, a.phone::text, a.country::text,
+           exists (select 1 from inserted i where i.tracking_code = a.tracking_code)
+    from approved a
+    order by a.id;
+$$;
+
+create or replace function reject_shipment_requests(p_req_ids bigint[], p_admin bigint)
+returns table (id bigint, user_id bigint)
+language sql as $$
+    update shipment_requests sr
+    set status = 'rejected', claimed_by = null, claimed_until = null
+    where sr.id = any(p_req_ids) and sr.status = 'pending'
+      and (sr.claimed_by is null or sr.claimed_by = p_admin or sr.claimed_until <= now())
+    returning sr.id::bigint, sr.user_id::bigint;
+$$;
@@ -0,0 +1,12 @@
+-- /start profile writes from the bot's write-behind buffer:
+-- select upsert_users('[{"id": 1, "username": "x", "phone": null, "role": "user"}, ...]');
+-- New users get 'ru' (or the row's language); existing users keep the language
+-- they picked, which only set_user_languages (007) changes.
+create or replace function upsert_users(p_rows jsonb)
+returns void language sql as $$
+    insert into users (id, username, phone, role, language)
+    select x.id, x.username, x.phone, coalesce(x.role, 'user'), coalesce(x.language, 'ru')
+    from jsonb_to_recordset(p_rows) as x(id bigint, username text, phone text, role text, language text)
+    on conflict (id) do update set
+        username = excluded.username, phone = excluded.phone, role = excluded.role;
+$$;